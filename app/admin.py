@@ -1,6 +1,23 @@
 from django.contrib import admin
+from django.contrib.auth.admin import UserAdmin
+from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
+from django.utils import timezone
 
-from app.models import Post, Like, DisLike, Report, Comment, Media
+from app.models import Post, Like, DisLike, Report, Comment, Media, Blob, PendingDeletion, Task, \
+    UserStats
+from app.purge import schedule_post_deletion, schedule_user_deletion
+
+
+class BackgroundDeleteMixin:
+    """
+    Для моделей которые удаляются в фоне: страница подтверждения не собирает
+    все связанные строки (для популярного поста это сотни тысяч объектов)
+    """
+
+    def get_deleted_objects(self, objs, request):
+        objs = list(objs)
+        return [str(obj) for obj in objs], {self.model._meta.verbose_name_plural: len(objs)}, set(), []
 
 
 class CommentInline(admin.TabularInline):
@@ -15,23 +32,41 @@ class MediaInline(admin.StackedInline):
 
 
 @admin.register(Post)
-class PostAdmin(admin.ModelAdmin):
+class PostAdmin(BackgroundDeleteMixin, admin.ModelAdmin):
     """
     Админ Панель для Модельки Поста
     """
     # Помогает нам видеть какие столбцы должны быть в списке Постов
-    list_display = ["pk", "title", "author", "created_at", "get_like_count", "get_dislike_count", "get_comment_count"]
+    list_display = ["pk", "title", "author", "created_at", "view_count", "get_like_count", "get_dislike_count",
+                    "get_comment_count"]
     # Помогает нам создать фильтры для определенных столбцов
-    list_filter = ["author", "created_at"]
+    list_filter = ["author", "created_at", "is_deleted"]
     # Помогает реализовать поиск по определенным столбцам
     search_fields = ["title"]
     # Помогает реализовать пагинацию разделение на страницы
     list_per_page = 50
     # Подключение Вкладок с привязанными к нашей модели других
     inlines = [CommentInline, MediaInline]
+    # Счетчики пишут только viewcounts, archive и related, в форме их не меняем
+    readonly_fields = ["view_count", "archived_at", "archived_likes", "archived_dislikes", "archived_comments",
+                       "related_at"]
 
     # TODO: Нужно реализовать логику кол-во лайков, дизлайков и комментов
 
+    def save_model(self, request, obj, form, change):
+        if not change:
+            return super().save_model(request, obj, form, change)
+        # Только поля формы, иначе save() запишет устаревшие счетчики поверх параллельного обновления
+        obj.save(update_fields=list(form.base_fields))
+
+    def delete_model(self, request, obj):
+        # Скрываем сразу, остальное удаляется в фоне
+        schedule_post_deletion(obj)
+
+    def delete_queryset(self, request, queryset):
+        for post in queryset:
+            schedule_post_deletion(post)
+
     def get_like_count(self, obj):
         """
         Метод для подсчета кол-во Лайков
@@ -68,3 +103,58 @@ class ReportAdmin(admin.ModelAdmin):
     list_display = ["theme", "post", "user", "is_solve", "created_at"]
     list_filter = ["user", "theme", "is_solve", "created_at"]
     list_per_page = 35
+
+
+@admin.register(Blob)
+class BlobAdmin(admin.ModelAdmin):
+    list_display = ["name", "size", "ref_count", "created_at"]
+    list_filter = ["created_at"]
+    search_fields = ["name"]
+    list_per_page = 50
+
+
+@admin.register(PendingDeletion)
+class PendingDeletionAdmin(admin.ModelAdmin):
+    list_display = ["kind", "object_id", "created_at"]
+    list_filter = ["kind"]
+
+
+@admin.register(Task)
+class TaskAdmin(admin.ModelAdmin):
+    list_display = ["pk", "name", "status", "attempts", "run_at", "dedup_key", "created_at"]
+    list_filter = ["status", "name"]
+    search_fields = ["name", "dedup_key"]
+    list_per_page = 50
+    actions = ["retry"]
+
+    @admin.action(description="Перезапустить")
+    def retry(self, request, queryset):
+        for task in queryset.filter(status=Task.FAILED):
+            try:
+                with transaction.atomic():
+                    Task.objects.filter(pk=task.pk).update(status=Task.QUEUED, attempts=0, run_at=timezone.now())
+            except IntegrityError:
+                # Такая же задача (dedup_key) уже ждет в очереди - она и выполнит работу
+                task.delete()
+
+
+@admin.register(UserStats)
+class UserStatsAdmin(admin.ModelAdmin):
+    list_display = ["user", "posts_count", "likes_received", "dislikes_received", "comments_received",
+                    "open_reports"]
+    list_select_related = ["user"]
+    list_per_page = 50
+
+
+# Пользователи тоже удаляются в фоне, у них может быть очень много данных
+admin.site.unregister(User)
+
+
+@admin.register(User)
+class CustomUserAdmin(BackgroundDeleteMixin, UserAdmin):
+    def delete_model(self, request, obj):
+        schedule_user_deletion(obj)
+
+    def delete_queryset(self, request, queryset):
+        for user in queryset:
+            schedule_user_deletion(user)
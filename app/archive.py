@@ -0,0 +1,263 @@
+import os
+import time
+from collections import Counter
+from datetime import timedelta
+
+from django.apps import apps
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
+from django.utils import timezone
+
+from app.models import ArchivedComment, ArchivedDisLike, ArchivedLike, Comment, DisLike, Like, Post
+
+# Алиас архивной базы в DATABASES и имя схемы под которым она подключена (ATTACH) к основной
+ALIAS = getattr(settings, "ARCHIVE_DATABASE", "archive")
+SCHEMA = "archive"
+# Лайки и комменты постов старше стольких дней уезжают в архив
+AFTER_DAYS = getattr(settings, "ARCHIVE_AFTER_DAYS", 180)
+# Сколько строк переносим за одну транзакцию и пауза между порциями
+CHUNK_SIZE = getattr(settings, "ARCHIVE_CHUNK_SIZE", 1000)
+CHUNK_PAUSE = getattr(settings, "ARCHIVE_CHUNK_PAUSE", 0.05)
+
+# Что архивируем: модель -> (архивная модель, колонки, счетчик в Post)
+ARCHIVED = {
+    Comment: (ArchivedComment, ["id", "post_id", "user_id", "body", "created_at"], "archived_comments"),
+    Like: (ArchivedLike, ["id", "post_id", "user_id"], "archived_likes"),
+    DisLike: (ArchivedDisLike, ["id", "post_id", "user_id"], "archived_dislikes"),
+}
+
+
+class ArchiveRouter:
+    """
+    Архивные модели (is_archive = True) живут в базе ALIAS, все остальное - в основной.
+    Таблицы архива создаются командой: python manage.py migrate --database archive
+    """
+
+    def db_for_read(self, model, **hints):
+        return ALIAS if getattr(model, "is_archive", False) else None
+
+    db_for_write = db_for_read
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # В миграциях приходят исторические модели без is_archive, смотрим на настоящую
+        model = None
+        if model_name is not None:
+            try:
+                model = apps.get_model(app_label, model_name)
+            except LookupError:
+                pass
+        is_archive = getattr(model, "is_archive", False)
+        if db == ALIAS:
+            return is_archive
+        return False if is_archive else None
+
+
+def archive_name():
+    """
+    Файл архивной базы, с которым работает ORM (под тестами - тестовая база)
+    """
+    return str(connections[ALIAS].settings_dict["NAME"])
+
+
+def attach(sender, connection, **kwargs):
+    """
+    connection_created: подключает архивную базу к основному соединению как схему archive,
+    чтобы переносить строки одним INSERT ... SELECT, без выгрузки в Python
+    """
+    if connection.vendor != "sqlite" or ALIAS not in settings.DATABASES:
+        return
+    if connection.alias == DEFAULT_DB_ALIAS:
+        connection.archive_name = None  # Новое соединение, ничего не подключено
+        _attach(connection)
+    elif connection.alias == ALIAS:
+        # Тестовая архивная база создается после основной, основное соединение
+        # к этому времени уже подключило настоящий файл - переподключаем
+        main = connections[DEFAULT_DB_ALIAS]
+        if main.connection is not None and not main.in_atomic_block:
+            _attach(main)
+
+
+def _attach(connection):
+    name = archive_name()
+    if getattr(connection, "archive_name", None) == name:
+        return
+    with connection.cursor() as cursor:
+        if getattr(connection, "archive_name", None) is not None:
+            cursor.execute("DETACH DATABASE " + SCHEMA)
+        # Django открывает sqlite с uri=True, поэтому тестовая база в памяти
+        # (file:memorydb_archive?mode=memory&cache=shared) подключается та же самая
+        cursor.execute("ATTACH DATABASE %s AS " + SCHEMA, [name])
+    connection.archive_name = name
+
+
+def _tables(model):
+    archive_model, columns, counter = ARCHIVED[model]
+    quote = connection.ops.quote_name
+    return (
+        quote(model._meta.db_table),
+        "%s.%s" % (quote(SCHEMA), quote(archive_model._meta.db_table)),
+        ", ".join(quote(column) for column in columns),
+        counter,
+    )
+
+
+def archive_chunk(model, cutoff, chunk_size=CHUNK_SIZE):
+    """
+    Переносит одну порцию строк model под постами созданными раньше cutoff.
+    Сначала копируем (INSERT OR IGNORE - повтор после сбоя безопасен), потом
+    в отдельной транзакции удаляем из основной базы и увеличиваем счетчики Post.
+    Пока счетчик не увеличен, пост читает строку из основной базы - счет всегда точный
+    :return: Сколько строк перенесено
+    """
+    hot, archived, columns, counter = _tables(model)
+    posts = connection.ops.quote_name(Post._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.id FROM %s c JOIN %s p ON p.id = c.post_id "
+            "WHERE p.created_at < %%s AND p.is_deleted = %%s ORDER BY c.id LIMIT %%s" % (hot, posts),
+            [connection.ops.adapt_datetimefield_value(cutoff), False, chunk_size],
+        )
+        ids = [row[0] for row in cursor.fetchall()]
+    if not ids:
+        return 0
+    placeholders = ", ".join(["%s"] * len(ids))
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "INSERT OR IGNORE INTO %s (%s) SELECT %s FROM %s WHERE id IN (%s)"
+                % (archived, columns, columns, hot, placeholders), ids,
+            )
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            # Пока копировали, часть строк могли удалить (сняли лайк) - их копии не нужны
+            cursor.execute("SELECT id FROM %s WHERE id IN (%s)" % (hot, placeholders), ids)
+            present = {row[0] for row in cursor.fetchall()}
+            gone = [pk for pk in ids if pk not in present]
+            if gone:
+                cursor.execute(
+                    "DELETE FROM %s WHERE id IN (%s)" % (archived, ", ".join(["%s"] * len(gone))), gone
+                )
+            if not present:
+                return 0
+            present = list(present)
+            placeholders = ", ".join(["%s"] * len(present))
+            cursor.execute(
+                "SELECT post_id, COUNT(*) FROM %s WHERE id IN (%s) GROUP BY post_id" % (hot, placeholders), present
+            )
+            per_post = cursor.fetchall()
+            cursor.execute("DELETE FROM %s WHERE id IN (%s)" % (hot, placeholders), present)
+            # Счетчики в той же транзакции что и удаление
+            now = connection.ops.adapt_datetimefield_value(timezone.now())
+            for post_id, count in per_post:
+                cursor.execute(
+                    "UPDATE %s SET %s = %s + %%s, archived_at = COALESCE(archived_at, %%s) WHERE id = %%s"
+                    % (posts, counter, counter), [count, now, post_id],
+                )
+    return len(present)
+
+
+def archive_old(days=AFTER_DAYS, chunk_size=CHUNK_SIZE, pause=CHUNK_PAUSE):
+    """
+    Переносит в архив все лайки, дизлайки и комменты постов старше days дней
+    :return: {модель: сколько строк перенесено}
+    """
+    cutoff = timezone.now() - timedelta(days=days)
+    moved = Counter()
+    for model in ARCHIVED:
+        while True:
+            count = archive_chunk(model, cutoff, chunk_size)
+            if not count:
+                break
+            moved[model.__name__] += count
+            time.sleep(pause)
+    return dict(moved)
+
+
+def unarchive(model, condition, params, chunk_size=CHUNK_SIZE):
+    """
+    Возвращает строки model из архива в основную базу - archive_chunk наоборот.
+    Основная и архивная база - разные файлы, в WAL одна транзакция на обе не атомарна,
+    поэтому два шага: в транзакции основной базы копируем (INSERT OR IGNORE) и уменьшаем
+    счетчики Post ровно на кол-во вставленных строк, потом отдельно удаляем архивные копии.
+    Сбой между шагами оставляет строку в обеих базах, но счетчик ее уже не считает - счет
+    точный, а повтор ничего не вставит второй раз и только доудалит копии
+    :param condition: SQL условие на архивную таблицу, например "user_id = %s"
+    :return: Сколько строк возвращено
+    """
+    hot, archived, columns, counter = _tables(model)
+    posts = connection.ops.quote_name(Post._meta.db_table)
+    total = 0
+    while True:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT id FROM %s WHERE %s ORDER BY id LIMIT %%s" % (archived, condition), list(params) + [chunk_size]
+            )
+            ids = [row[0] for row in cursor.fetchall()]
+        if not ids:
+            return total
+        placeholders = ", ".join(["%s"] * len(ids))
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                # Сколько строк реально вставится: тех что уже есть в основной базе не считаем
+                cursor.execute(
+                    "SELECT post_id, COUNT(*) FROM %s WHERE id IN (%s) "
+                    "AND id NOT IN (SELECT id FROM %s WHERE id IN (%s)) GROUP BY post_id"
+                    % (archived, placeholders, hot, placeholders), ids + ids,
+                )
+                per_post = cursor.fetchall()
+                cursor.execute(
+                    "INSERT OR IGNORE INTO %s (%s) SELECT %s FROM %s WHERE id IN (%s)"
+                    % (hot, columns, columns, archived, placeholders), ids,
+                )
+                for post_id, count in per_post:
+                    cursor.execute(
+                        "UPDATE %s SET %s = %s - %%s WHERE id = %%s" % (posts, counter, counter), [count, post_id]
+                    )
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute("DELETE FROM %s WHERE id IN (%s)" % (archived, placeholders), ids)
+        total += len(ids)
+        if len(ids) < chunk_size:
+            return total
+        time.sleep(CHUNK_PAUSE)
+
+
+def restore_reactions(post, user_id):
+    """
+    Возвращает лайк/дизлайк пользователя из архива в основную базу, чтобы
+    повторное нажатие снимало его как обычно. Вставка SQL-запросом, без сигналов:
+    в статистике эта реакция уже учтена
+    """
+    if post.archived_at is None:
+        return
+    for model in (Like, DisLike):
+        unarchive(model, "post_id = %s AND user_id = %s", [post.pk, user_id])
+
+
+def delete_archived_post(post_id):
+    """
+    Удаляет архивные строки поста (при окончательном удалении поста)
+    """
+    for archive_model, _, _ in ARCHIVED.values():
+        archive_model.objects.filter(post_id=post_id).delete()
+
+
+def unarchive_user(user_id):
+    """
+    Возвращает архивные лайки/комменты пользователя в основную базу, откуда их
+    удаляет обычная очистка пользователя (purge_user) вместе со свежими
+    """
+    for model in ARCHIVED:
+        unarchive(model, "user_id = %s", [user_id])
+
+
+def archive_size():
+    """
+    Размер файла архивной базы в байтах (для вывода в команде)
+    """
+    if ALIAS not in settings.DATABASES:
+        return 0
+    try:
+        return os.path.getsize(archive_name())
+    except OSError:
+        return 0
@@ -0,0 +1,79 @@
+from collections import Counter
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from app.models import Blob
+from app.storage import select_media_storage
+
+
+def retain_blobs(names):
+    """
+    Увеличивает счетчик ссылок на файлы, если файла еще нет в учете - создает запись
+    :param names: Имена файлов (могут повторяться)
+    """
+    storage = select_media_storage()
+    for name, count in Counter(n for n in names if n).items():
+        updated = Blob.objects.filter(name=name).update(ref_count=F("ref_count") + count)
+        if updated:
+            continue
+        try:
+            size = storage.size(name)
+        except OSError:
+            size = 0
+        try:
+            with transaction.atomic():
+                Blob.objects.create(name=name, size=size, ref_count=count)
+        except IntegrityError:  # Параллельно создали ту же запись
+            Blob.objects.filter(name=name).update(ref_count=F("ref_count") + count)
+
+
+def register_blob(name, size):
+    """
+    Учитывает только что загруженный файл без ссылок: если его так
+    и не привяжут к Media, collect_blobs удалит его после grace периода
+    """
+    try:
+        with transaction.atomic():
+            _, created = Blob.objects.get_or_create(name=name, defaults={"size": size, "ref_count": 0})
+    except IntegrityError:  # Параллельно создали ту же запись
+        created = False
+    if not created:
+        # Такой же файл без ссылок ждет удаления - откладываем, пока загрузку не сохранят
+        Blob.objects.filter(name=name, ref_count__lte=0).update(created_at=timezone.now())
+
+
+def release_blobs(names):
+    """
+    Уменьшает счетчик ссылок, сами файлы удаляет gc_media после grace периода.
+    Файл без ссылок получает новый created_at: такую же загрузку, которая уже
+    нашла этот файл в хранилище, но еще не сохранила Media, он дождется
+    :param names: Имена файлов (могут повторяться)
+    """
+    counts = Counter(n for n in names if n)
+    for name, count in counts.items():
+        Blob.objects.filter(name=name).update(ref_count=F("ref_count") - count)
+    Blob.objects.filter(name__in=list(counts), ref_count__lte=0).update(created_at=timezone.now())
+
+
+def collect_blobs(names=None, older_than=None):
+    """
+    Удаляет файлы на которые больше никто не ссылается
+    :param names: Проверить только эти файлы, по умолчанию все
+    :param older_than: Не трогать файлы загруженные позже этого времени
+    :return: Сколько файлов удалено
+    """
+    storage = select_media_storage()
+    queryset = Blob.objects.filter(ref_count__lte=0)
+    if names is not None:
+        queryset = queryset.filter(name__in=list(names))
+    if older_than is not None:
+        queryset = queryset.filter(created_at__lt=older_than)
+    deleted = 0
+    for blob_id, name in queryset.values_list("pk", "name").iterator():
+        # Удаляем запись только если за это время на файл никто не сослался
+        if Blob.objects.filter(pk=blob_id, ref_count__lte=0).delete()[0]:
+            storage.delete(name)
+            deleted += 1
+    return deleted
@@ -0,0 +1,228 @@
+import os
+import tempfile
+from datetime import datetime, timezone
+from xml.sax.saxutils import escape
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.urls import reverse
+from django.utils.feedgenerator import Atom1Feed, Rss201rev2Feed
+
+from app.models import Post
+from app.taskqueue import task
+
+ROOT = getattr(settings, "FEEDS_ROOT", os.path.join(settings.BASE_DIR, "cache", "feeds"))
+SITE_URL = getattr(settings, "FEEDS_SITE_URL", "http://localhost:8000").rstrip("/")
+# Сколько последних постов в ленте
+ITEMS = getattr(settings, "FEED_ITEMS", 50)
+# Сколько постов в одном файле карты сайта (лимит протокола - 50 000)
+SEGMENT_SIZE = getattr(settings, "SITEMAP_SEGMENT_SIZE", 10_000)
+# Пачка постов подряд обновляет файл один раз
+REGENERATE_DELAY = getattr(settings, "FEEDS_REGENERATE_DELAY", 5)
+# Сколько секунд браузер/прокси не перепроверяет ленту, дальше 304 по ETag
+MAX_AGE = getattr(settings, "FEEDS_MAX_AGE", 5 * 60)
+# Файла еще нет: сборка уходит в очередь, клиент повторит запрос через столько секунд
+RETRY_AFTER = getattr(settings, "FEEDS_RETRY_AFTER", 30)
+
+FEED_CLASSES = {"rss": Rss201rev2Feed, "atom": Atom1Feed}
+CONTENT_TYPES = {
+    "rss": "application/rss+xml; charset=utf-8",
+    "atom": "application/atom+xml; charset=utf-8",
+    "sitemap": "application/xml; charset=utf-8",
+}
+
+
+def feed_path(kind, author_id=None):
+    if author_id is None:
+        return os.path.join(ROOT, "feed.%s.xml" % kind)
+    return os.path.join(ROOT, "authors", "%s.%s.xml" % (author_id, kind))
+
+
+def segment_path(segment):
+    return os.path.join(ROOT, "sitemap", "%d.xml" % segment)
+
+
+def index_path():
+    return os.path.join(ROOT, "sitemap", "index.xml")
+
+
+def post_url(pk):
+    return SITE_URL + reverse("post-detail", args=[pk])
+
+
+def _write_atomic(path, write):
+    """
+    Пишет во временный файл и подменяет, читатели никогда не видят недописанный файл
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as fh:
+            write(fh)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+@task
+def build_feeds(author_id=None):
+    """
+    Перестраивает RSS и Atom ленту (общую либо автора)
+    :param author_id: pk автора, None - общая лента
+    """
+    posts = Post.objects.visible().order_by("-created_at")
+    title = "Django Blog"
+    if author_id is not None:
+        username = User.objects.filter(pk=author_id, is_active=True).values_list("username", flat=True).first()
+        if username is None:  # Пользователя удалили - ленты больше нет
+            for kind in FEED_CLASSES:
+                if os.path.exists(feed_path(kind, author_id)):
+                    os.remove(feed_path(kind, author_id))
+            return
+        posts = posts.filter(author_id=author_id)
+        title = "Django Blog - %s" % username
+    items = list(posts.values("pk", "title", "content", "created_at", "author__username")[:ITEMS])
+
+    link = SITE_URL + reverse("post-list")
+    for kind, feed_class in FEED_CLASSES.items():
+        feed = feed_class(
+            title=title,
+            link=link,
+            description="Новые посты",
+            language="ru",
+            feed_url=SITE_URL + (reverse("feed", args=[kind]) if author_id is None
+                                 else reverse("author-feed", args=[author_id, kind])),
+        )
+        for item in items:
+            feed.add_item(
+                title=item["title"],
+                link=post_url(item["pk"]),
+                description=item["content"],
+                author_name=item["author__username"],
+                pubdate=item["created_at"],
+                unique_id=post_url(item["pk"]),
+            )
+        _write_atomic(feed_path(kind, author_id), lambda fh: feed.write(fh, "utf-8"))
+
+
+@task
+def build_sitemap_segment(segment):
+    """
+    Перестраивает один файл карты сайта: посты с pk от segment*SEGMENT_SIZE
+    до (segment+1)*SEGMENT_SIZE, и индекс
+    :return: Есть ли в сегменте посты
+    """
+    posts = (
+        Post.objects.visible()
+        .filter(pk__gte=segment * SEGMENT_SIZE, pk__lt=(segment + 1) * SEGMENT_SIZE)
+        .order_by("pk")
+        .values_list("pk", "created_at")
+    )
+    count = 0
+
+    def write(fh):
+        nonlocal count
+        fh.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        fh.write('<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+        for pk, created_at in posts.iterator(chunk_size=2000):
+            fh.write("<url><loc>%s</loc><lastmod>%s</lastmod></url>\n"
+                     % (escape(post_url(pk)), created_at.date().isoformat()))
+            count += 1
+        fh.write("</urlset>\n")
+
+    path = segment_path(segment)
+    _write_atomic(path, write)
+    if not count:  # Все посты сегмента удалены
+        os.remove(path)
+    build_sitemap_index()
+    return bool(count)
+
+
+def build_sitemap_index():
+    """
+    Индекс карты сайта по существующим файлам сегментов, базу не трогает
+    """
+    directory = os.path.dirname(index_path())
+    segments = []
+    if os.path.isdir(directory):
+        for filename in os.listdir(directory):
+            name, extension = os.path.splitext(filename)
+            if extension == ".xml" and name.isdigit():
+                segments.append(int(name))
+
+    def write(fh):
+        fh.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        fh.write('<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+        for segment in sorted(segments):
+            modified = os.path.getmtime(segment_path(segment))
+            fh.write("<sitemap><loc>%s</loc><lastmod>%s</lastmod></sitemap>\n" % (
+                escape(SITE_URL + reverse("sitemap-segment", args=[segment])),
+                _isoformat(modified),
+            ))
+        fh.write("</sitemapindex>\n")
+
+    _write_atomic(index_path(), write)
+
+
+def _isoformat(timestamp):
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+@task
+def build_sitemap():
+    """
+    Перестраивает все сегменты карты сайта и индекс
+    :return: Кол-во сегментов с постами
+    """
+    last_segment = (Post.objects.order_by("-pk").values_list("pk", flat=True).first() or 0) // SEGMENT_SIZE
+    # Сегменты за последним постом остались от удаленных постов
+    directory = os.path.dirname(index_path())
+    if os.path.isdir(directory):
+        for filename in os.listdir(directory):
+            name, extension = os.path.splitext(filename)
+            if extension == ".xml" and name.isdigit() and int(name) > last_segment:
+                os.remove(os.path.join(directory, filename))
+    segment_count = sum(build_sitemap_segment(segment) for segment in range(last_segment + 1))
+    build_sitemap_index()
+    return segment_count
+
+
+def build_all():
+    """
+    Перестраивает все ленты и карту сайта
+    :return: (кол-во лент авторов, кол-во сегментов)
+    """
+    build_feeds()
+    authors = Post.objects.visible().values_list("author_id", flat=True).distinct()
+    author_count = 0
+    for author_id in authors.iterator():
+        build_feeds(author_id)
+        author_count += 1
+    return author_count, build_sitemap()
+
+
+def schedule_post_changed(post_id, author_id):
+    """
+    Ставит в очередь перестройку только того что затронул пост:
+    общая лента, лента автора и один сегмент карты сайта
+    """
+    options = dict(delay=REGENERATE_DELAY)
+    build_feeds.enqueue(dedup_key="feeds", **options)
+    build_feeds.enqueue(author_id, dedup_key="feeds:%s" % author_id, **options)
+    segment = post_id // SEGMENT_SIZE
+    build_sitemap_segment.enqueue(segment, dedup_key="sitemap:%s" % segment, **options)
+
+
+def schedule_author_changed(author_id):
+    """
+    То же для всех постов автора сразу (например пользователя удалили)
+    """
+    options = dict(delay=REGENERATE_DELAY)
+    build_feeds.enqueue(dedup_key="feeds", **options)
+    build_feeds.enqueue(author_id, dedup_key="feeds:%s" % author_id, **options)
+    segments = {pk // SEGMENT_SIZE for pk in Post.objects.filter(author_id=author_id).values_list("pk", flat=True)}
+    for segment in sorted(segments):
+        build_sitemap_segment.enqueue(segment, dedup_key="sitemap:%s" % segment, **options)
@@ -47,6 +47,14 @@ class PostForm(forms.ModelForm):
         model = Post
         fields = ["title", "content"]
 
+    def save(self, commit=True):
+        if not commit or self.instance._state.adding:
+            return super().save(commit)
+        # Пишем только поля формы: счетчики в строке поста меняются параллельно (просмотры, архив)
+        self.instance.save(update_fields=self._meta.fields)
+        self._save_m2m()
+        return self.instance
+
 
 class CustomUserCreationForm(UserCreationForm):
     first_name = forms.CharField(max_length=255)
@@ -0,0 +1,393 @@
+import hashlib
+import http.client
+import io
+import ipaddress
+import os
+import socket
+import tempfile
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core import signing
+from django.urls import reverse
+from PIL import Image, UnidentifiedImageError
+
+from app.images import SNIFF_SIZE, sniff_file_type, sniff_image_type
+
+# Настройки IMAGE_PROXY_<имя> читаются при каждом вызове (override_settings в тестах)
+DEFAULTS = {
+    "ENABLED": True,
+    "CACHE_DIR": os.path.join(settings.BASE_DIR, "cache", "images"),
+    "MAX_CACHE_BYTES": 256 * 1024 * 1024,
+    "TTL": 7 * 24 * 60 * 60,
+    "TIMEOUT": 5,
+    "MAX_IMAGE_BYTES": 10 * 1024 * 1024,
+    "MAX_WIDTH": 2000,
+    # Сколько секунд не пытаемся заново скачать картинку, которую скачать не удалось
+    "FAILURE_TTL": 5 * 60,
+    # Разрешить скачивание с локальных/внутренних адресов (только для тестов с локальным сервером)
+    "ALLOW_PRIVATE": False,
+}
+
+SALT = "image-proxy"
+CHUNK_SIZE = 64 * 1024
+# Чаще раза в минуту время доступа не обновляем, лишняя запись на диск
+TOUCH_INTERVAL = 60
+# После вытеснения оставляем запас, чтобы не чистить на каждой записи
+EVICT_TARGET = 0.9
+
+# Файл рядом с картинкой: скачать не удалось, время изменения - когда
+FAILURE_SUFFIX = ".failed"
+
+# Ожидающие одного и того же URL ждут одну загрузку и получают ее результат
+_inflight = {}
+_inflight_guard = threading.Lock()
+# Примерный размер кеша в байтах по папкам кеша, нет ключа - еще не считали
+_cache_sizes = {}
+_cache_size_guard = threading.Lock()
+
+
+class ImageProxyError(Exception):
+    """
+    Не удалось скачать или проверить картинку
+    """
+    pass
+
+
+def option(name):
+    """
+    :return: Настройка IMAGE_PROXY_<name>
+    """
+    return getattr(settings, "IMAGE_PROXY_" + name, DEFAULTS[name])
+
+
+def proxied_url(url, width=None):
+    """
+    Ссылка на картинку через наш прокси, подписана чтобы прокси не был открытым
+    :param url: Внешняя ссылка на картинку
+    :param width: Уменьшить до такой ширины
+    :return: /img/<token>
+    """
+    if not url or not option("ENABLED"):
+        return url
+    if width:
+        width = min(int(width), option("MAX_WIDTH"))
+    # Без метки времени: одна и та же картинка - всегда один и тот же URL (кеш браузера/CDN)
+    token = signing.Signer(salt=SALT).sign_object([url, width or None], compress=True)
+    return reverse("image-proxy", args=[token])
+
+
+def load_token(token):
+    """
+    :return: (url, width)
+    :raises signing.BadSignature: Ссылку подделали
+    """
+    url, width = signing.Signer(salt=SALT).unsign_object(token)
+    return url, width
+
+
+def cache_path(url, width=None):
+    key = hashlib.sha256(("%s|%s" % (url, width or "")).encode()).hexdigest()
+    return os.path.join(option("CACHE_DIR"), key[:2], key)
+
+
+def get_image(url, width=None):
+    """
+    Отдает картинку из кеша, при необходимости скачивает.
+    Одновременные запросы одного URL скачивают его один раз и получают общий результат,
+    неудачная загрузка запоминается на FAILURE_TTL секунд
+    :param url: Внешняя ссылка
+    :param width: Ширина до которой уменьшить
+    :return: (путь к файлу в кеше, MIME тип)
+    :raises ImageProxyError: Скачать не удалось и старой копии нет
+    """
+    path = cache_path(url, width)
+    if _is_fresh(path):
+        _touch(path)
+        return path, sniff_file_type(path)
+
+    with _coalesce(path) as inflight:
+        if inflight.done:  # Пока ждали, другой поток уже попробовал
+            if inflight.error is not None:
+                raise inflight.error
+            return inflight.result
+        try:
+            inflight.result = _load(url, width, path)
+        except ImageProxyError as e:
+            inflight.error = e
+            raise
+        finally:
+            inflight.done = True
+    return inflight.result
+
+
+def _load(url, width, path):
+    # Другой процесс мог скачать картинку или запомнить неудачу
+    if _is_fresh(path):
+        return path, sniff_file_type(path)
+    try:
+        if _recently_failed(path):
+            raise ImageProxyError("Не удалось скачать %s, повтор позже" % url)
+        try:
+            data = process(fetch(url), width)
+        except ImageProxyError:
+            _mark_failed(path)
+            raise
+    except ImageProxyError:
+        if os.path.exists(path):  # Лучше устаревшая картинка чем сломанная карточка
+            return path, sniff_file_type(path)
+        raise
+    _store(path, data)
+    try:
+        os.remove(path + FAILURE_SUFFIX)
+    except OSError:
+        pass
+    return path, sniff_image_type(data[:SNIFF_SIZE])
+
+
+def fetch(url):
+    """
+    Скачивает картинку с ограничением по размеру и времени
+    :return: Байты картинки
+    """
+    _check_url(url)
+    max_bytes = option("MAX_IMAGE_BYTES")
+    # Без прокси из окружения: соединяемся только с адресом, который сами проверили
+    opener = urllib.request.build_opener(
+        urllib.request.ProxyHandler({}), _SafeRedirectHandler, _CheckedHTTPHandler, _CheckedHTTPSHandler
+    )
+    request = urllib.request.Request(url, headers={"User-Agent": "django-blog-image-proxy"})
+    try:
+        with opener.open(request, timeout=option("TIMEOUT")) as response:
+            length = response.headers.get("Content-Length")
+            if length and length.isdigit() and int(length) > max_bytes:
+                raise ImageProxyError("Картинка слишком большая")
+            buffer = io.BytesIO()
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                buffer.write(chunk)
+                if buffer.tell() > max_bytes:
+                    raise ImageProxyError("Картинка слишком большая")
+    except (OSError, http.client.HTTPException, ValueError) as e:
+        raise ImageProxyError("Не удалось скачать %s: %s" % (url, e))
+    return buffer.getvalue()
+
+
+def process(data, width=None):
+    """
+    Проверяет что это действительно картинка и при необходимости уменьшает
+    :param data: Байты картинки
+    :param width: Максимальная ширина
+    :return: Байты картинки (исходные если менять не пришлось)
+    """
+    if sniff_image_type(data[:SNIFF_SIZE]) is None:
+        raise ImageProxyError("Это не картинка")
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image.verify()
+        if not width:
+            return data
+        with Image.open(io.BytesIO(data)) as image:
+            if image.width <= width or getattr(image, "n_frames", 1) > 1:
+                return data  # Анимацию не трогаем
+            image_format = image.format
+            image.thumbnail((width, image.height))
+            output = io.BytesIO()
+            if image_format == "JPEG":
+                image.save(output, image_format, quality=85, optimize=True, progressive=True)
+            else:
+                image.save(output, image_format, optimize=True)
+            return output.getvalue()
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, SyntaxError, ValueError) as e:
+        raise ImageProxyError("Битая картинка: %s" % e)
+
+
+def _check_url(url):
+    """
+    Только http(s). Адрес хоста проверяется при соединении (_resolve)
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ImageProxyError("Неподдерживаемая ссылка")
+
+
+def _resolve(host, port):
+    """
+    Только публичные адреса, чтобы через прокси нельзя было достучаться
+    до внутренних сервисов. Соединяемся именно с проверенным адресом:
+    повторное разрешение имени могло бы вернуть другой (DNS rebinding)
+    :return: IP адрес для соединения
+    """
+    try:
+        addresses = socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)
+    except socket.gaierror as e:
+        raise ImageProxyError("Не удалось найти хост: %s" % e)
+    if not option("ALLOW_PRIVATE"):
+        for address in addresses:
+            if not ipaddress.ip_address(address[4][0]).is_global:
+                raise ImageProxyError("Внутренний адрес запрещен")
+    return addresses[0][4][0]
+
+
+class _CheckedHTTPConnection(http.client.HTTPConnection):
+    def connect(self):
+        address = _resolve(self.host, self.port)
+        self.sock = self._create_connection((address, self.port), self.timeout, self.source_address)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class _CheckedHTTPSConnection(http.client.HTTPSConnection, _CheckedHTTPConnection):
+    # HTTPSConnection.connect вызывает _CheckedHTTPConnection.connect и проверяет сертификат по имени хоста
+    pass
+
+
+class _CheckedHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(_CheckedHTTPConnection, req)
+
+
+class _CheckedHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(_CheckedHTTPSConnection, req, context=self._context)
+
+
+class _SafeRedirectHandler(urllib.request.HTTPRedirectHandler):
+    # Редирект тоже проверяем, иначе публичный сайт может перекинуть на file:// и т.п.
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        _check_url(newurl)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+class _Inflight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiters = 0
+        self.done = False
+        self.result = None
+        self.error = None
+
+
+@contextmanager
+def _coalesce(key):
+    """
+    Первый поток скачивает, остальные ждут на lock и берут его результат (done)
+    """
+    with _inflight_guard:
+        inflight = _inflight.get(key)
+        if inflight is None:
+            inflight = _inflight[key] = _Inflight()
+        inflight.waiters += 1
+    try:
+        with inflight.lock:
+            yield inflight
+    finally:
+        with _inflight_guard:
+            inflight.waiters -= 1
+            if inflight.waiters == 0:
+                del _inflight[key]
+
+
+def _is_fresh(path):
+    try:
+        return time.time() - os.stat(path).st_mtime < option("TTL")
+    except OSError:
+        return False
+
+
+def _recently_failed(path):
+    try:
+        return time.time() - os.stat(path + FAILURE_SUFFIX).st_mtime < option("FAILURE_TTL")
+    except OSError:
+        return False
+
+
+def _mark_failed(path):
+    """
+    Запоминаем неудачу на диске, чтобы ее видели все процессы
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + FAILURE_SUFFIX, "wb"):
+        pass
+
+
+def _touch(path):
+    """
+    Время доступа - для LRU, время изменения - когда скачали (для TTL)
+    """
+    try:
+        stat = os.stat(path)
+        now = time.time()
+        if now - stat.st_atime > TOUCH_INTERVAL:
+            os.utime(path, (now, stat.st_mtime))
+    except OSError:
+        pass
+
+
+def _store(path, data):
+    """
+    Атомарно записывает файл в кеш и следит за общим размером
+    """
+    cache_dir = option("CACHE_DIR")
+    max_cache_bytes = option("MAX_CACHE_BYTES")
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    try:
+        old_size = os.path.getsize(path)
+    except OSError:
+        old_size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "wb") as fh:
+        fh.write(data)
+    os.replace(tmp_path, path)
+
+    with _cache_size_guard:
+        if cache_dir not in _cache_sizes:
+            _cache_sizes[cache_dir] = _scan_size(cache_dir)
+        else:
+            _cache_sizes[cache_dir] += len(data) - old_size
+        if _cache_sizes[cache_dir] > max_cache_bytes:
+            _cache_sizes[cache_dir] = _evict(cache_dir, int(max_cache_bytes * EVICT_TARGET))
+
+
+def _scan_size(cache_dir):
+    total = 0
+    for directory, _, files in os.walk(cache_dir):
+        for filename in files:
+            try:
+                total += os.path.getsize(os.path.join(directory, filename))
+            except OSError:
+                pass
+    return total
+
+
+def _evict(cache_dir, target):
+    """
+    Удаляет давно не использованные картинки пока кеш не станет меньше target
+    :return: Новый размер кеша
+    """
+    entries = []
+    for directory, _, files in os.walk(cache_dir):
+        for filename in files:
+            path = os.path.join(directory, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_atime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    entries.sort()
+    for _, size, path in entries:
+        if total <= target:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+    return total
@@ -0,0 +1,40 @@
+# Сигнатуры (magic bytes) форматов картинок которые мы принимаем
+SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+
+# Расширение файла по типу
+EXTENSIONS = {
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+}
+
+# Сколько байт нужно чтобы узнать формат
+SNIFF_SIZE = 16
+
+
+def sniff_image_type(head):
+    """
+    Определяет тип картинки по первым байтам, не доверяя расширению и Content-Type
+    :param head: Первые байты файла (хватает SNIFF_SIZE)
+    :return: MIME тип либо None если это не картинка
+    """
+    for signature, content_type in SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+def sniff_file_type(path):
+    """
+    То же что sniff_image_type, но для файла на диске
+    """
+    with open(path, "rb") as fh:
+        return sniff_image_type(fh.read(SNIFF_SIZE))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+
+from app.archive import ALIAS, AFTER_DAYS, ARCHIVED, CHUNK_PAUSE, CHUNK_SIZE, archive_old, archive_size
+
+
+class Command(BaseCommand):
+    help = "Переносит лайки, дизлайки и комменты старых постов в архивную базу"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=AFTER_DAYS, help="Архивировать посты старше стольких дней")
+        parser.add_argument("--chunk", type=int, default=CHUNK_SIZE, help="Строк за одну транзакцию")
+        parser.add_argument("--pause", type=float, default=CHUNK_PAUSE, help="Пауза между порциями (секунды)")
+        parser.add_argument("--vacuum", action="store_true", help="После переноса сжать основную базу (VACUUM)")
+
+    def handle(self, *args, days=AFTER_DAYS, chunk=CHUNK_SIZE, pause=CHUNK_PAUSE, vacuum=False, **options):
+        tables = connections[ALIAS].introspection.table_names()
+        missing = [model._meta.db_table for model, _, _ in ARCHIVED.values() if model._meta.db_table not in tables]
+        if missing:
+            raise CommandError(
+                "В архивной базе нет таблиц %s, выполните: python manage.py migrate --database %s"
+                % (", ".join(missing), ALIAS)
+            )
+        moved = archive_old(days, chunk, pause)
+        for name, count in moved.items():
+            self.stdout.write("%s: %d" % (name, count))
+        if vacuum:
+            # Освободившиеся страницы возвращаем системе, основная база снова помещается в кеш
+            with connection.cursor() as cursor:
+                cursor.execute("VACUUM main")
+        self.stdout.write(self.style.SUCCESS(
+            "Перенесено строк: %d, размер архива: %.1f МБ" % (sum(moved.values()), archive_size() / 1024 / 1024)
+        ))
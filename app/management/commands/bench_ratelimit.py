@@ -0,0 +1,44 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+from django.urls import resolve
+
+from app.ratelimit import LocalBucketStore, RateLimitMiddleware, TokenBucketLimiter
+
+
+class Command(BaseCommand):
+    help = "Замер накладных расходов ограничителя частоты запросов (мкс на запрос)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("-n", "--number", type=int, default=100_000, help="Кол-во итераций")
+        parser.add_argument("--clients", type=int, default=1000, help="Кол-во разных клиентов")
+
+    def handle(self, *args, number=100_000, clients=1000, **options):
+        limiter = TokenBucketLimiter(LocalBucketStore())
+        keys = ["like:ip:10.0.%d.%d" % (i // 256, i % 256) for i in range(clients)]
+        self.report("TokenBucketLimiter.allow", number, lambda i: limiter.allow(keys[i % clients], "30/m"))
+
+        middleware = RateLimitMiddleware(lambda request: None)
+        middleware.limiter = TokenBucketLimiter(LocalBucketStore())
+        factory = RequestFactory()
+        requests = []
+        for i in range(clients):
+            request = factory.post("/posts/1/like", REMOTE_ADDR="10.1.%d.%d" % (i // 256, i % 256))
+            request.COOKIES["sessionid"] = "session%d" % i
+            middleware.sessions.add("session%d" % i)
+            request.resolver_match = resolve("/posts/1/like")
+            requests.append(request)
+        self.report(
+            "RateLimitMiddleware.process_view", number,
+            lambda i: middleware.process_view(requests[i % clients], None, (), {})
+        )
+
+    def report(self, title, number, func):
+        for i in range(min(number, 1000)):  # Прогрев
+            func(i)
+        start = time.perf_counter()
+        for i in range(number):
+            func(i)
+        elapsed = time.perf_counter() - start
+        self.stdout.write("%-35s %8.2f мкс/запрос" % (title, elapsed / number * 1_000_000))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from app.feeds import build_all
+
+
+class Command(BaseCommand):
+    help = "Собирает заново все RSS/Atom ленты и карту сайта"
+
+    def handle(self, *args, **options):
+        authors, segments = build_all()
+        self.stdout.write(self.style.SUCCESS(
+            "Собрано лент авторов: %d, сегментов карты сайта: %d" % (authors, segments)
+        ))
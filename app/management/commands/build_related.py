@@ -0,0 +1,19 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from app.related import COUNT, build_related
+
+
+class Command(BaseCommand):
+    help = "Пересчитывает похожие посты (TF-IDF по тексту + общие лайки)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--new", action="store_true", help="Только для постов у которых списка еще нет, по векторам последнего полного пересчета")
+        parser.add_argument("--count", type=int, default=COUNT, help="Сколько похожих хранить для поста")
+
+    def handle(self, *args, new=False, count=COUNT, **options):
+        try:
+            total = build_related(new_only=new, count=count)
+        except ImproperlyConfigured as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS("Посчитано постов: %d" % total))
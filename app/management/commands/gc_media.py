@@ -0,0 +1,142 @@
+import os
+from collections import Counter
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from app.blobs import collect_blobs
+from app.models import Blob, Media
+from app.storage import select_media_storage, staging_dir
+
+UPLOAD_DIR = Media._meta.get_field("file").upload_to.rstrip("/")
+# Сколько строк читаем одним запросом и чиним одной транзакцией
+BATCH_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = "Пересчитывает ссылки на файлы Media и удаляет файлы, на которые никто не ссылается"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Только показать что будет удалено")
+        parser.add_argument(
+            "--grace", type=int, default=3600,
+            help="Не трогать файлы моложе стольких секунд (идущие загрузки)"
+        )
+
+    def handle(self, *args, dry_run=False, grace=3600, **options):
+        storage = select_media_storage()
+        cutoff = timezone.now() - timedelta(seconds=grace)
+
+        referenced, known = self.recount(storage, dry_run)
+
+        # Блобы без ссылок
+        if dry_run:
+            orphans = Blob.objects.filter(ref_count__lte=0, created_at__lt=cutoff)
+            removed = 0
+            for name in orphans.values_list("name", flat=True).iterator():
+                if name not in referenced:  # Счетчик еще не исправлен в режиме --dry-run
+                    self.stdout.write("Удалить: %s" % name)
+                    removed += 1
+        else:
+            removed = collect_blobs(older_than=cutoff)
+
+        # Файлы на диске без учета: старые загрузки до хранилища по хешу,
+        # остатки каскадного удаления постов и недописанные .upload
+        root = storage.path(UPLOAD_DIR)
+        for directory, _, files in os.walk(root, topdown=False):
+            for filename in files:
+                path = os.path.join(directory, filename)
+                name = os.path.relpath(path, storage.location).replace(os.sep, "/")
+                if name in referenced or name in known or os.path.getmtime(path) >= cutoff.timestamp():
+                    continue
+                if dry_run:
+                    self.stdout.write("Удалить: %s" % name)
+                else:
+                    os.remove(path)
+                removed += 1
+            # Пустые подпапки блобов (post-gallery/ab/)
+            if directory != root and not dry_run and not os.listdir(directory):
+                os.rmdir(directory)
+
+        # Загрузки, брошенные упавшим процессом (обычно их удаляет сам обработчик загрузки)
+        staging = staging_dir()
+        for filename in os.listdir(staging):
+            path = os.path.join(staging, filename)
+            if filename.endswith(".upload") and os.path.getmtime(path) < cutoff.timestamp():
+                if dry_run:
+                    self.stdout.write("Удалить: %s" % path)
+                else:
+                    os.remove(path)
+                removed += 1
+
+        self.stdout.write(self.style.SUCCESS("Удалено файлов: %d" % removed))
+
+    def recount(self, storage, dry_run):
+        """
+        Сверяет ref_count с реальным кол-вом Media, счетчики могут разойтись
+        после массовых удалений мимо сигналов. Сначала читаем обе таблицы порциями
+        по pk без блокировки, потом перепроверяем и чиним только расхождения
+        короткими транзакциями (IMMEDIATE держит блокировку записи всю транзакцию)
+        :return: (файлы на которые есть ссылки, файлы в учете)
+        """
+        referenced = Counter()
+        for names in self.batches(Media.objects.exclude(file="").exclude(file__isnull=True), "file"):
+            referenced.update(names)
+        known = set()
+        suspects = []
+        for rows in self.batches(Blob.objects.all(), "name", "ref_count"):
+            for name, ref_count in rows:
+                known.add(name)
+                if referenced.get(name, 0) != ref_count:
+                    suspects.append(name)
+        suspects.extend(name for name in referenced if name not in known)
+        fixed = added = 0
+        if not dry_run:
+            for start in range(0, len(suspects), BATCH_SIZE):
+                batch_fixed, batch_added = self.fix(storage, suspects[start:start + BATCH_SIZE])
+                fixed += batch_fixed
+                added += batch_added
+        elif suspects:
+            self.stdout.write("Счетчиков к исправлению: %d" % len(suspects))
+        if fixed or added:
+            self.stdout.write("Исправлено счетчиков: %d, добавлено файлов: %d" % (fixed, added))
+        return set(referenced), known
+
+    @staticmethod
+    def batches(queryset, *fields):
+        """
+        Значения fields порциями по BATCH_SIZE в порядке pk, каждая порция - отдельный запрос
+        """
+        last_pk = 0
+        while True:
+            rows = list(queryset.filter(pk__gt=last_pk).order_by("pk").values_list("pk", *fields)[:BATCH_SIZE])
+            if not rows:
+                return
+            last_pk = rows[-1][0]
+            yield [row[1] if len(fields) == 1 else row[1:] for row in rows]
+
+    @staticmethod
+    def fix(storage, names):
+        """
+        Пересчитывает счетчики для names внутри транзакции (за это время их могли изменить)
+        :return: (исправлено счетчиков, добавлено файлов)
+        """
+        with transaction.atomic():
+            actual = dict(
+                Media.objects.filter(file__in=names).values("file").annotate(n=Count("pk")).values_list("file", "n")
+            )
+            fixed = []
+            for blob in Blob.objects.filter(name__in=names).only("pk", "name", "ref_count"):
+                count = actual.pop(blob.name, 0)
+                if blob.ref_count != count:
+                    blob.ref_count = count
+                    fixed.append(blob)
+            Blob.objects.bulk_update(fixed, ["ref_count"])
+            Blob.objects.bulk_create([
+                Blob(name=name, ref_count=count, size=storage.size(name) if storage.exists(name) else 0)
+                for name, count in actual.items()
+            ])
+        return len(fixed), len(actual)
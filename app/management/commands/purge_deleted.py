@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from app.purge import purge_pending
+
+
+class Command(BaseCommand):
+    help = "Доделывает фоновое удаление постов и пользователей (после перезапуска или падения)"
+
+    def handle(self, *args, **options):
+        done = purge_pending()
+        self.stdout.write(self.style.SUCCESS("Удалено объектов: %d" % done))
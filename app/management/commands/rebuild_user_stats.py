@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from app.stats import REBUILD_BATCH, rebuild_all, rebuild_user_stats
+
+
+class Command(BaseCommand):
+    help = "Пересчитывает статистику пользователей (UserStats) с нуля"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user", type=int, help="Пересчитать только этого пользователя")
+        parser.add_argument("--batch", type=int, default=REBUILD_BATCH, help="Пользователей за одну транзакцию")
+
+    def handle(self, *args, user=None, batch=REBUILD_BATCH, **options):
+        if user:
+            rebuild_user_stats(user)
+            total = 1
+        else:
+            total = rebuild_all(batch)
+        self.stdout.write(self.style.SUCCESS("Пересчитано пользователей: %d" % total))
@@ -0,0 +1,51 @@
+import multiprocessing
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from app.taskqueue import BATCH_SIZE, run_worker
+
+
+class Command(BaseCommand):
+    help = "Запускает воркеры фоновых задач (очередь хранится в базе)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int, default=1, help="Кол-во процессов")
+        parser.add_argument("--threads", type=int, default=1, help="Кол-во потоков в каждом процессе")
+        parser.add_argument("--batch", type=int, default=BATCH_SIZE, help="Сколько задач брать за раз")
+        parser.add_argument("--poll", type=float, default=1.0, help="Пауза когда задач нет (секунды)")
+        parser.add_argument("--once", action="store_true", help="Выполнить готовые задачи и выйти")
+
+    def handle(self, *args, processes=1, threads=1, batch=BATCH_SIZE, poll=1.0, once=False, **options):
+        worker_options = dict(threads=threads, batch_size=batch, poll=poll, once=once)
+        if processes <= 1:
+            stop_event = threading.Event()
+            self.handle_signals(stop_event.set)
+            run_worker(stop_event=stop_event, **worker_options)
+            return
+
+        # Соединения с базой не должны переходить в дочерние процессы
+        connections.close_all()
+        children = [
+            multiprocessing.Process(target=_child, kwargs=worker_options, daemon=False)
+            for _ in range(processes)
+        ]
+        for child in children:
+            child.start()
+        self.handle_signals(lambda: [child.terminate() for child in children if child.is_alive()])
+        for child in children:
+            child.join()
+
+    @staticmethod
+    def handle_signals(callback):
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda *_: callback())
+
+
+def _child(**worker_options):
+    # terminate() от родителя = SIGTERM: доделываем текущую пачку и выходим
+    stop_event = threading.Event()
+    Command.handle_signals(stop_event.set)
+    run_worker(stop_event=stop_event, **worker_options)
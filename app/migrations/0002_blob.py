@@ -0,0 +1,53 @@
+# Generated by Django 5.2.3 on 2026-10-19 17:10
+
+import app.storage
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True, verbose_name='Файл')),
+                ('size', models.PositiveBigIntegerField(default=0, verbose_name='Размер')),
+                ('ref_count', models.IntegerField(db_index=True, default=0, verbose_name='Кол-во ссылок')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата Создания')),
+            ],
+            options={
+                'verbose_name_plural': 'Файлы',
+            },
+        ),
+        migrations.AlterField(
+            model_name='comment',
+            name='post',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='comments', to='app.post', verbose_name='Пост'),
+        ),
+        migrations.AlterField(
+            model_name='dislike',
+            name='post',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='dislikes', to='app.post', verbose_name='Пост'),
+        ),
+        migrations.AlterField(
+            model_name='like',
+            name='post',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='likes', to='app.post', verbose_name='Пост'),
+        ),
+        migrations.AlterField(
+            model_name='media',
+            name='file',
+            field=models.ImageField(blank=True, null=True, storage=app.storage.select_media_storage, upload_to='post-gallery/'),
+        ),
+        migrations.AlterField(
+            model_name='media',
+            name='post',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='media', to='app.post', verbose_name='Пост'),
+        ),
+    ]
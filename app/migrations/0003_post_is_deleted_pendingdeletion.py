@@ -0,0 +1,31 @@
+# Generated by Django 5.2.3 on 2026-10-19 17:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0002_blob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='is_deleted',
+            field=models.BooleanField(db_index=True, default=False, verbose_name='Удален'),
+        ),
+        migrations.CreateModel(
+            name='PendingDeletion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('post', 'Пост'), ('user', 'Пользователь')], max_length=8, verbose_name='Тип')),
+                ('object_id', models.BigIntegerField(verbose_name='ID Объекта')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата Создания')),
+            ],
+            options={
+                'verbose_name_plural': 'Удаления',
+                'unique_together': {('kind', 'object_id')},
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.3 on 2026-10-19 17:18
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0005_task'),
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserStats',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+                ('posts_count', models.IntegerField(default=0, verbose_name='Посты')),
+                ('likes_received', models.IntegerField(default=0, verbose_name='Лайки')),
+                ('dislikes_received', models.IntegerField(default=0, verbose_name='Дизлайки')),
+                ('comments_received', models.IntegerField(default=0, verbose_name='Комментарии')),
+                ('open_reports', models.IntegerField(default=0, verbose_name='Открытые жалобы')),
+            ],
+            options={
+                'verbose_name_plural': 'Статистика Пользователей',
+            },
+        ),
+    ]
@@ -0,0 +1,70 @@
+# Generated by Django 5.2.3 on 2026-10-19 17:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0006_userstats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedComment',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('post_id', models.BigIntegerField(db_index=True, verbose_name='Пост')),
+                ('user_id', models.IntegerField(db_index=True, verbose_name='Пользователь')),
+                ('body', models.CharField(max_length=1024, verbose_name='Содержимое')),
+                ('created_at', models.DateTimeField(verbose_name='Дата Создания')),
+            ],
+            options={
+                'verbose_name_plural': 'Архив Комментариев',
+            },
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='archived_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='В архиве с'),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='archived_comments',
+            field=models.PositiveIntegerField(default=0, verbose_name='Комменты в архиве'),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='archived_dislikes',
+            field=models.PositiveIntegerField(default=0, verbose_name='Дизлайки в архиве'),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='archived_likes',
+            field=models.PositiveIntegerField(default=0, verbose_name='Лайки в архиве'),
+        ),
+        migrations.CreateModel(
+            name='ArchivedDisLike',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('post_id', models.BigIntegerField(verbose_name='Пост')),
+                ('user_id', models.IntegerField(db_index=True, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name_plural': 'Архив Дизлайков',
+                'indexes': [models.Index(fields=['post_id', 'user_id'], name='app_archive_post_id_1ff58d_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedLike',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('post_id', models.BigIntegerField(verbose_name='Пост')),
+                ('user_id', models.IntegerField(db_index=True, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name_plural': 'Архив Лайков',
+                'indexes': [models.Index(fields=['post_id', 'user_id'], name='app_archive_post_id_d9e6c0_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.3 on 2026-10-19 17:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0008_relatedpost'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='related_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Похожие посчитаны'),
+        ),
+    ]
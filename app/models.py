@@ -1,5 +1,16 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
+
+from app.storage import select_media_storage
+
+
+class PostQuerySet(models.QuerySet):
+    def visible(self):
+        """
+        Посты которые не удалены (удаленные скрыты сразу, а чистятся в фоне)
+        """
+        return self.filter(is_deleted=False)
 
 
 # Посты
@@ -13,26 +24,46 @@ class Post(models.Model):
         content: Поле Контента Поста максимально 3000 символов
         created_at: Поле Дата Создания автоматически определяет время создания
         author: Поле Автор привязан к модели Пользователь(User)
+        is_deleted: Пост удален и ждет фоновой очистки связанных данных
+        view_count: Кол-во просмотров, копится в памяти и записывается пачками (см. viewcounts)
+        archived_at: Когда лайки/комменты поста впервые перенесли в архивную базу (см. archive)
+        archived_likes: Сколько лайков лежит в архиве
+        archived_dislikes: Сколько дизлайков лежит в архиве
+        archived_comments: Сколько комментов лежит в архиве
+        related_at: Когда посчитан список похожих (см. related), пустой список тоже считается
     """
     title = models.CharField(max_length=256, verbose_name="Название Поста")
     content = models.CharField(max_length=3000, verbose_name="Контент Поста")
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата Создания")
     author = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name="Автор")
+    is_deleted = models.BooleanField(default=False, db_index=True, verbose_name="Удален")
+    view_count = models.PositiveIntegerField(default=0, verbose_name="Просмотры")
+    archived_at = models.DateTimeField(null=True, blank=True, verbose_name="В архиве с")
+    archived_likes = models.PositiveIntegerField(default=0, verbose_name="Лайки в архиве")
+    archived_dislikes = models.PositiveIntegerField(default=0, verbose_name="Дизлайки в архиве")
+    archived_comments = models.PositiveIntegerField(default=0, verbose_name="Комменты в архиве")
+    related_at = models.DateTimeField(null=True, blank=True, verbose_name="Похожие посчитаны")
+
+    objects = PostQuerySet.as_manager()
 
     def __str__(self):
         return self.title
 
-    # Метод Подсчета Лайков
+    # Метод Подсчета Лайков (вместе с архивными)
     def get_likes_count(self):
-        return self.likes.count()
+        return self.likes.count() + self.archived_likes
 
-    # Метод Подсчета ДизЛайков
+    # Метод Подсчета ДизЛайков (вместе с архивными)
     def get_dislikes_count(self):
-        return self.dislikes.count()
+        return self.dislikes.count() + self.archived_dislikes
 
-    # Метод Подсчета Комментов
+    # Метод Подсчета Комментов (вместе с архивными)
     def get_comments_count(self):
-        return self.comments.count()
+        return self.comments.count() + self.archived_comments
+
+    # Метод Доставания всех комментов: свежие из основной базы + архивные
+    def get_comments(self):
+        return Comment.objects.for_post(self)
 
     # Метод Доставания первого изображения
     def get_first_media(self):
@@ -42,6 +73,25 @@ class Post(models.Model):
         verbose_name_plural = "Посты"
 
 
+class CommentManager(models.Manager):
+    def for_post(self, post):
+        """
+        Все комменты поста: свежие из основной базы и перенесенные в архив (см. archive),
+        по времени написания. У архивных user подставлен так же как у обычных
+        """
+        comments = list(self.filter(post=post).select_related("user").order_by("created_at"))
+        if post.archived_at is None:
+            return comments
+        # После сбоя при переносе строка может оказаться в обеих базах
+        hot_ids = {comment.pk for comment in comments}
+        archived = [comment for comment in ArchivedComment.objects.filter(post_id=post.pk)
+                    if comment.pk not in hot_ids]
+        users = User.objects.in_bulk({comment.user_id for comment in archived})
+        for comment in archived:
+            comment.user = users.get(comment.user_id)
+        return sorted(comments + archived, key=lambda comment: comment.created_at)
+
+
 # Комменты
 class Comment(models.Model):
     """
@@ -58,6 +108,8 @@ class Comment(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name="Пользователь")
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата Создания")
 
+    objects = CommentManager()
+
     def __str__(self):
         return f"{self.post.title}-{self.user.username}"
 
@@ -139,9 +191,229 @@ class Media(models.Model):
     post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name="media", verbose_name="Пост")
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата Создания")
     url = models.URLField(null=True, blank=True, verbose_name="Ссылка")  # tesxt.com
-    file = models.ImageField(upload_to="post-gallery/", null=True, blank=True)  # jpg png jpeg svg webp
+    # Имя файла = хеш содержимого, одинаковые загрузки хранятся один раз (см. Blob)
+    file = models.ImageField(upload_to="post-gallery/", storage=select_media_storage, null=True,
+                             blank=True)  # jpg png jpeg svg webp
 
     class Meta:
         verbose_name_plural = "Медиа"
 
+
+# Статистика пользователя
+class UserStats(models.Model):
+    """
+    Готовые счетчики для профиля, обновляются при каждой записи (см. stats),
+    чтобы профиль не считал агрегаты по самым большим таблицам
+
+    Attributes:
+        user: Пользователь (он же первичный ключ)
+        posts_count: Кол-во постов
+        likes_received: Лайки под постами пользователя
+        dislikes_received: Дизлайки под постами пользователя
+        comments_received: Комментарии под постами пользователя
+        open_reports: Нерешенные жалобы которые подал пользователь
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name="stats",
+                                verbose_name="Пользователь")
+    posts_count = models.IntegerField(default=0, verbose_name="Посты")
+    likes_received = models.IntegerField(default=0, verbose_name="Лайки")
+    dislikes_received = models.IntegerField(default=0, verbose_name="Дизлайки")
+    comments_received = models.IntegerField(default=0, verbose_name="Комментарии")
+    open_reports = models.IntegerField(default=0, verbose_name="Открытые жалобы")
+
+    def __str__(self):
+        return f"{self.user_id}"
+
+    class Meta:
+        verbose_name_plural = "Статистика Пользователей"
+
+
+# Файлы в хранилище
+class Blob(models.Model):
+    """
+    Учет файлов в контентно-адресуемом хранилище, один файл может использоваться
+    несколькими Media, поэтому считаем ссылки и удаляем файл только когда их 0
+
+    Attributes:
+        name: Имя файла в хранилище (post-gallery/ab/ab12...ef.jpg)
+        size: Размер в байтах
+        ref_count: Сколько Media ссылаются на файл
+        created_at: Когда файл загрузили или он потерял последнюю ссылку (от этого считается grace период)
+    """
+    name = models.CharField(max_length=255, unique=True, verbose_name="Файл")
+    size = models.PositiveBigIntegerField(default=0, verbose_name="Размер")
+    ref_count = models.IntegerField(default=0, db_index=True, verbose_name="Кол-во ссылок")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата Создания")
+
+    def __str__(self):
+        return self.name
+
+    class Meta:
+        verbose_name_plural = "Файлы"
+
 # pip install pillow
+
+
+# Отложенное удаление
+class PendingDeletion(models.Model):
+    """
+    Очередь фонового удаления: объект уже скрыт, а его связанные данные
+    (лайки, комменты, жалобы, медиа) удаляются небольшими порциями
+
+    Attributes:
+        kind: Что удаляем - пост или пользователя
+        object_id: pk удаляемого объекта
+        created_at: Когда пользователь нажал удалить
+    """
+    POST = "post"
+    USER = "user"
+    KINDS = (
+        (POST, "Пост"),
+        (USER, "Пользователь"),
+    )
+    kind = models.CharField(max_length=8, choices=KINDS, verbose_name="Тип")
+    object_id = models.BigIntegerField(verbose_name="ID Объекта")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата Создания")
+
+    def __str__(self):
+        return f"{self.kind}-{self.object_id}"
+
+    class Meta:
+        verbose_name_plural = "Удаления"
+        unique_together = [("kind", "object_id")]
+
+
+# Фоновые задачи
+class Task(models.Model):
+    """
+    Очередь фоновых задач прямо в базе, без внешнего брокера (см. taskqueue)
+
+    Attributes:
+        name: Путь к функции задачи (app.purge.purge_post)
+        args: Позиционные аргументы (JSON)
+        kwargs: Именованные аргументы (JSON)
+        status: В очереди / выполняется / провалена
+        dedup_key: Одинаковая задача в очереди может быть только одна
+        attempts: Сколько раз уже пробовали
+        max_attempts: После стольких ошибок задача считается проваленной
+        run_at: Не запускать раньше этого времени (повторы с задержкой)
+        locked_until: Воркер взял задачу до этого времени, потом ее может взять другой
+        claimed_by: Метка пачки воркера который взял задачу
+        last_error: Последняя ошибка
+        created_at: Время постановки в очередь
+    """
+    QUEUED = "queued"
+    RUNNING = "running"
+    FAILED = "failed"
+    STATUSES = (
+        (QUEUED, "В очереди"),
+        (RUNNING, "Выполняется"),
+        (FAILED, "Провалена"),
+    )
+    name = models.CharField(max_length=255, verbose_name="Задача")
+    args = models.JSONField(default=list, blank=True, verbose_name="Аргументы")
+    kwargs = models.JSONField(default=dict, blank=True, verbose_name="Именованные аргументы")
+    status = models.CharField(max_length=16, choices=STATUSES, default=QUEUED, verbose_name="Статус")
+    dedup_key = models.CharField(max_length=255, null=True, blank=True, verbose_name="Ключ дедупликации")
+    attempts = models.PositiveIntegerField(default=0, verbose_name="Попытки")
+    max_attempts = models.PositiveIntegerField(default=5, verbose_name="Максимум попыток")
+    run_at = models.DateTimeField(default=timezone.now, verbose_name="Запустить после")
+    locked_until = models.DateTimeField(null=True, blank=True, verbose_name="Занята до")
+    claimed_by = models.CharField(max_length=64, blank=True, verbose_name="Воркер")
+    last_error = models.TextField(blank=True, verbose_name="Ошибка")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата Создания")
+
+    def __str__(self):
+        return f"{self.name}-{self.status}"
+
+    class Meta:
+        verbose_name_plural = "Задачи"
+        indexes = [
+            models.Index(fields=["status", "run_at"]),
+            models.Index(fields=["claimed_by"]),
+        ]
+        constraints = [
+            # Пока задача ждет в очереди, вторую такую же не ставим
+            models.UniqueConstraint(
+                fields=["dedup_key"], condition=models.Q(status="queued"), name="task_unique_queued_dedup_key"
+            ),
+        ]
+
+
+# Похожие посты
+class RelatedPost(models.Model):
+    """
+    Готовый список похожих постов, считается офлайн (см. related):
+    близость текстов (TF-IDF) + общие лайки
+
+    Attributes:
+        post: Пост для которого список
+        related: Похожий пост
+        score: Насколько похож (0..1)
+        rank: Место в списке, с 0
+    """
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name="related_links", verbose_name="Пост")
+    related = models.ForeignKey(Post, on_delete=models.CASCADE, related_name="+", verbose_name="Похожий пост")
+    score = models.FloatField(verbose_name="Оценка")
+    rank = models.PositiveSmallIntegerField(verbose_name="Место")
+
+    def __str__(self):
+        return f"{self.post_id}-{self.related_id}"
+
+    class Meta:
+        verbose_name_plural = "Похожие Посты"
+        ordering = ["post", "rank"]
+        unique_together = [("post", "rank")]
+
+# Архив (отдельная база DATABASES["archive"], см. archive)
+class ArchivedComment(models.Model):
+    """
+    Коммент старого поста, перенесенный в архивную базу. pk тот же что был у Comment.
+    Связи хранятся просто числами: другая база, внешних ключей на Post/User нет
+
+    Attributes:
+        post_id: pk поста
+        user_id: pk пользователя
+        body: Содержимое Комментария
+        created_at: Время написания комментария
+    """
+    is_archive = True
+
+    id = models.BigIntegerField(primary_key=True)
+    post_id = models.BigIntegerField(db_index=True, verbose_name="Пост")
+    user_id = models.IntegerField(db_index=True, verbose_name="Пользователь")
+    body = models.CharField(max_length=1024, verbose_name="Содержимое")
+    created_at = models.DateTimeField(verbose_name="Дата Создания")
+
+    class Meta:
+        verbose_name_plural = "Архив Комментариев"
+
+
+class ArchivedLike(models.Model):
+    """
+    Лайк старого поста в архивной базе, pk тот же что был у Like
+    """
+    is_archive = True
+
+    id = models.BigIntegerField(primary_key=True)
+    post_id = models.BigIntegerField(verbose_name="Пост")
+    user_id = models.IntegerField(db_index=True, verbose_name="Пользователь")
+
+    class Meta:
+        verbose_name_plural = "Архив Лайков"
+        indexes = [models.Index(fields=["post_id", "user_id"])]
+
+
+class ArchivedDisLike(models.Model):
+    """
+    Дизлайк старого поста в архивной базе, pk тот же что был у DisLike
+    """
+    is_archive = True
+
+    id = models.BigIntegerField(primary_key=True)
+    post_id = models.BigIntegerField(verbose_name="Пост")
+    user_id = models.IntegerField(db_index=True, verbose_name="Пользователь")
+
+    class Meta:
+        verbose_name_plural = "Архив Дизлайков"
+        indexes = [models.Index(fields=["post_id", "user_id"])]
@@ -0,0 +1,346 @@
+import json
+import os
+import re
+import socket
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from functools import lru_cache
+
+from django.conf import settings
+from django.core import signing
+from django.urls import Resolver404, resolve
+
+# Общая папка для всех процессов: управляющий файл и снимки каждого процесса
+ROOT = getattr(settings, "PROFILER_DIR", os.path.join(settings.BASE_DIR, "cache", "profiles"))
+# Интервал между снимками стеков (секунды)
+INTERVAL = getattr(settings, "PROFILER_INTERVAL", 0.005)
+# Дольше стольких секунд профилировать не даем
+MAX_SECONDS = getattr(settings, "PROFILER_MAX_SECONDS", 10 * 60)
+# Сколько секунд действует подписанный X-Profile заголовок
+TOKEN_MAX_AGE = getattr(settings, "PROFILER_TOKEN_MAX_AGE", 60 * 60)
+# Как часто процесс перечитывает управляющий файл (секунды)
+CONTROL_CHECK_INTERVAL = 1.0
+MAX_DEPTH = 128
+
+SALT = "app.profiler"
+HEADER = "HTTP_X_PROFILE"
+CONTROL_FILE = "control.json"
+EXTENSION = ".collapsed"
+
+# Категория по файлу кадра, от самого глубокого кадра к корню
+CATEGORIES = [
+    ("ORM", os.path.join("django", "db", "")),
+    ("template", os.path.join("django", "template", "")),
+]
+VIEW = "view"
+PROFILE_NAME = re.compile(r"^[\w-]{1,64}$")
+
+_PATH_PREFIXES = sorted({os.path.join(path, "") for path in sys.path if path}, key=len, reverse=True)
+
+
+def new_profile_name(prefix):
+    return "%s-%s-%s" % (prefix, time.strftime("%Y%m%d-%H%M%S"), uuid.uuid4().hex[:6])
+
+
+def _write_atomic(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as fh:
+        fh.write(text)
+    os.replace(tmp_path, path)
+
+
+# Управление (вызывается из staff-страницы, действует на все процессы через файл)
+
+def start(seconds):
+    """
+    Включает профилирование всех запросов во всех процессах на seconds секунд
+    :return: Имя профиля
+    """
+    seconds = max(1, min(int(seconds), MAX_SECONDS))
+    name = new_profile_name("run")
+    _write_atomic(os.path.join(ROOT, CONTROL_FILE), json.dumps({"name": name, "until": time.time() + seconds}))
+    return name
+
+
+def stop():
+    try:
+        os.remove(os.path.join(ROOT, CONTROL_FILE))
+    except FileNotFoundError:
+        pass
+
+
+def active_run():
+    """
+    :return: (имя профиля, до какого времени) либо None
+    """
+    try:
+        with open(os.path.join(ROOT, CONTROL_FILE), encoding="utf-8") as fh:
+            control = json.load(fh)
+    except (OSError, ValueError):
+        return None
+    if control.get("until", 0) <= time.time():
+        return None
+    return control["name"], control["until"]
+
+
+def make_token():
+    """
+    Подписанное значение для заголовка X-Profile: профилирует один запрос
+    :return: (токен, имя профиля)
+    """
+    name = new_profile_name("request")
+    return signing.dumps(name, salt=SALT), name
+
+
+def load_token(token):
+    """
+    :return: Имя профиля, None если подпись неверна или устарела
+    """
+    try:
+        name = signing.loads(token, salt=SALT, max_age=TOKEN_MAX_AGE)
+    except signing.BadSignature:
+        return None
+    return name if isinstance(name, str) and PROFILE_NAME.match(name) else None
+
+
+# Сбор
+
+@lru_cache(maxsize=8192)
+def frame_label(code):
+    filename = code.co_filename
+    for prefix in _PATH_PREFIXES:
+        if filename.startswith(prefix):
+            filename = filename[len(prefix):]
+            break
+    return ("%s (%s:%d)" % (code.co_name, filename, code.co_firstlineno)).replace(";", ",")
+
+
+def categorize(codes):
+    """
+    ORM если в стеке есть django/db, иначе template если есть django/template, иначе view
+    :param codes: Объекты кода от корня к листу
+    """
+    for code in reversed(codes):
+        for category, marker in CATEGORIES:
+            if marker in code.co_filename:
+                return category
+    return VIEW
+
+
+class Sampler:
+    """
+    Раз в INTERVAL секунд снимает стеки потоков, которые сейчас обрабатывают
+    профилируемые запросы (sys._current_frames), и копит их в памяти процесса.
+    Пока таких запросов нет - поток спит и ничего не стоит
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._threads = {}  # ident -> (имя профиля, метка запроса)
+        self._stacks = {}  # имя профиля -> Counter еще не записанных стеков
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._process = None
+
+    def begin(self, name, label):
+        with self._lock:
+            self._threads[threading.get_ident()] = (name, label)
+            if self._thread is None or not self._thread.is_alive():  # Нет потока либо процесс форкнули
+                self._process = "%s-%s" % (socket.gethostname(), os.getpid())
+                self._thread = threading.Thread(target=self._loop, name="profiler", daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def end(self):
+        with self._lock:
+            name, _ = self._threads.pop(threading.get_ident())
+        if name.startswith("request-"):  # Профиль одного запроса нужен сразу
+            self.save()
+
+    def sample(self):
+        with self._lock:
+            threads = dict(self._threads)
+        if not threads:
+            return
+        frames = sys._current_frames()
+        collected = []
+        for ident, (name, label) in threads.items():
+            frame = frames.get(ident)
+            codes = []
+            while frame is not None and len(codes) < MAX_DEPTH:
+                codes.append(frame.f_code)
+                frame = frame.f_back
+            codes.reverse()
+            if codes:
+                stack = ";".join([categorize(codes), label] + [frame_label(code) for code in codes])
+                collected.append((name, stack))
+        with self._lock:
+            for name, stack in collected:
+                self._stacks.setdefault(name, Counter())[stack] += 1
+
+    def save(self):
+        """
+        Дописывает накопленные снимки в файл процесса (файлы только растут,
+        при чтении одинаковые стеки складываются), память освобождает
+        """
+        with self._lock:
+            pending, self._stacks = self._stacks, {}
+        for name, stacks in pending.items():
+            directory = os.path.join(ROOT, name)
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, self._process + EXTENSION), "a", encoding="utf-8") as fh:
+                fh.write(collapsed(stacks))
+
+    def _loop(self):
+        last_save = time.monotonic()
+        while True:
+            self._wakeup.wait()
+            with self._lock:
+                idle = not self._threads
+                if idle:
+                    self._wakeup.clear()
+            if idle:
+                self.save()
+                continue
+            self.sample()
+            if time.monotonic() - last_save > 1:
+                self.save()
+                last_save = time.monotonic()
+            time.sleep(INTERVAL)
+
+
+sampler = Sampler()
+
+
+class ProfilerMiddleware:
+    """
+    Включает сэмплирование для запроса, если запущен профиль на N секунд
+    (управляющий файл, проверяется не чаще раза в секунду) или пришел
+    подписанный заголовок X-Profile. Иначе стоит одну проверку времени
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self._checked_at = 0
+        self._run = None
+
+    def __call__(self, request):
+        name = self._profile_name(request)
+        if name is None:
+            return self.get_response(request)
+        sampler.begin(name, request_label(request))
+        try:
+            response = self.get_response(request)
+        finally:
+            sampler.end()
+        response["X-Profile-Name"] = name
+        return response
+
+    def _profile_name(self, request):
+        token = request.META.get(HEADER)
+        if token:
+            return load_token(token)
+        now = time.monotonic()
+        if now - self._checked_at > CONTROL_CHECK_INTERVAL:
+            self._checked_at = now
+            self._run = active_run()
+        if self._run is not None and self._run[1] > time.time():
+            return self._run[0]
+        return None
+
+
+def request_label(request):
+    """
+    "GET posts/<int:pk>": по шаблону маршрута, чтобы все посты попали в одну ветку
+    """
+    try:
+        path = resolve(request.path_info).route or request.path_info
+    except Resolver404:
+        path = request.path_info
+    return ("%s %s" % (request.method, path)).replace(";", ",")
+
+
+# Чтение (агрегация по всем процессам)
+
+def profile_names():
+    """
+    :return: Список имен профилей, новые первыми
+    """
+    if not os.path.isdir(ROOT):
+        return []
+    names = [name for name in os.listdir(ROOT) if os.path.isdir(os.path.join(ROOT, name))]
+    return sorted(names, key=lambda name: os.path.getmtime(os.path.join(ROOT, name)), reverse=True)
+
+
+def load(name):
+    """
+    Складывает снимки всех процессов
+    :return: Counter {свернутый стек: кол-во снимков}
+    """
+    stacks = Counter()
+    directory = os.path.join(ROOT, name)
+    if not PROFILE_NAME.match(name) or not os.path.isdir(directory):
+        return stacks
+    for filename in os.listdir(directory):
+        if not filename.endswith(EXTENSION):
+            continue
+        with open(os.path.join(directory, filename), encoding="utf-8") as fh:
+            for line in fh:
+                stack, _, count = line.rstrip("\n").rpartition(" ")
+                if stack and count.isdigit():
+                    stacks[stack] += int(count)
+    return stacks
+
+
+def delete(name):
+    directory = os.path.join(ROOT, name)
+    if not PROFILE_NAME.match(name) or not os.path.isdir(directory):
+        return
+    for filename in os.listdir(directory):
+        os.remove(os.path.join(directory, filename))
+    os.rmdir(directory)
+
+
+def collapsed(stacks):
+    """
+    Формат для flamegraph.pl / speedscope: "кадр;кадр;кадр кол-во"
+    """
+    return "".join("%s %d\n" % (stack, count) for stack, count in sorted(stacks.items()))
+
+
+def category_totals(stacks):
+    """
+    :return: {категория: (кол-во снимков, доля в %)}
+    """
+    totals = Counter()
+    for stack, count in stacks.items():
+        totals[stack.split(";", 1)[0]] += count
+    overall = sum(totals.values()) or 1
+    return {
+        category: (totals[category], round(totals[category] * 100 / overall, 1))
+        for category in ("ORM", "template", VIEW)
+    }
+
+
+def tree(stacks):
+    """
+    Дерево для flame graph: {"name", "value", "children": [...]}
+    """
+    root = {"name": "all", "value": 0, "children": {}}
+    for stack, count in stacks.items():
+        root["value"] += count
+        node = root
+        for frame in stack.split(";"):
+            node = node["children"].setdefault(frame, {"name": frame, "value": 0, "children": {}})
+            node["value"] += count
+
+    def freeze(node):
+        children = sorted(node["children"].values(), key=lambda child: -child["value"])
+        return {"name": node["name"], "value": node["value"], "children": [freeze(child) for child in children]}
+
+    return freeze(root)
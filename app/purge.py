@@ -0,0 +1,174 @@
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+
+from app.archive import delete_archived_post, unarchive_user
+from app.blobs import release_blobs
+from app.feeds import schedule_author_changed, schedule_post_changed
+from app.models import Comment, DisLike, Like, Media, PendingDeletion, Post, RelatedPost, Report
+from app.stats import rebuild_user_stats
+from app.taskqueue import task
+
+# Сколько строк удаляем за одну транзакцию, запись в SQLite блокируется только на это время
+CHUNK_SIZE = getattr(settings, "PURGE_CHUNK_SIZE", 500)
+# Пауза между порциями, чтобы запросы пользователей успевали писать
+CHUNK_PAUSE = getattr(settings, "PURGE_CHUNK_PAUSE", 0.05)
+
+# Что удаляем вместе с постом / пользователем (модель, поле)
+POST_CHILDREN = [(Like, "post"), (DisLike, "post"), (Comment, "post"), (Report, "post"),
+                 (RelatedPost, "post"), (RelatedPost, "related")]
+USER_CHILDREN = [(Like, "user"), (DisLike, "user"), (Comment, "user"), (Report, "user")]
+
+
+def schedule_post_deletion(post):
+    """
+    Сразу скрывает пост, а связанные данные удаляет в фоне
+    :param post: Моделька Post
+    """
+    with transaction.atomic():
+        Post.objects.filter(pk=post.pk).update(is_deleted=True)
+        PendingDeletion.objects.get_or_create(kind=PendingDeletion.POST, object_id=post.pk)
+        purge_post.enqueue(post.pk, dedup_key="purge-post:%s" % post.pk)
+        # Скрытый пост и его лайки/комменты больше не входят в статистику автора
+        rebuild_user_stats.enqueue(post.author_id, dedup_key="user-stats:%s" % post.author_id)
+        schedule_post_changed(post.pk, post.author_id)
+    post.is_deleted = True
+
+
+def schedule_user_deletion(user):
+    """
+    Сразу блокирует пользователя и скрывает его посты, остальное удаляется в фоне
+    :param user: Моделька User
+    """
+    with transaction.atomic():
+        User.objects.filter(pk=user.pk).update(is_active=False)
+        Post.objects.filter(author_id=user.pk).update(is_deleted=True)
+        PendingDeletion.objects.get_or_create(kind=PendingDeletion.USER, object_id=user.pk)
+        purge_user.enqueue(user.pk, dedup_key="purge-user:%s" % user.pk)
+        schedule_author_changed(user.pk)
+    user.is_active = False
+
+
+@task
+def purge_post(post_id):
+    """
+    Удаляет пост и все что с ним связано порциями по CHUNK_SIZE строк
+    :param post_id: pk поста
+    """
+    # Жалобы удаляются мимо сигналов - open_reports их авторов пересчитаем после удаления
+    reporters = set(Report.objects.filter(post_id=post_id).values_list("user_id", flat=True).distinct())
+    for model, field in POST_CHILDREN:
+        delete_in_chunks(model, field, post_id)
+    delete_archived_post(post_id)
+    purge_media(post_id)
+    # Связанных строк уже нет, обычное удаление ничего тяжелого не соберет
+    with transaction.atomic():
+        for user_id in reporters:
+            rebuild_user_stats.enqueue(user_id, dedup_key="user-stats:%s" % user_id)
+        Post.objects.filter(pk=post_id).delete()
+        PendingDeletion.objects.filter(kind=PendingDeletion.POST, object_id=post_id).delete()
+
+
+@task
+def purge_user(user_id):
+    """
+    Удаляет пользователя: его посты, его лайки/комменты/жалобы под чужими постами
+    :param user_id: pk пользователя
+    """
+    post_ids = list(Post.objects.filter(author_id=user_id).values_list("pk", flat=True))
+    for post_id in post_ids:
+        purge_post(post_id)
+    # Архивные лайки/комменты пользователя удаляем вместе со свежими
+    unarchive_user(user_id)
+    # Чьи посты пользователь лайкал/комментировал - им нужно пересчитать статистику
+    authors = set()
+    for model, field in USER_CHILDREN:
+        if model is not Report:
+            authors.update(
+                model.objects.filter(**{field: user_id}).values_list("post__author_id", flat=True).distinct()
+            )
+        delete_in_chunks(model, field, user_id)
+    with transaction.atomic():
+        for author_id in authors - {user_id}:
+            rebuild_user_stats.enqueue(author_id, dedup_key="user-stats:%s" % author_id)
+        User.objects.filter(pk=user_id).delete()
+        PendingDeletion.objects.filter(kind=PendingDeletion.USER, object_id=user_id).delete()
+
+
+def purge_pending():
+    """
+    Доделывает все удаления из очереди (после перезапуска или падения)
+    :return: Сколько объектов удалено
+    """
+    done = 0
+    for kind, object_id in list(PendingDeletion.objects.order_by("pk").values_list("kind", "object_id")):
+        if kind == PendingDeletion.POST:
+            purge_post(object_id)
+        else:
+            purge_user(object_id)
+        done += 1
+    return done
+
+
+def delete_in_chunks(model, field, value):
+    """
+    Удаляет строки одним DELETE на порцию, без загрузки объектов в память
+    и без каскадного сборщика Django
+    :param model: Моделька
+    :param field: Поле внешнего ключа
+    :param value: Значение внешнего ключа
+    :return: Сколько строк удалено
+    """
+    quote = connection.ops.quote_name
+    table = quote(model._meta.db_table)
+    pk = quote(model._meta.pk.column)
+    column = quote(model._meta.get_field(field).column)
+    sql = (
+        f"DELETE FROM {table} WHERE {pk} IN "
+        f"(SELECT {pk} FROM {table} WHERE {column} = %s LIMIT %s)"
+    )
+    total = 0
+    while True:
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(sql, [value, CHUNK_SIZE])
+                deleted = cursor.rowcount
+        total += deleted
+        if deleted < CHUNK_SIZE:
+            return total
+        time.sleep(CHUNK_PAUSE)
+
+
+def delete_ids(model, ids):
+    """
+    DELETE по списку pk одним запросом
+    """
+    quote = connection.ops.quote_name
+    placeholders = ", ".join(["%s"] * len(ids))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"DELETE FROM {quote(model._meta.db_table)} WHERE {quote(model._meta.pk.column)} IN ({placeholders})",
+            ids,
+        )
+
+
+def purge_media(post_id):
+    """
+    Удаляет медиа поста порциями. Файлы без ссылок удаляет gc_media после grace периода:
+    параллельная загрузка того же содержимого может уже ссылаться на файл, но еще не сохранить Media
+    :param post_id: pk поста
+    """
+    while True:
+        with transaction.atomic():
+            rows = list(Media.objects.filter(post_id=post_id).values_list("pk", "file")[:CHUNK_SIZE])
+            if not rows:
+                return
+            delete_ids(Media, [pk for pk, _ in rows])
+            # Сигналы Media при таком удалении не срабатывают - отпускаем ссылки сами
+            names = [name for _, name in rows if name]
+            release_blobs(names)
+        if len(rows) < CHUNK_SIZE:
+            return
+        time.sleep(CHUNK_PAUSE)
@@ -0,0 +1,191 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+
+# Правила: имя маршрута -> (лимит, по кому считаем)
+# Лимит "30/m" - 30 запросов в минуту с возможностью сделать их все сразу
+# По кому: "user" - по сессионной куке (без запроса в базу), пока кука не проверена - по адресу,
+# "ip" - по адресу
+RULES = getattr(settings, "RATE_LIMITS", {})
+METHODS = getattr(settings, "RATE_LIMIT_METHODS", ("POST",))
+# Алиас из CACHES чтобы лимит был общий для всех процессов, None - память процесса
+CACHE_ALIAS = getattr(settings, "RATE_LIMIT_CACHE", None)
+# Брать адрес клиента из X-Forwarded-For (только если перед нами свой прокси)
+TRUST_FORWARDED = getattr(settings, "RATE_LIMIT_TRUST_FORWARDED", False)
+# Больше стольких ключей в памяти не держим
+MAX_KEYS = getattr(settings, "RATE_LIMIT_MAX_KEYS", 100_000)
+
+PERIODS = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60}
+
+
+def parse_rate(rate):
+    """
+    "30/m" -> (30, 0.5): размер ведра и сколько жетонов добавляется в секунду
+    """
+    count, period = rate.split("/")
+    count = int(count)
+    return count, count / PERIODS[period.strip().lower()[0]]
+
+
+class LocalBucketStore:
+    """
+    Ведра в памяти процесса: ключ -> (жетоны, время последнего обновления)
+    """
+
+    def __init__(self, max_keys=MAX_KEYS):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._max_keys = max_keys
+
+    def take(self, key, capacity, refill, now):
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * refill)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            if key not in self._buckets and len(self._buckets) >= self._max_keys:
+                self._prune(now)
+            self._buckets[key] = (tokens, now)
+        return allowed, tokens
+
+    def _prune(self, now):
+        # Убираем давно не трогавшиеся ведра, если таких нет - самые старые
+        cutoff = now - 60 * 60
+        stale = [key for key, (_, updated) in self._buckets.items() if updated < cutoff]
+        if not stale:
+            stale = sorted(self._buckets, key=lambda key: self._buckets[key][1])[:len(self._buckets) // 10 + 1]
+        for key in stale:
+            del self._buckets[key]
+
+
+class CacheBucketStore:
+    """
+    Ведра в кеше Django (memcached/redis), общие для всех процессов.
+    get/set не атомарны: при гонке пара лишних запросов может пройти
+    """
+
+    def __init__(self, alias):
+        self._cache = caches[alias]
+
+    def take(self, key, capacity, refill, now):
+        cache_key = "rl:" + key
+        tokens, updated = self._cache.get(cache_key) or (capacity, now)
+        tokens = min(capacity, tokens + (now - updated) * refill)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        # Ведро которое успело наполниться хранить незачем
+        self._cache.set(cache_key, (tokens, now), timeout=int(capacity / refill) + 1)
+        return allowed, tokens
+
+
+class TokenBucketLimiter:
+    def __init__(self, store=None):
+        self.store = store or (CacheBucketStore(CACHE_ALIAS) if CACHE_ALIAS else LocalBucketStore())
+        self._rates = {}
+
+    def allow(self, key, rate):
+        """
+        Забирает жетон из ведра
+        :param key: Ключ ведра (маршрут + клиент)
+        :param rate: Лимит вида "30/m"
+        :return: (разрешено ли, через сколько секунд появится жетон)
+        """
+        parsed = self._rates.get(rate)
+        if parsed is None:
+            parsed = self._rates[rate] = parse_rate(rate)
+        capacity, refill = parsed
+        allowed, tokens = self.store.take(key, capacity, refill, time.time())
+        if allowed:
+            return True, 0
+        return False, (1 - tokens) / refill
+
+
+def client_ip(request):
+    if TRUST_FORWARDED:
+        forwarded = request.META.get("HTTP_X_FORWARDED_FOR")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.META.get("REMOTE_ADDR", "")
+
+
+class SessionRegistry:
+    """
+    Сессионные куки, с которыми этот процесс уже видел залогиненного пользователя.
+    Выдуманной куке верить нельзя: новая случайная кука на каждый запрос - новое ведро
+    """
+
+    def __init__(self, max_keys=MAX_KEYS):
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._max_keys = max_keys
+
+    def __contains__(self, session):
+        return session in self._sessions
+
+    def add(self, session):
+        if session in self._sessions:
+            return
+        with self._lock:
+            if len(self._sessions) >= self._max_keys:
+                # Словарь помнит порядок добавления: забываем самые старые
+                for old in list(self._sessions)[:self._max_keys // 10 + 1]:
+                    del self._sessions[old]
+            self._sessions[session] = True
+
+
+def client_key(request, scope, sessions):
+    """
+    Кому принадлежит ведро. Пользователя определяем по сессионной куке,
+    а не через request.user, чтобы не ходить в базу. Кука которую еще
+    не видели с залогиненным пользователем считается по адресу
+    """
+    if scope == "user":
+        session = request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+        if session and session in sessions:
+            return "s:" + session
+    return "ip:" + client_ip(request)
+
+
+class RateLimitMiddleware:
+    """
+    Отсекает частые запросы к маршрутам из RATE_LIMITS до авторизации,
+    get_object_or_404 и транзакций. Должна стоять до CsrfViewMiddleware,
+    которая читает тело запроса
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.limiter = TokenBucketLimiter()
+        self.sessions = SessionRegistry()
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        # Пользователя уже достали из базы по куке (сам запрос в базу не делаем) - куке можно верить
+        user = request.__dict__.get("_cached_user")
+        session = request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+        if session and user is not None and user.is_authenticated:
+            self.sessions.add(session)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.method not in METHODS:
+            return None
+        name = request.resolver_match.url_name if request.resolver_match else None
+        rule = RULES.get(name)
+        if rule is None:
+            return None
+        rate, scope = rule
+        key = "%s:%s" % (name, client_key(request, scope, self.sessions))
+        allowed, retry_after = self.limiter.allow(key, rate)
+        if allowed:
+            return None
+        response = HttpResponse(
+            "Слишком много запросов, попробуйте позже", status=429, content_type="text/plain; charset=utf-8"
+        )
+        response["Retry-After"] = str(int(retry_after) + 1)
+        return response
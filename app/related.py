@@ -0,0 +1,354 @@
+import logging
+import os
+import re
+import tempfile
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.utils import timezone
+
+from app.models import ArchivedLike, Like, Post, RelatedPost
+from app.taskqueue import task
+
+try:
+    import numpy as np  # pip install numpy scipy (нужны только для расчета)
+    from scipy import sparse
+except ImportError:
+    np = sparse = None
+
+logger = logging.getLogger(__name__)
+
+# Сколько похожих постов храним для каждого поста
+COUNT = getattr(settings, "RELATED_POSTS_COUNT", 5)
+# Вклад близости текстов и общих лайков в итоговую оценку
+TEXT_WEIGHT = getattr(settings, "RELATED_TEXT_WEIGHT", 0.7)
+LIKES_WEIGHT = getattr(settings, "RELATED_LIKES_WEIGHT", 0.3)
+# Слово из названия весит как столько же слов из текста
+TITLE_WEIGHT = 3
+# Слова которые есть больше чем в такой доле постов ничего не различают
+MAX_DF = 0.5
+# Матрица оценок считается блоками по столько ячеек (float32: 4 млн = 16 МБ)
+BLOCK_CELLS = getattr(settings, "RELATED_BLOCK_CELLS", 4_000_000)
+# Пачка новых постов подряд пересчитывается одной задачей
+DELAY = getattr(settings, "RELATED_DELAY", 60)
+# Словарь, idf и векторы последнего полного пересчета (см. build_related)
+VECTORS_PATH = getattr(settings, "RELATED_VECTORS_PATH", os.path.join(settings.BASE_DIR, "cache", "related.npz"))
+# Раз в столько секунд новые слова и правки постов попадают в векторы полным пересчетом
+REBUILD_INTERVAL = getattr(settings, "RELATED_REBUILD_INTERVAL", 24 * 60 * 60)
+
+TOKEN = re.compile(r"\w{2,}")
+
+
+def term_counts(rows, vocabulary, grow=True):
+    """
+    Сублинейные частоты слов постов
+    :param rows: (название, текст) в порядке индексов постов
+    :param vocabulary: {слово: столбец}, дополняется новыми словами
+    :param grow: False - слова которых нет в vocabulary пропускаем
+    :return: csr_matrix посты x слова
+    """
+    indptr, indices, data = [0], [], []
+    for title, content in rows:
+        counts = Counter(TOKEN.findall(title.lower()))
+        for term in counts:
+            counts[term] *= TITLE_WEIGHT
+        counts.update(TOKEN.findall(content.lower()))
+        for term, count in counts.items():
+            column = vocabulary.get(term)
+            if column is None:
+                if not grow:
+                    continue
+                column = vocabulary[term] = len(vocabulary)
+            indices.append(column)
+            data.append(count)
+        indptr.append(len(indices))
+    matrix = sparse.csr_matrix(
+        (np.asarray(data, dtype=np.float32), np.asarray(indices, dtype=np.int32), np.asarray(indptr, dtype=np.int64)),
+        shape=(len(indptr) - 1, len(vocabulary)),
+    )
+    matrix.data = 1 + np.log(matrix.data)  # Сублинейный tf: 10 повторов не в 10 раз важнее
+    return matrix
+
+
+def text_vectors(rows):
+    """
+    TF-IDF векторы постов, нормированные по длине: скалярное произведение = косинус
+    :param rows: (название, текст) в порядке индексов постов
+    :return: (csr_matrix посты x слова, {слово: столбец}, idf по столбцам)
+    """
+    vocabulary = {}
+    matrix = term_counts(rows, vocabulary)
+    n = matrix.shape[0]
+    df = np.bincount(matrix.indices, minlength=matrix.shape[1])
+    idf = (np.log((1 + n) / (1 + df)) + 1).astype(np.float32)
+    if n >= 10:
+        idf[df > MAX_DF * n] = 0
+    return weigh(matrix, idf), vocabulary, idf
+
+
+def weigh(matrix, idf):
+    matrix.data *= idf[matrix.indices]
+    matrix.eliminate_zeros()
+    return normalize_rows(matrix)
+
+
+def like_matrix(pairs, index):
+    """
+    Посты x пользователи, 1 если пользователь лайкнул пост
+    :param pairs: (pk поста, pk пользователя), посты не из index пропускаем
+    :param index: {pk поста: номер строки}
+    """
+    posts, users = [], []
+    user_index = {}
+    for post_id, user_id in pairs:
+        row = index.get(post_id)
+        if row is not None:
+            posts.append(row)
+            users.append(user_index.setdefault(user_id, len(user_index)))
+    matrix = sparse.csr_matrix(
+        (np.ones(len(posts), dtype=np.float32), (np.asarray(posts, dtype=np.int32), np.asarray(users, dtype=np.int32))),
+        shape=(len(index), max(len(user_index), 1)),
+    )
+    matrix.data[:] = 1  # Повторы одной пары (лайк и в основной базе, и в архиве) считаем один раз
+    return matrix
+
+
+def like_vectors(index):
+    """
+    Векторы постов по лайкнувшим пользователям (включая лайки в архиве)
+    :param index: {pk поста: номер строки}
+    :return: (csr_matrix посты x пользователи с нормированными строками, кол-во лайкнувших по строкам)
+    """
+    pairs = (
+        pair
+        for queryset in (Like.objects.all(), ArchivedLike.objects.all())
+        for pair in queryset.values_list("post_id", "user_id").iterator(chunk_size=10_000)
+    )
+    matrix = like_matrix(pairs, index)
+    likers = np.diff(matrix.indptr).astype(np.float32)
+    return scale_rows(matrix, likers), likers
+
+
+def target_like_vectors(index, target_pks, likers):
+    """
+    Как like_vectors, но читает только лайки пользователей, лайкнувших target_pks: оценки
+    целевых постов с остальными от этого не меняются. Строки остальных постов неполные,
+    их нормы берем из likers (посчитаны при прошлом расчете)
+    :param likers: Кол-во лайкнувших по строкам index, для целевых пересчитывается
+    :return: (csr_matrix посты x пользователи, обновленные likers)
+    """
+    users = set()
+    for model in (Like, ArchivedLike):
+        for chunk in chunks(target_pks):
+            users.update(model.objects.filter(post_id__in=chunk).values_list("user_id", flat=True))
+    users = sorted(users)
+    pairs = (
+        pair
+        for model in (Like, ArchivedLike)
+        for chunk in chunks(users)
+        for pair in model.objects.filter(user_id__in=chunk).values_list("post_id", "user_id").iterator()
+    )
+    matrix = like_matrix(pairs, index)
+    # Все лайкнувшие целевые посты прочитаны, для них счет точный
+    counts = np.diff(matrix.indptr).astype(np.float32)
+    likers = np.maximum(likers, counts)
+    rows = [index[pk] for pk in target_pks]
+    likers[rows] = counts[rows]
+    return scale_rows(matrix, likers), likers
+
+
+def chunks(values, size=500):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def normalize_rows(matrix):
+    return scale_rows(matrix, np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+
+
+def scale_rows(matrix, squared_norms):
+    norms = np.sqrt(squared_norms)
+    norms[norms == 0] = 1
+    return (sparse.diags((1 / norms).astype(np.float32)) @ matrix).tocsr()
+
+
+def top_related(text, likes, rows, count=COUNT):
+    """
+    Лучшие count похожих для строк rows, блоками чтобы не строить матрицу N x N целиком
+    :return: Итератор (строка, [(строка похожего, оценка), ...])
+    """
+    n = text.shape[0]
+    text_t = text.T.tocsr()
+    likes_t = likes.T.tocsr()
+    block = max(1, BLOCK_CELLS // max(n, 1))
+    for start in range(0, len(rows), block):
+        block_rows = rows[start:start + block]
+        scores = (text[block_rows] @ text_t) * TEXT_WEIGHT + (likes[block_rows] @ likes_t) * LIKES_WEIGHT
+        scores = scores.toarray()
+        scores[np.arange(len(block_rows)), block_rows] = 0  # Сам себе не похожий
+        k = min(count, n - 1)
+        if k <= 0:
+            for row in block_rows:
+                yield row, []
+            continue
+        best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        best_scores = np.take_along_axis(scores, best, axis=1)
+        order = np.argsort(-best_scores, axis=1)
+        best = np.take_along_axis(best, order, axis=1)
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        for i, row in enumerate(block_rows):
+            yield row, [(int(other), float(score)) for other, score in zip(best[i], best_scores[i]) if score > 0]
+
+
+@task
+def build_related(new_only=False, count=COUNT):
+    """
+    Пересчитывает похожие посты. Полный пересчет сохраняет словарь, idf и векторы в VECTORS_PATH,
+    новые посты считаются по ним без перечитывания всех текстов и лайков. Слова, которых не было
+    при полном пересчете, в новых постах не учитываются, поэтому раз в REBUILD_INTERVAL
+    полный пересчет ставится в очередь сам
+    :param new_only: Только для постов у которых списка еще нет (новые)
+    :return: Для скольких постов посчитано
+    """
+    if sparse is None:
+        raise ImproperlyConfigured("Для похожих постов нужны numpy и scipy: pip install numpy scipy")
+    vectors = load_vectors() if new_only else None
+    if vectors is None:
+        return build_all(new_only, count)
+    if time.time() - vectors["built_at"] > REBUILD_INTERVAL:
+        build_related.enqueue(dedup_key="related:all")
+    return build_new(vectors, count)
+
+
+def build_all(new_only, count):
+    """
+    Векторы всех видимых постов с нуля
+    :param new_only: Списки только для постов без отметки related_at
+    """
+    pks, texts = [], []
+    for pk, title, content in Post.objects.visible().order_by("pk").values_list("pk", "title", "content").iterator():
+        pks.append(pk)
+        texts.append((title, content))
+    if not pks:
+        return 0
+    index = {pk: row for row, pk in enumerate(pks)}
+    text, vocabulary, idf = text_vectors(texts)
+    likes, likers = like_vectors(index)
+    save_vectors(pks, text, vocabulary, idf, likers)
+    if new_only:
+        targets = Post.objects.visible().filter(related_at__isnull=True).values_list("pk", flat=True)
+        rows = sorted(index[pk] for pk in targets if pk in index)
+    else:
+        rows = range(len(pks))
+    return write_related(pks, text, likes, np.asarray(rows, dtype=np.int64), count)
+
+
+def build_new(vectors, count):
+    """
+    Списки для постов без отметки related_at: новые векторизуются по сохраненному словарю и idf,
+    сравниваются с сохраненными векторами, лайки читаются только их пользователей
+    """
+    targets = list(
+        Post.objects.visible().filter(related_at__isnull=True).order_by("pk").values_list("pk", "title", "content")
+    )
+    if not targets:
+        return 0
+    visible = set(Post.objects.visible().values_list("pk", flat=True))
+    known = vectors["pks"].tolist()
+    keep = [row for row, pk in enumerate(known) if pk in visible]  # Удаленные после пересчета выкидываем
+    known = set(known)
+    fresh = [(pk, title, content) for pk, title, content in targets if pk not in known]
+    vocabulary = {term: column for column, term in enumerate(vectors["terms"].tolist())}
+    fresh_text = weigh(term_counts([(title, content) for _, title, content in fresh], vocabulary, grow=False),
+                       vectors["idf"])
+    text = sparse.vstack([vectors["text"][keep], fresh_text], format="csr")
+    pks = vectors["pks"][keep].tolist() + [pk for pk, _, _ in fresh]
+    index = {pk: row for row, pk in enumerate(pks)}
+    target_pks = [pk for pk, _, _ in targets]
+    likers = np.concatenate([vectors["likers"][keep], np.zeros(len(fresh), dtype=np.float32)])
+    likes, likers = target_like_vectors(index, target_pks, likers)
+    # Новые посты тоже попадают в сохраненные векторы: следующая пачка найдет их в похожих
+    save_vectors(pks, text, vocabulary, vectors["idf"], likers, built_at=vectors["built_at"])
+    rows = np.asarray([index[pk] for pk in target_pks], dtype=np.int64)
+    return write_related(pks, text, likes, rows, count)
+
+
+def write_related(pks, text, likes, rows, count):
+    """
+    Считает и записывает списки похожих для строк rows
+    :return: Для скольких постов посчитано
+    """
+    if not len(rows):
+        return 0
+    batch, batch_posts = [], []
+    for row, related in top_related(text, likes, rows, count):
+        batch_posts.append(pks[row])
+        batch.extend(
+            RelatedPost(post_id=pks[row], related_id=pks[other], score=score, rank=rank)
+            for rank, (other, score) in enumerate(related)
+        )
+        if len(batch_posts) >= 500:
+            save(batch_posts, batch)
+            batch, batch_posts = [], []
+    save(batch_posts, batch)
+    logger.info("Похожие посты посчитаны для %d постов", len(rows))
+    return len(rows)
+
+
+def save(post_ids, links):
+    if not post_ids:
+        return
+    with transaction.atomic():
+        RelatedPost.objects.filter(post_id__in=post_ids).delete()
+        RelatedPost.objects.bulk_create(links)
+        # Отметка и для пустых списков, иначе такие посты пересчитывались бы каждым запуском
+        Post.objects.filter(pk__in=post_ids).update(related_at=timezone.now())
+
+
+def save_vectors(pks, text, vocabulary, idf, likers, built_at=None):
+    """
+    Сохраняет векторы для следующих расчетов новых постов (через временный файл,
+    читатели не увидят недописанный)
+    :param built_at: Время полного пересчета, по умолчанию сейчас
+    """
+    os.makedirs(os.path.dirname(VECTORS_PATH), exist_ok=True)
+    terms = sorted(vocabulary, key=vocabulary.get)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(VECTORS_PATH), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(
+                f, pks=np.asarray(pks, dtype=np.int64), terms=np.asarray(terms, dtype=str), idf=idf, likers=likers,
+                data=text.data, indices=text.indices, indptr=text.indptr, shape=np.asarray(text.shape),
+                built_at=np.float64(time.time() if built_at is None else built_at),
+            )
+        os.replace(tmp_path, VECTORS_PATH)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def load_vectors():
+    """
+    :return: Сохраненные векторы (dict) или None если полного пересчета еще не было
+    """
+    try:
+        with np.load(VECTORS_PATH) as f:
+            vectors = {name: f[name] for name in f.files}
+    except (OSError, ValueError):
+        return None
+    vectors["text"] = sparse.csr_matrix(
+        (vectors.pop("data"), vectors.pop("indices"), vectors.pop("indptr")), shape=tuple(vectors.pop("shape"))
+    )
+    vectors["built_at"] = float(vectors["built_at"])
+    return vectors
+
+
+def schedule_new_post():
+    """
+    Новый пост получит список похожих через DELAY секунд, пачка постов - одной задачей
+    """
+    if sparse is not None:
+        build_related.enqueue(new_only=True, dedup_key="related:new", delay=DELAY)
@@ -0,0 +1,217 @@
+import mimetypes
+import os
+import re
+from email.utils import formatdate
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import parse_http_date_safe
+
+# Имя блоба ContentAddressedStorage: post-gallery/9f/9f86d081...e4.jpg (sha256, подпапка - первые 2 символа)
+BLOB_NAME_RE = re.compile(r"^(?:.+/)?([0-9a-f]{2})/\1[0-9a-f]{62}\.[a-z0-9]+$")
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+# Предсжатые варианты в порядке предпочтения: (Content-Encoding, расширение)
+PRECOMPRESSED = (("br", ".br"), ("gzip", ".gz"))
+
+CHUNK_SIZE = 64 * 1024
+
+# Режим раздачи: "django" - сами стримим файл,
+# "sendfile" - X-Sendfile (Apache/lighttpd), "accel" - X-Accel-Redirect (nginx)
+SERVE_MODE = getattr(settings, "FILE_SERVE_MODE", "django")
+# Для X-Accel-Redirect у каждой корневой папки свой internal location в nginx
+MEDIA_ACCEL_PREFIX = getattr(settings, "FILE_ACCEL_MEDIA_PREFIX", "/protected/media/")
+STATIC_ACCEL_PREFIX = getattr(settings, "FILE_ACCEL_STATIC_PREFIX", "/protected/static/")
+IMMUTABLE_MAX_AGE = getattr(settings, "FILE_IMMUTABLE_MAX_AGE", 365 * 24 * 60 * 60)
+DEFAULT_MAX_AGE = getattr(settings, "FILE_DEFAULT_MAX_AGE", 60)
+
+
+def make_etag(stat):
+    """
+    Сильный ETag из метаданных файла, сам файл не читаем
+    :param stat: Результат os.stat
+    :return: ETag в кавычках
+    """
+    return '"%x-%x-%x"' % (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def is_blob_name(name):
+    """
+    Имя дал ContentAddressedStorage (sha256 содержимого): файл под ним никогда не меняется
+    """
+    return bool(BLOB_NAME_RE.match(name))
+
+
+_manifest_names = (None, frozenset())
+
+
+def is_manifest_name(name):
+    """
+    Имя с хешем из манифеста collectstatic (css/style.3f2a9c1b7e4d.css): файл под ним никогда не меняется.
+    Похожее на хеш имя, которого нет в манифесте, не подходит
+    """
+    global _manifest_names
+    hashed_files = getattr(staticfiles_storage, "hashed_files", None) or {}
+    if _manifest_names[0] is not hashed_files:  # Манифест перечитали
+        _manifest_names = (hashed_files, frozenset(hashed_files.values()))
+    return name in _manifest_names[1]
+
+
+def parse_range(header, size):
+    """
+    Разбирает заголовок Range, поддерживается только один диапазон
+    :param header: Значение заголовка Range
+    :param size: Размер файла
+    :return: (start, end) включительно, None если заголовок нужно игнорировать,
+             False если диапазон невыполним
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match:
+        return None  # Несколько диапазонов или мусор - отдаем весь файл
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:  # bytes=-500 - последние 500 байт
+        length = int(last)
+        if length == 0:
+            return False
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def _range_iterator(path, start, length):
+    with open(path, "rb") as fh:
+        fh.seek(start)
+        while length > 0:
+            chunk = fh.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def _pick_precompressed(request, path):
+    """
+    Ищет рядом с файлом .br/.gz вариант, который принимает клиент
+    :return: (путь, Content-Encoding) либо (path, None)
+    """
+    accept = request.META.get("HTTP_ACCEPT_ENCODING", "")
+    for encoding, suffix in PRECOMPRESSED:
+        if encoding in accept and os.path.isfile(path + suffix):
+            return path + suffix, encoding
+    return path, None
+
+
+def serve_file(request, path, root=None, content_type=None, max_age=None, mode=None, accel_prefix=None,
+               immutable=False):
+    """
+    Отдает файл с диска: ETag/Last-Modified, условные запросы (304),
+    Range (206), предсжатые варианты и X-Sendfile/X-Accel-Redirect
+    :param request: Запрос
+    :param path: Путь к файлу (относительный если указан root)
+    :param root: Папка из которой раздаем, выйти за нее нельзя
+    :param content_type: Тип если его нельзя угадать по расширению
+    :param max_age: Время кеширования, по умолчанию IMMUTABLE_MAX_AGE если immutable, иначе DEFAULT_MAX_AGE
+    :param mode: Режим раздачи, по умолчанию FILE_SERVE_MODE
+    :param accel_prefix: internal location nginx для root. Без root или без префикса
+                         режим "accel" не работает и файл отдает сам воркер
+    :param immutable: Под этим именем файл никогда не меняется (is_blob_name, is_manifest_name)
+    :return: HttpResponse
+    """
+    relative = path
+    if root is not None:
+        try:
+            path = safe_join(root, path)
+        except SuspiciousFileOperation:  # Попытка выйти за пределы root (../)
+            raise Http404("Файл не найден")
+    try:
+        stat = os.stat(path)
+    except OSError:
+        raise Http404("Файл не найден")
+    if not os.path.isfile(path):
+        raise Http404("Файл не найден")
+
+    range_header = request.META.get("HTTP_RANGE")
+    mode = mode or SERVE_MODE
+    if mode == "accel" and (root is None or accel_prefix is None):
+        mode = "django"
+    has_variants = any(os.path.isfile(path + suffix) for _, suffix in PRECOMPRESSED)
+    # Предсжатый вариант - отдельное представление со своим ETag
+    file_path, encoding = path, None
+    if has_variants and not range_header and mode == "django":
+        file_path, encoding = _pick_precompressed(request, path)
+        if encoding:
+            stat = os.stat(file_path)
+
+    etag = make_etag(stat)
+    last_modified = formatdate(stat.st_mtime, usegmt=True)
+    if max_age is None:
+        max_age = IMMUTABLE_MAX_AGE if immutable else DEFAULT_MAX_AGE
+    cache_control = "public, max-age=%d" % max_age
+    if max_age >= IMMUTABLE_MAX_AGE:
+        cache_control += ", immutable"
+    if content_type is None:
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+    def finalize(response):
+        if has_variants:
+            patch_vary_headers(response, ["Accept-Encoding"])
+        response["ETag"] = etag
+        response["Last-Modified"] = last_modified
+        response["Cache-Control"] = cache_control
+        response["Accept-Ranges"] = "bytes"
+        return response
+
+    # 304 Not Modified / 412 Precondition Failed
+    conditional = get_conditional_response(
+        request, etag=etag, last_modified=int(stat.st_mtime)
+    )
+    if conditional is not None:
+        return finalize(conditional)
+
+    # Прокси сам умеет Range и отдает файл без копирования через воркер
+    if mode == "sendfile":
+        response = finalize(HttpResponse(content_type=content_type))
+        response["X-Sendfile"] = os.path.abspath(path)
+        return response
+    if mode == "accel":
+        response = finalize(HttpResponse(content_type=content_type))
+        response["X-Accel-Redirect"] = accel_prefix.rstrip("/") + "/" + relative.lstrip("/")
+        return response
+
+    if range_header and request.method in ("GET", "HEAD"):
+        # If-Range: диапазон отдаем только если файл не менялся
+        if_range = request.META.get("HTTP_IF_RANGE")
+        if if_range and if_range != etag and parse_http_date_safe(if_range) != int(stat.st_mtime):
+            range_header = None
+    if range_header:
+        byte_range = parse_range(range_header, stat.st_size)
+        if byte_range is False:
+            response = finalize(HttpResponse(status=416))
+            response["Content-Range"] = "bytes */%d" % stat.st_size
+            return response
+        if byte_range is not None:
+            start, end = byte_range
+            length = end - start + 1
+            response = finalize(StreamingHttpResponse(
+                _range_iterator(path, start, length), status=206, content_type=content_type
+            ))
+            response["Content-Range"] = "bytes %d-%d/%d" % (start, end, stat.st_size)
+            response["Content-Length"] = str(length)
+            return response
+
+    # Полный файл, если есть - предсжатый вариант
+    response = FileResponse(
+        open(file_path, "rb"), content_type=content_type, filename=os.path.basename(path)
+    )
+    if encoding:
+        response["Content-Encoding"] = encoding
+    return finalize(response)
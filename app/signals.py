@@ -0,0 +1,114 @@
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from app.archive import attach
+from app.blobs import release_blobs, retain_blobs
+from app.feeds import schedule_post_changed
+from app.models import Comment, DisLike, Like, Media, Post, Report
+from app.related import schedule_new_post
+from app.stats import author_of, bump
+
+
+@receiver(post_init, sender=Media)
+def remember_media_file(sender, instance, **kwargs):
+    # Запоминаем исходный файл, чтобы при изменении знать какую ссылку отпустить
+    # Берем сырое значение, чтобы не трогать дескриптор (и не грузить отложенное поле)
+    value = instance.__dict__.get("file")
+    instance._original_file = getattr(value, "name", value) or None
+
+
+@receiver(post_save, sender=Media)
+def count_media_file(sender, instance, created, **kwargs):
+    current = instance.file.name if instance.file else None
+    if current != instance._original_file:
+        retain_blobs([current])
+        release_blobs([instance._original_file])
+        instance._original_file = current
+
+
+@receiver(post_delete, sender=Media)
+def release_media_file(sender, instance, **kwargs):
+    release_blobs([instance._original_file])
+
+
+# Статистика пользователей (UserStats)
+
+@receiver(post_save, sender=Post)
+def count_post_created(sender, instance, created, **kwargs):
+    if created and not instance.is_deleted:
+        bump(instance.author_id, posts_count=1)
+
+
+@receiver(post_delete, sender=Post)
+def count_post_deleted(sender, instance, **kwargs):
+    # Удаленный через is_deleted пост уже вычтен при скрытии
+    if not instance.is_deleted:
+        bump(instance.author_id, posts_count=-1)
+
+
+# Ленты и карта сайта: перестраиваем только то что затронул пост
+
+@receiver(post_save, sender=Post)
+def refresh_feeds_saved(sender, instance, **kwargs):
+    schedule_post_changed(instance.pk, instance.author_id)
+
+
+@receiver(post_delete, sender=Post)
+def refresh_feeds_deleted(sender, instance, **kwargs):
+    # Скрытый пост уже убран из лент при скрытии
+    if not instance.is_deleted:
+        schedule_post_changed(instance.pk, instance.author_id)
+
+
+@receiver(post_save, sender=Post)
+def refresh_related(sender, instance, created, **kwargs):
+    # Похожие для нового поста, остальные списки обновляет полный пересчет build_related
+    if created:
+        schedule_new_post()
+
+
+# Какое поле статистики автора поста меняет каждая модель
+RECEIVED_FIELDS = {
+    Like: "likes_received",
+    DisLike: "dislikes_received",
+    Comment: "comments_received",
+}
+
+
+def count_received_created(sender, instance, created, **kwargs):
+    if created:
+        bump(author_of(instance.post_id, instance), **{RECEIVED_FIELDS[sender]: 1})
+
+
+def count_received_deleted(sender, instance, **kwargs):
+    bump(author_of(instance.post_id, instance), **{RECEIVED_FIELDS[sender]: -1})
+
+
+for model in RECEIVED_FIELDS:
+    post_save.connect(count_received_created, sender=model, dispatch_uid="stats-created-%s" % model.__name__)
+    post_delete.connect(count_received_deleted, sender=model, dispatch_uid="stats-deleted-%s" % model.__name__)
+
+
+@receiver(post_init, sender=Report)
+def remember_report_status(sender, instance, **kwargs):
+    instance._original_is_solve = instance.__dict__.get("is_solve")
+
+
+@receiver(post_save, sender=Report)
+def count_report_saved(sender, instance, created, **kwargs):
+    if created:
+        bump(instance.user_id, open_reports=0 if instance.is_solve else 1)
+    elif instance.is_solve != instance._original_is_solve:
+        bump(instance.user_id, open_reports=-1 if instance.is_solve else 1)
+    instance._original_is_solve = instance.is_solve
+
+
+@receiver(post_delete, sender=Report)
+def count_report_deleted(sender, instance, **kwargs):
+    if not instance._original_is_solve:
+        bump(instance.user_id, open_reports=-1)
+
+
+# Архивная база подключается к каждому соединению с основной (ATTACH)
+connection_created.connect(attach, dispatch_uid="attach-archive")
@@ -0,0 +1,108 @@
+from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+
+from app.models import Comment, DisLike, Like, Post, Report, UserStats
+from app.taskqueue import task
+
+STAT_FIELDS = ["posts_count", "likes_received", "dislikes_received", "comments_received", "open_reports"]
+# Сколько пользователей пересчитываем за одну транзакцию при полной перестройке
+REBUILD_BATCH = 1000
+
+
+def bump(user_id, **deltas):
+    """
+    Изменяет счетчики пользователя на deltas: bump(5, likes_received=1)
+    Если строки еще нет - считаем ее целиком
+    """
+    deltas = {field: delta for field, delta in deltas.items() if delta}
+    if not user_id or not deltas:
+        return
+    updated = UserStats.objects.filter(pk=user_id).update(
+        **{field: F(field) + delta for field, delta in deltas.items()}
+    )
+    if not updated:
+        rebuild_user_stats(user_id)
+
+
+def author_of(post_id, instance=None):
+    """
+    Автор поста для лайка/коммента, без запроса если пост уже загружен
+    """
+    if instance is not None and type(instance).post.is_cached(instance):
+        return instance.post.author_id if not instance.post.is_deleted else None
+    return Post.objects.visible().filter(pk=post_id).values_list("author_id", flat=True).first()
+
+
+def compute(user_ids):
+    """
+    Считает статистику для пачки пользователей запросами с GROUP BY
+    :return: {user_id: {поле: значение}}
+    """
+    user_ids = list(user_ids)
+    result = {user_id: dict.fromkeys(STAT_FIELDS, 0) for user_id in user_ids}
+    visible = Post.objects.visible().filter(author_id__in=user_ids)
+    queries = [
+        ("posts_count", visible.values("author_id").annotate(n=Count("pk")).values_list("author_id", "n")),
+        ("likes_received", Like.objects.filter(post__in=visible)
+            .values("post__author_id").annotate(n=Count("pk")).values_list("post__author_id", "n")),
+        ("dislikes_received", DisLike.objects.filter(post__in=visible)
+            .values("post__author_id").annotate(n=Count("pk")).values_list("post__author_id", "n")),
+        ("comments_received", Comment.objects.filter(post__in=visible)
+            .values("post__author_id").annotate(n=Count("pk")).values_list("post__author_id", "n")),
+        ("open_reports", Report.objects.filter(user_id__in=user_ids, is_solve=False)
+            .values("user_id").annotate(n=Count("pk")).values_list("user_id", "n")),
+    ]
+    for field, queryset in queries:
+        for user_id, count in queryset:
+            result[user_id][field] = count
+    # Лайки и комменты старых постов лежат в архиве, их кол-во хранится в самом посте
+    archived = visible.values("author_id").annotate(
+        likes=Sum("archived_likes"), dislikes=Sum("archived_dislikes"), comments=Sum("archived_comments"),
+    ).values_list("author_id", "likes", "dislikes", "comments")
+    for user_id, likes, dislikes, comments in archived:
+        result[user_id]["likes_received"] += likes
+        result[user_id]["dislikes_received"] += dislikes
+        result[user_id]["comments_received"] += comments
+    return result
+
+
+def save(stats):
+    """
+    Записывает посчитанную статистику (INSERT ... ON CONFLICT UPDATE)
+    """
+    UserStats.objects.bulk_create(
+        [UserStats(user_id=user_id, **values) for user_id, values in stats.items()],
+        update_conflicts=True, unique_fields=["user"], update_fields=STAT_FIELDS,
+    )
+
+
+@task
+def rebuild_user_stats(user_id):
+    """
+    Пересчитывает статистику одного пользователя с нуля
+    """
+    if not User.objects.filter(pk=user_id).exists():
+        return
+    try:
+        with transaction.atomic():
+            save(compute([user_id]))
+    except IntegrityError:  # Пользователя удалили пока считали
+        pass
+
+
+def rebuild_all(batch_size=REBUILD_BATCH):
+    """
+    Пересчитывает статистику всех пользователей пачками
+    :return: Сколько пользователей пересчитано
+    """
+    total = 0
+    last_id = 0
+    while True:
+        user_ids = list(User.objects.filter(pk__gt=last_id).order_by("pk").values_list("pk", flat=True)[:batch_size])
+        if not user_ids:
+            return total
+        with transaction.atomic():
+            save(compute(user_ids))
+        total += len(user_ids)
+        last_id = user_ids[-1]
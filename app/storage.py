@@ -0,0 +1,184 @@
+import errno
+import gzip
+import hashlib
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage, StaticFilesStorage
+from django.core.files.storage import FileSystemStorage, storages
+from django.utils.deconstruct import deconstructible
+
+try:
+    import brotli  # pip install brotli (необязательно)
+except ImportError:
+    brotli = None
+
+# Что имеет смысл сжимать, картинки и шрифты woff2 уже сжаты
+COMPRESSIBLE_EXTENSIONS = (".css", ".js", ".mjs", ".map", ".svg", ".txt", ".html", ".xml", ".json", ".ico")
+# Маленькие файлы не сжимаем, выигрыша почти нет
+MIN_COMPRESS_SIZE = 256
+
+
+class PrecompressMixin:
+    """
+    Пост-обработчик collectstatic: рядом с каждым файлом кладет .gz и .br варианты,
+    чтобы при раздаче не сжимать на лету
+    """
+
+    def post_process(self, paths, dry_run=False, **options):
+        parent = getattr(super(), "post_process", None)
+        if parent is not None:
+            processed = parent(paths, dry_run=dry_run, **options)
+        else:
+            processed = ((path, None, False) for path in paths)
+
+        # Manifest отдает одно имя несколько раз (по проходу на файл), сжимаем один раз
+        names = {}
+        for name, hashed_name, was_processed in processed:
+            yield name, hashed_name, was_processed
+            if isinstance(was_processed, Exception) or dry_run:
+                continue
+            names[name] = True
+            if hashed_name:
+                names[hashed_name] = True
+
+        for name in names:
+            for compressed_name in self.compress_file(name):
+                yield compressed_name, compressed_name, True
+
+    def compress_file(self, name):
+        """
+        Сжимает один файл
+        :param name: Имя файла в хранилище
+        :return: Список созданных сжатых файлов
+        """
+        if not name.lower().endswith(COMPRESSIBLE_EXTENSIONS):
+            return []
+        path = self.path(name)
+        with open(path, "rb") as fh:
+            data = fh.read()
+        if len(data) < MIN_COMPRESS_SIZE:
+            return []
+
+        created = []
+        variants = [(".gz", lambda raw: gzip.compress(raw, compresslevel=9, mtime=0))]
+        if brotli is not None:
+            variants.append((".br", lambda raw: brotli.compress(raw, quality=11)))
+        for suffix, compress in variants:
+            compressed = compress(data)
+            if len(compressed) >= len(data):  # Сжатие не помогло
+                continue
+            tmp_path = path + suffix + ".tmp"
+            with open(tmp_path, "wb") as fh:
+                fh.write(compressed)
+            os.replace(tmp_path, path + suffix)
+            created.append(name + suffix)
+        return created
+
+
+class PrecompressedStaticFilesStorage(PrecompressMixin, StaticFilesStorage):
+    pass
+
+
+class PrecompressedManifestStaticFilesStorage(PrecompressMixin, ManifestStaticFilesStorage):
+    """
+    Имена с хешем содержимого (style.3f2a9c1b7e4d.css) + сжатые варианты,
+    такие файлы раздаются с кешированием на год
+    """
+    pass
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    Хранилище где имя файла - sha256 его содержимого.
+    Одинаковые картинки лежат на диске один раз: post-gallery/ab/ab12...ef.jpg
+    Файл считаем хешем прямо во время записи по чанкам, целиком в память не грузим
+    """
+
+    def get_available_name(self, name, max_length=None):
+        # Итоговое имя зависит от содержимого и считается в _save
+        return name
+
+    def _save(self, name, content):
+        stored_name = getattr(content, "stored_name", None)
+        if stored_name and self.exists(stored_name):
+            # Файл уже записан сюда при загрузке (StreamingImageUploadHandler)
+            return stored_name
+        directory, basename = os.path.split(name)
+        extension = os.path.splitext(basename)[1].lower()
+
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(suffix=".upload", dir=staging_dir())
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                if hasattr(content, "seek"):
+                    content.seek(0)
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    fh.write(chunk)
+            final_name = self.blob_name(directory, digest.hexdigest(), extension)
+            self.move_into_place(tmp_path, final_name)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return final_name
+
+    def move_into_place(self, tmp_path, name):
+        """
+        Переносит готовый файл из staging_dir() в хранилище под именем name.
+        Такой файл уже есть - временный удаляем, второй раз не храним
+        """
+        final_path = self.path(name)
+        if os.path.exists(final_path):
+            os.remove(tmp_path)
+            return
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        if self.file_permissions_mode is not None:
+            os.chmod(tmp_path, self.file_permissions_mode)
+        try:
+            os.replace(tmp_path, final_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # Временная папка на другом диске: копируем рядом с итоговым файлом и переименовываем,
+            # чтобы под итоговым именем никогда не было недописанного файла
+            fd, copy_path = tempfile.mkstemp(suffix=".upload", dir=os.path.dirname(final_path))
+            try:
+                with os.fdopen(fd, "wb") as dst, open(tmp_path, "rb") as src:
+                    shutil.copyfileobj(src, dst)
+                shutil.copymode(tmp_path, copy_path)
+                os.replace(copy_path, final_path)
+            except BaseException:
+                os.remove(copy_path)
+                raise
+            os.remove(tmp_path)
+
+    @staticmethod
+    def blob_name(directory, digest, extension):
+        """
+        Имя блоба по хешу, раскладываем по подпапкам чтобы не было 100к файлов в одной
+        """
+        name = "%s/%s%s" % (digest[:2], digest, extension)
+        return "%s/%s" % (directory.rstrip("/"), name) if directory else name
+
+
+def staging_dir():
+    """
+    Папка для недописанных и еще не подтвержденных загрузок, вне MEDIA_ROOT:
+    serve_media их не отдаст. UPLOAD_STAGING_DIR, иначе FILE_UPLOAD_TEMP_DIR или системная временная папка
+    """
+    directory = (getattr(settings, "UPLOAD_STAGING_DIR", None) or settings.FILE_UPLOAD_TEMP_DIR
+                 or tempfile.gettempdir())
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def select_media_storage():
+    """
+    Хранилище для Media.file, задается в STORAGES["media"]
+    """
+    return storages["media"]
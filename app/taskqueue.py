@@ -0,0 +1,271 @@
+import logging
+import os
+import random
+import socket
+import threading
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import timedelta
+from functools import partial
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from app.models import Task
+
+logger = logging.getLogger(__name__)
+
+# Выполнять задачи сразу после коммита, без воркера (для разработки)
+EAGER = getattr(settings, "TASK_QUEUE_EAGER", False)
+# Сколько задач воркер забирает одним UPDATE
+BATCH_SIZE = getattr(settings, "TASK_QUEUE_BATCH_SIZE", 100)
+# На сколько секунд воркер берет задачу, если он умрет - задачу возьмет другой.
+# Пока пачка выполняется, аренда продлевается каждые LEASE / 3 секунд
+LEASE = getattr(settings, "TASK_QUEUE_LEASE", 5 * 60)
+# Повтор после ошибки: BACKOFF_BASE * 2^(попытка-1), но не больше BACKOFF_MAX
+BACKOFF_BASE = getattr(settings, "TASK_QUEUE_BACKOFF_BASE", 5)
+BACKOFF_MAX = getattr(settings, "TASK_QUEUE_BACKOFF_MAX", 60 * 60)
+MAX_ATTEMPTS = getattr(settings, "TASK_QUEUE_MAX_ATTEMPTS", 5)
+
+# Задачу перехватил другой воркер (аренда истекла), выполнять не нужно
+LOST = object()
+
+
+def task(func):
+    """
+    Делает функцию фоновой задачей:
+
+        @task
+        def purge_post(post_id): ...
+
+        purge_post.enqueue(post.pk, dedup_key="purge-post:%s" % post.pk)
+
+    Аргументы должны сериализоваться в JSON
+    """
+    func.task_name = "%s.%s" % (func.__module__, func.__name__)
+    func.is_task = True
+    func.enqueue = partial(enqueue, func)
+    return func
+
+
+def enqueue(func, *args, dedup_key=None, delay=0, max_attempts=None, **kwargs):
+    """
+    Ставит задачу в очередь. Запись идет в текущей транзакции,
+    поэтому задача появится только если транзакция закоммитится
+    :param func: Функция помеченная @task
+    :param dedup_key: Если такая задача уже ждет в очереди - вторую не ставим
+    :param delay: Запустить не раньше чем через столько секунд
+    :param max_attempts: Сколько раз пробовать
+    :return: Task (существующая если сработала дедупликация), None в режиме EAGER
+    """
+    if EAGER:
+        transaction.on_commit(lambda: func(*args, **kwargs))
+        return None
+    fields = dict(
+        name=func.task_name,
+        args=list(args),
+        kwargs=kwargs,
+        dedup_key=dedup_key,
+        max_attempts=max_attempts or MAX_ATTEMPTS,
+        run_at=timezone.now() + timedelta(seconds=delay),
+    )
+    if dedup_key is None:
+        return Task.objects.create(**fields)
+    try:
+        with transaction.atomic():
+            return Task.objects.create(**fields)
+    except IntegrityError:
+        existing = Task.objects.filter(dedup_key=dedup_key, status=Task.QUEUED).first()
+        if existing is None:  # Ее успели взять в работу - ставим заново
+            return enqueue(func, *args, dedup_key=dedup_key, delay=delay, max_attempts=max_attempts, **kwargs)
+        return existing
+
+
+def claim(batch_size=BATCH_SIZE):
+    """
+    Забирает пачку готовых задач. Одна пачка - один UPDATE, а не блокировка на каждую строку.
+    Условие повторяется в UPDATE, поэтому два воркера не возьмут одну задачу
+    :return: Список Task
+    """
+    now = timezone.now()
+    ready = Q(status=Task.QUEUED, run_at__lte=now) | Q(status=Task.RUNNING, locked_until__lt=now)
+    token = uuid.uuid4().hex
+    with transaction.atomic():
+        candidates = Task.objects.filter(ready).order_by("run_at").values_list("pk", flat=True)[:batch_size]
+        if connection.features.has_select_for_update_skip_locked:
+            candidates = candidates.select_for_update(skip_locked=True)
+        ids = list(candidates)
+        if not ids:
+            return []
+        Task.objects.filter(ready, pk__in=ids).update(
+            status=Task.RUNNING,
+            claimed_by=token,
+            locked_until=now + timedelta(seconds=LEASE),
+            attempts=F("attempts") + 1,
+        )
+    return list(Task.objects.filter(claimed_by=token, status=Task.RUNNING))
+
+
+def renew(token, task_pk=None):
+    """
+    Продлевает аренду задач пачки token (или одной задачи task_pk)
+    :return: Сколько задач все еще наши: истекшую аренду мог перехватить другой воркер
+    """
+    queryset = Task.objects.filter(claimed_by=token, status=Task.RUNNING)
+    if task_pk is not None:
+        queryset = queryset.filter(pk=task_pk)
+    return queryset.update(locked_until=timezone.now() + timedelta(seconds=LEASE))
+
+
+@contextmanager
+def keep_leased(token):
+    """
+    Пока выполняется пачка, фоновый поток продлевает аренду всех ее задач:
+    и еще не начатых, и выполненных, результат которых запишем в конце
+    """
+    stop = threading.Event()
+
+    def heartbeat():
+        try:
+            while not stop.wait(LEASE / 3):
+                try:
+                    renew(token)
+                except Exception:
+                    logger.exception("Не удалось продлить аренду задач")
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=heartbeat, name="task-lease", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def execute(task_row):
+    """
+    Выполняет одну задачу
+    :return: None если успешно, иначе текст ошибки
+    """
+    try:
+        func = import_string(task_row.name)
+        if not getattr(func, "is_task", False):
+            raise ValueError("%s не помечена @task" % task_row.name)
+        func(*task_row.args, **task_row.kwargs)
+    except Exception:
+        logger.exception("Задача %s (%s) упала", task_row.name, task_row.pk)
+        return traceback.format_exc(limit=20)
+    return None
+
+
+def backoff(attempts):
+    delay = min(BACKOFF_BASE * 2 ** max(attempts - 1, 0), BACKOFF_MAX)
+    return delay * random.uniform(0.5, 1.5)
+
+
+def finish(token, done, failed):
+    """
+    Записывает результат пачки: успешные удаляем одним DELETE, упавшие
+    ставим на повтор с задержкой или помечаем проваленными.
+    Трогаем только строки которые все еще наши (claimed_by = token)
+    :param token: Метка пачки
+    :param done: Список pk успешных задач
+    :param failed: Список (Task, ошибка)
+    """
+    ours = Task.objects.filter(claimed_by=token, status=Task.RUNNING)
+    if done:
+        ours.filter(pk__in=done).delete()
+    now = timezone.now()
+    for task_row, error in failed:
+        if task_row.attempts >= task_row.max_attempts:
+            ours.filter(pk=task_row.pk).update(
+                status=Task.FAILED, locked_until=None, last_error=error
+            )
+            continue
+        try:
+            with transaction.atomic():
+                ours.filter(pk=task_row.pk).update(
+                    status=Task.QUEUED, locked_until=None, last_error=error,
+                    run_at=now + timedelta(seconds=backoff(task_row.attempts)),
+                )
+        except IntegrityError:
+            # Такая же задача уже снова в очереди - она и выполнит работу
+            ours.filter(pk=task_row.pk).delete()
+
+
+def run_batch(batch_size=BATCH_SIZE, pool=None):
+    """
+    Забирает и выполняет одну пачку задач
+    :param pool: ThreadPoolExecutor, если задачи нужно выполнять в несколько потоков
+    :return: Сколько задач выполнено
+    """
+    tasks = claim(batch_size)
+    if not tasks:
+        return 0
+    token = tasks[0].claimed_by
+    with keep_leased(token):
+        if pool is None:
+            errors = [_execute_claimed(task_row) for task_row in tasks]
+        else:
+            errors = list(pool.map(_execute_in_thread, tasks))
+    done = [task_row.pk for task_row, error in zip(tasks, errors) if error is None]
+    failed = [(task_row, error) for task_row, error in zip(tasks, errors) if error not in (None, LOST)]
+    finish(token, done, failed)
+    return len(tasks)
+
+
+def _execute_claimed(task_row):
+    # Перед запуском продлеваем аренду и заодно проверяем что задача все еще наша
+    if not renew(task_row.claimed_by, task_row.pk):
+        logger.warning("Задачу %s (%s) уже взял другой воркер", task_row.name, task_row.pk)
+        return LOST
+    return execute(task_row)
+
+
+def _execute_in_thread(task_row):
+    try:
+        return _execute_claimed(task_row)
+    finally:
+        connection.close()  # У каждого потока свое соединение
+
+
+def run_worker(threads=1, batch_size=BATCH_SIZE, poll=1.0, once=False, stop_event=None):
+    """
+    Цикл воркера: берет пачки пока есть задачи, иначе спит poll секунд
+    :param threads: Кол-во потоков для выполнения задач пачки
+    :param once: Выполнить все готовые задачи и выйти
+    :param stop_event: threading.Event для остановки
+    """
+    import django
+    from django.apps import apps
+    if not apps.ready:  # Процесс запущен через spawn
+        django.setup()
+
+    stop_event = stop_event or threading.Event()
+    name = "%s:%s" % (socket.gethostname(), os.getpid())
+    logger.info("Воркер %s запущен", name)
+    pool = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+    try:
+        while not stop_event.is_set():
+            try:
+                processed = run_batch(batch_size, pool)
+            except Exception:
+                logger.exception("Ошибка воркера %s", name)
+                processed = 0
+            if processed:
+                continue
+            if once:
+                break
+            stop_event.wait(poll)
+            connection.close_if_unusable_or_obsolete()
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        connection.close()
@@ -0,0 +1,14 @@
+from django import template
+
+from app.image_proxy import proxied_url
+
+register = template.Library()
+
+
+@register.filter
+def proxied(url, width=None):
+    """
+    Внешняя картинка через наш кеширующий прокси
+    Пример: {{ media.url|proxied:600 }}
+    """
+    return proxied_url(url, width)
@@ -0,0 +1,17 @@
+from django.test.runner import DiscoverRunner
+
+from app.archive import ALIAS
+
+
+class TestRunner(DiscoverRunner):
+    """
+    Основная тестовая база подключает (ATTACH) архивную, поэтому архивная создается
+    всегда вместе с ней, даже если выбранным тестам она не нужна: иначе TEST DEPENDENCIES
+    основной базы не выполнить, а ATTACH создал бы пустой настоящий файл архива
+    """
+
+    def get_databases(self, suite):
+        databases = super().get_databases(suite)
+        if "default" in databases:
+            databases.setdefault(ALIAS, False)
+        return databases
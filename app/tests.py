@@ -1,3 +1,791 @@
-from django.test import TestCase
+import gzip
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import Client, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.core import signing
+from django.http import Http404, HttpResponse
+from django.urls import reverse
+from django.utils.http import http_date
+from django.db.models import F
+from django.utils import timezone
+from PIL import Image
+
+from app.admin import PostAdmin
+from app.archive import archive_old, restore_reactions
+from app import feeds, profiler, ratelimit
+from app.forms import PostForm
+from app.image_proxy import ImageProxyError, get_image
+from app.models import (
+    ArchivedComment, ArchivedLike, Blob, Comment, DisLike, Like, Media, Post, RelatedPost, Report, Task, UserStats,
+)
+from app.purge import purge_post, purge_user
+from app.related import build_related
+from app.serving import is_manifest_name, serve_file
+from app.stats import bump, rebuild_user_stats
+from app.storage import select_media_storage
+from app.taskqueue import claim, enqueue, finish, run_batch, task
+from app.uploads import StreamingImageUploadHandler
+from app.viewcounts import DEDUP_WINDOW, ViewCounter
+
+
+def run_tasks():
+    """
+    Выполняет все готовые задачи очереди в текущем потоке
+    """
+    while run_batch():
+        pass
+
+
+def make_png(width=40, height=20):
+    output = io.BytesIO()
+    Image.new("RGB", (width, height), "red").save(output, "PNG")
+    return output.getvalue()
+
+
+class ImageServer(ThreadingHTTPServer):
+    """
+    Локальная замена внешнего сайта с картинками, считает запросы по путям
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), ImageHandler)
+        self.hits = Counter()
+        self.lock = threading.Lock()
+
+    def url(self, path):
+        return "http://127.0.0.1:%d%s" % (self.server_address[1], path)
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        with self.server.lock:
+            self.server.hits[self.path] += 1
+        if self.path.startswith("/slow"):
+            time.sleep(0.3)
+        if self.path.startswith("/error"):
+            self.send_error(500)
+            return
+        body = make_png()
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ImageProxyTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ImageServer()
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir, ignore_errors=True)
+        settings = override_settings(IMAGE_PROXY_CACHE_DIR=self.cache_dir, IMAGE_PROXY_ALLOW_PRIVATE=True)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.server.hits.clear()
+
+    def run_concurrently(self, url, count=8):
+        results = []
+
+        def worker():
+            try:
+                results.append(get_image(url))
+            except ImageProxyError as e:
+                results.append(e)
+
+        threads = [threading.Thread(target=worker) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_fetches_once_and_serves_from_cache(self):
+        url = self.server.url("/image.png")
+        path, content_type = get_image(url)
+        self.assertEqual(content_type, "image/png")
+        self.assertEqual(get_image(url), (path, content_type))
+        self.assertEqual(self.server.hits["/image.png"], 1)
+
+    def test_resizes_to_width(self):
+        path, _ = get_image(self.server.url("/image.png"), width=10)
+        with Image.open(path) as image:
+            self.assertEqual(image.size, (10, 5))
+
+    def test_concurrent_requests_share_one_fetch(self):
+        results = self.run_concurrently(self.server.url("/slow.png"))
+        self.assertEqual(self.server.hits["/slow.png"], 1)
+        self.assertEqual(len(set(results)), 1)
+
+    def test_failure_is_shared_and_remembered(self):
+        url = self.server.url("/error.png")
+        results = self.run_concurrently(url)
+        self.assertTrue(all(isinstance(result, ImageProxyError) for result in results))
+        self.assertEqual(self.server.hits["/error.png"], 1)
+        with self.assertRaises(ImageProxyError):
+            get_image(url)
+        self.assertEqual(self.server.hits["/error.png"], 1)
+        with override_settings(IMAGE_PROXY_FAILURE_TTL=0):
+            with self.assertRaises(ImageProxyError):
+                get_image(url)
+        self.assertEqual(self.server.hits["/error.png"], 2)
+
+    def test_rejects_private_addresses(self):
+        with override_settings(IMAGE_PROXY_ALLOW_PRIVATE=False):
+            with self.assertRaisesMessage(ImageProxyError, "Внутренний адрес"):
+                get_image(self.server.url("/image.png"))
+        self.assertEqual(self.server.hits["/image.png"], 0)
+
+    def test_rejects_unsupported_schemes(self):
+        with self.assertRaises(ImageProxyError):
+            get_image("file:///etc/passwd")
+
+
+class ArchiveTests(TransactionTestCase):
+    # Строки переносятся через основное соединение (ATTACH), а читаются архивным:
+    # без настоящих коммитов второе соединение их не увидит
+    databases = {"default", "archive"}
+
+    def setUp(self):
+        self.author = User.objects.create_user("author")
+        self.fan = User.objects.create_user("fan")
+        self.post = Post.objects.create(author=self.author, title="Старый пост", content="Текст")
+        Post.objects.filter(pk=self.post.pk).update(created_at=timezone.now() - timedelta(days=400))
+        Like.objects.create(post=self.post, user=self.fan)
+        Comment.objects.create(post=self.post, user=self.fan, body="Коммент")
+
+    def test_archive_old_moves_rows_into_test_archive(self):
+        real_archive = os.path.join(settings.BASE_DIR, "archive.sqlite3")
+        real_stat = os.stat(real_archive) if os.path.exists(real_archive) else None
+
+        self.assertEqual(archive_old(pause=0), {"Comment": 1, "Like": 1})
+
+        self.assertFalse(Like.objects.exists())
+        self.assertEqual(ArchivedLike.objects.count(), 1)
+        self.assertEqual(ArchivedComment.objects.get().body, "Коммент")
+        post = Post.objects.get(pk=self.post.pk)
+        self.assertEqual(post.get_likes_count(), 1)
+        self.assertEqual(post.get_comments_count(), 1)
+        self.assertEqual(os.stat(real_archive) if os.path.exists(real_archive) else None, real_stat)
+
+    def test_restore_finishes_interrupted_restore_without_double_count(self):
+        archive_old(pause=0)
+        archived = ArchivedLike.objects.get()
+        # Первый шаг уже прошел (строка вернулась, счетчик уменьшен), архивную копию удалить не успели
+        Like.objects.bulk_create([Like(pk=archived.pk, post_id=archived.post_id, user_id=archived.user_id)])
+        Post.objects.filter(pk=self.post.pk).update(archived_likes=0)
+
+        restore_reactions(Post.objects.get(pk=self.post.pk), self.fan.pk)
+
+        self.assertFalse(ArchivedLike.objects.exists())
+        post = Post.objects.get(pk=self.post.pk)
+        self.assertEqual(post.archived_likes, 0)
+        self.assertEqual(post.get_likes_count(), 1)
+
+    def test_purge_user_removes_archived_rows(self):
+        archive_old(pause=0)
+        purge_user(self.fan.pk)
+        purge_user(self.fan.pk)  # Повтор задачи ничего не ломает
+
+        self.assertFalse(ArchivedLike.objects.exists())
+        self.assertFalse(ArchivedComment.objects.exists())
+        post = Post.objects.get(pk=self.post.pk)
+        self.assertEqual((post.get_likes_count(), post.get_comments_count()), (0, 0))
+        self.assertEqual(post.get_comments(), [])
+
+
+class RelatedTests(TestCase):
+    databases = {"default", "archive"}  # Лайки читаются и из архива
+
+    def setUp(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        patcher = mock.patch("app.related.VECTORS_PATH", os.path.join(cache_dir, "related.npz"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.author = User.objects.create_user("author")
+        self.fan = User.objects.create_user("fan")
+
+    def post(self, title, content):
+        return Post.objects.create(author=self.author, title=title, content=content)
+
+    def test_new_only_computes_only_unmarked_posts(self):
+        python = self.post("Django и Python", "Модели и миграции Django")
+        self.post("Рецепт борща", "Свекла капуста морковь")
+        lonely = self.post("Абв", "Где")  # Ни одного общего слова: пустой список
+        self.assertEqual(build_related(), 3)
+        self.assertFalse(Post.objects.filter(related_at__isnull=True).exists())
+        self.assertFalse(RelatedPost.objects.filter(post=lonely).exists())
+
+        new = self.post("Миграции Django", "Как писать миграции")
+        Like.objects.create(post=new, user=self.fan)
+        Like.objects.create(post=python, user=self.fan)
+        self.assertEqual(build_related(new_only=True), 1)
+        self.assertEqual(RelatedPost.objects.filter(post=new, rank=0).get().related, python)
+        self.assertEqual(build_related(new_only=True), 0)
+
+        # Второй новый пост находит первый: он уже в сохраненных векторах
+        newer = self.post("Миграции Django снова", "Миграции")
+        self.assertEqual(build_related(new_only=True), 1)
+        self.assertEqual(
+            set(RelatedPost.objects.filter(post=newer).values_list("related", flat=True)), {python.pk, new.pk}
+        )
+
+
+class StatsTests(TransactionTestCase):
+    # purge_post пишет и в архив: открытая транзакция TestCase держала бы его таблицы
+    databases = {"default", "archive"}
+
+    def setUp(self):
+        self.author = User.objects.create_user("author")
+        self.fan = User.objects.create_user("fan")
+        self.post = Post.objects.create(author=self.author, title="Пост", content="Текст")
+
+    def stats(self, user):
+        return UserStats.objects.values(
+            "posts_count", "likes_received", "dislikes_received", "comments_received", "open_reports"
+        ).get(pk=user.pk)
+
+    def test_counters_follow_creates_and_deletes(self):
+        like = Like.objects.create(post=self.post, user=self.fan)
+        DisLike.objects.create(post=self.post, user=self.fan)
+        comment = Comment.objects.create(post=self.post, user=self.fan, body="Коммент")
+        Comment.objects.create(post=self.post, user=self.fan, body="Еще")
+        report = Report.objects.create(post=self.post, user=self.fan, theme="SP", description="Спам")
+        self.assertEqual(self.stats(self.author), {
+            "posts_count": 1, "likes_received": 1, "dislikes_received": 1, "comments_received": 2, "open_reports": 0,
+        })
+        self.assertEqual(self.stats(self.fan)["open_reports"], 1)
+
+        like.delete()
+        comment.delete()
+        report.is_solve = True
+        report.save()
+        self.assertEqual(self.stats(self.author), {
+            "posts_count": 1, "likes_received": 0, "dislikes_received": 1, "comments_received": 1, "open_reports": 0,
+        })
+        self.assertEqual(self.stats(self.fan)["open_reports"], 0)
+        report.delete()  # Решенная жалоба счетчик не трогает
+        Report.objects.create(post=self.post, user=self.fan, theme="SP", description="Спам").delete()
+        self.assertEqual(self.stats(self.fan)["open_reports"], 0)
+
+    def test_bump_rebuilds_missing_row(self):
+        Like.objects.create(post=self.post, user=self.fan)
+        UserStats.objects.filter(pk=self.author.pk).delete()
+        bump(self.author.pk, comments_received=1)  # Строки нет: считаем целиком, а не от нуля
+        self.assertEqual(self.stats(self.author), {
+            "posts_count": 1, "likes_received": 1, "dislikes_received": 0, "comments_received": 0, "open_reports": 0,
+        })
+
+    def test_rebuild_matches_incremental_counters(self):
+        Like.objects.create(post=self.post, user=self.fan)
+        DisLike.objects.create(post=self.post, user=self.author)
+        Comment.objects.create(post=self.post, user=self.fan, body="Коммент")
+        Report.objects.create(post=self.post, user=self.fan, theme="OT", description="Другое")
+        Post.objects.create(author=self.author, title="Второй", content="Текст")
+        incremental = {user.pk: self.stats(user) for user in (self.author, self.fan)}
+
+        UserStats.objects.update(likes_received=100, open_reports=100)
+        for user in (self.author, self.fan):
+            rebuild_user_stats(user.pk)
+        self.assertEqual({user.pk: self.stats(user) for user in (self.author, self.fan)}, incremental)
+
+    def test_purge_post_recounts_reporters(self):
+        Report.objects.create(post=self.post, user=self.fan, theme="SP", description="Спам")
+        self.assertEqual(self.stats(self.fan)["open_reports"], 1)
+
+        purge_post(self.post.pk)
+        run_tasks()
+
+        self.assertFalse(Report.objects.exists())
+        self.assertEqual(self.stats(self.fan)["open_reports"], 0)
+
+
+@task
+def noop_task(value=None):
+    pass
+
+
+@task
+def failing_task():
+    raise RuntimeError("Сломалось")
+
+
+class TaskQueueTests(TestCase):
+    def test_workers_claim_disjoint_batches(self):
+        for i in range(4):
+            enqueue(noop_task, i)
+        first, second = claim(batch_size=2), claim(batch_size=2)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 2)
+        self.assertFalse({t.pk for t in first} & {t.pk for t in second})
+        self.assertNotEqual(first[0].claimed_by, second[0].claimed_by)
+        self.assertEqual(claim(), [])
+
+    def test_expired_lease_is_reclaimed_and_stale_finish_is_ignored(self):
+        enqueue(noop_task)
+        [stale] = claim()
+        self.assertEqual(claim(), [])  # Аренда еще не истекла
+        Task.objects.update(locked_until=timezone.now() - timedelta(seconds=1))
+
+        [fresh] = claim()
+        self.assertEqual(fresh.pk, stale.pk)
+        self.assertNotEqual(fresh.claimed_by, stale.claimed_by)
+        self.assertEqual(fresh.attempts, 2)
+
+        # Первый воркер проснулся и пишет результат: строка уже не его
+        finish(stale.claimed_by, [stale.pk], [(stale, "ошибка")])
+        row = Task.objects.get(pk=fresh.pk)
+        self.assertEqual((row.status, row.claimed_by, row.last_error), (Task.RUNNING, fresh.claimed_by, ""))
+
+        finish(fresh.claimed_by, [fresh.pk], [])
+        self.assertFalse(Task.objects.exists())
+
+    def test_failure_is_retried_with_backoff_then_failed(self):
+        enqueue(failing_task, max_attempts=2)
+        with self.assertLogs("app.taskqueue", "ERROR"):
+            self.assertEqual(run_batch(), 1)
+        row = Task.objects.get()
+        self.assertEqual((row.status, row.attempts), (Task.QUEUED, 1))
+        self.assertIn("Сломалось", row.last_error)
+        self.assertGreater(row.run_at, timezone.now())
+        self.assertEqual(run_batch(), 0)  # Повтор еще не наступил
+
+        Task.objects.update(run_at=timezone.now())
+        with self.assertLogs("app.taskqueue", "ERROR"):
+            self.assertEqual(run_batch(), 1)
+        row = Task.objects.get()
+        self.assertEqual((row.status, row.attempts, row.locked_until), (Task.FAILED, 2, None))
+
+    def test_duplicate_dedup_key_collapses_to_one_row(self):
+        first = enqueue(noop_task, 1, dedup_key="same")
+        second = enqueue(noop_task, 2, dedup_key="same")
+        self.assertEqual(first.pk, second.pk)
+        self.assertEqual(Task.objects.count(), 1)
+
+        # Взятая в работу задача не мешает поставить новую
+        claim()
+        third = enqueue(noop_task, 3, dedup_key="same")
+        self.assertNotEqual(third.pk, first.pk)
+        self.assertEqual(Task.objects.filter(dedup_key="same").count(), 2)
+
+
+class UploadTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.staging = tempfile.mkdtemp()
+        for directory in (self.media_root, self.staging):
+            self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        settings = override_settings(MEDIA_ROOT=self.media_root, UPLOAD_STAGING_DIR=self.staging)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.user = User.objects.create_user("author")
+        self.client.force_login(self.user)
+
+    def create_post(self, content, client=None):
+        return (client or self.client).post(reverse("post-create"), {
+            "title": "Пост", "content": "Текст",
+            "media-TOTAL_FORMS": "1", "media-INITIAL_FORMS": "0",
+            "media-MIN_NUM_FORMS": "0", "media-MAX_NUM_FORMS": "1000",
+            "media-0-file": SimpleUploadedFile("picture.png", content, "image/png"),
+        })
+
+    def stored_files(self):
+        return sorted(
+            os.path.relpath(os.path.join(directory, name), self.media_root)
+            for directory, _, files in os.walk(self.media_root) for name in files
+        )
+
+    def assertNothingStored(self):
+        self.assertFalse(Post.objects.exists())
+        self.assertFalse(Blob.objects.exists())
+        self.assertEqual(self.stored_files(), [])
+        self.assertEqual(os.listdir(self.staging), [])
+
+    def test_identical_uploads_share_one_blob(self):
+        png = make_png()
+        self.assertEqual(self.create_post(png).status_code, 302)
+        self.assertEqual(self.create_post(png).status_code, 302)
+
+        self.assertEqual(Media.objects.count(), 2)
+        self.assertEqual(len(set(Media.objects.values_list("file", flat=True))), 1)
+        blob = Blob.objects.get()
+        self.assertEqual((blob.ref_count, blob.size), (2, len(png)))
+        self.assertEqual(self.stored_files(), [blob.name])
+        self.assertEqual(os.listdir(self.staging), [])
+
+    def test_rejects_oversize_file(self):
+        with mock.patch("app.uploads.MAX_FILE_SIZE", 1024 * 1024):
+            response = self.create_post(make_png() + b"\0" * (1024 * 1024))
+        self.assertContains(response, "Файл больше 1 МБ")
+        self.assertNothingStored()
+
+    def test_rejects_non_image_by_content(self):
+        response = self.create_post(b"<?php echo 'not an image'; ?>")
+        self.assertContains(response, "Файл не является картинкой")
+        self.assertNothingStored()
+
+    def test_csrf_failure_leaves_no_files(self):
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(self.user)
+        self.assertEqual(self.create_post(make_png(), client).status_code, 403)
+        self.assertNothingStored()
+
+    def test_interrupted_upload_removes_temp_file(self):
+        handler = StreamingImageUploadHandler(RequestFactory().post("/"), select_media_storage(), "post-gallery")
+        handler.new_file("media-0-file", "picture.png", "image/png", None)
+        handler.receive_data_chunk(make_png(), 0)
+        self.assertEqual(len(os.listdir(self.staging)), 1)
+        handler.upload_interrupted()
+        self.assertEqual(os.listdir(self.staging), [])
+
+
+class ServeFileTests(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        settings = override_settings(MEDIA_ROOT=self.root, FILE_SERVE_MODE="django")
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.factory = RequestFactory()
+        self.body = b"0123456789" * 100
+        self.write("file.txt", self.body)
+
+    def write(self, name, data):
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as fh:
+            fh.write(data)
+        return path
+
+    def serve(self, name="file.txt", method="get", **headers):
+        request = getattr(self.factory, method)("/media/" + name, headers=headers)
+        return serve_file(request, name, root=self.root)
+
+    def test_full_file_with_strong_etag(self):
+        response = self.serve()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), self.body)
+        self.assertRegex(response["ETag"], r'^"[0-9a-f-]+"$')
+        self.assertEqual(response["Cache-Control"], "public, max-age=60")
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+
+    def test_conditional_requests_return_304(self):
+        response = self.serve()
+        self.assertEqual(self.serve(if_none_match=response["ETag"]).status_code, 304)
+        self.assertEqual(self.serve(if_modified_since=response["Last-Modified"]).status_code, 304)
+        self.assertEqual(self.serve(if_none_match='"other"').status_code, 200)
+        self.assertEqual(self.serve(if_modified_since=http_date(0)).status_code, 200)
+
+    def test_single_range_returns_206(self):
+        response = self.serve(range="bytes=10-19")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], "bytes 10-19/1000")
+        self.assertEqual(b"".join(response.streaming_content), self.body[10:20])
+        self.assertEqual(b"".join(self.serve(range="bytes=-5").streaming_content), self.body[-5:])
+
+    def test_unsatisfiable_range_returns_416(self):
+        response = self.serve(range="bytes=5000-")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], "bytes */1000")
+
+    def test_path_traversal_is_404(self):
+        secret = tempfile.NamedTemporaryFile(dir=os.path.dirname(self.root))
+        self.addCleanup(secret.close)
+        with self.assertRaises(Http404):
+            self.serve("../" + os.path.basename(secret.name))
+        with self.assertRaises(Http404):
+            self.serve("missing.txt")
+
+    def test_head_returns_headers_without_body(self):
+        response = self.client.head("/media/file.txt")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Length"], "1000")
+        self.assertIn("ETag", response)
+        self.assertEqual(b"".join(response.streaming_content), b"")
+        self.assertEqual(self.client.post("/media/file.txt").status_code, 405)
+
+    def test_picks_precompressed_variant(self):
+        text = b"body { color: red; }" * 50
+        self.write("style.css", text)
+        self.write("style.css.gz", gzip.compress(text))
+        self.write("style.css.br", b"brotli bytes")
+
+        response = self.serve("style.css", accept_encoding="gzip, deflate, br")
+        self.assertEqual(response["Content-Encoding"], "br")
+        self.assertEqual(b"".join(response.streaming_content), b"brotli bytes")
+        response = self.serve("style.css", accept_encoding="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(b"".join(response.streaming_content)), text)
+        response = self.serve("style.css")
+        self.assertNotIn("Content-Encoding", response)
+        self.assertEqual(b"".join(response.streaming_content), text)
+        self.assertIn("Accept-Encoding", response["Vary"])
+        self.assertEqual(self.serve("file.txt").get("Vary"), None)
+
+    def test_only_storage_names_are_immutable(self):
+        digest = hashlib.sha256(b"picture").hexdigest()
+        blob = "post-gallery/%s/%s.png" % (digest[:2], digest)
+        self.write(blob, b"picture")
+        self.write("post-gallery/report-2024010112345.png", b"picture")
+        self.write("post-gallery/%s.png" % digest, b"picture")  # Хеш, но не в своей подпапке
+
+        self.assertEqual(self.client.get("/media/" + blob)["Cache-Control"], "public, max-age=31536000, immutable")
+        for name in ("post-gallery/report-2024010112345.png", "post-gallery/%s.png" % digest):
+            self.assertEqual(self.client.get("/media/" + name)["Cache-Control"], "public, max-age=60")
+
+    def test_only_manifest_names_are_hashed_static(self):
+        manifest = {"css/site.css": "css/site.0123456789ab.css"}
+        with mock.patch.object(staticfiles_storage, "hashed_files", manifest, create=True):
+            self.assertTrue(is_manifest_name("css/site.0123456789ab.css"))
+            self.assertFalse(is_manifest_name("css/site.css"))
+            self.assertFalse(is_manifest_name("css/other.0123456789ab.css"))
+
+
+@mock.patch.object(ViewCounter, "_start_flusher")  # Без фонового потока, flush() вызываем сами
+class ViewCounterTests(TestCase):
+    def setUp(self):
+        self.counter = ViewCounter()
+        self.author = User.objects.create_superuser("author")
+        self.post = Post.objects.create(author=self.author, title="Пост", content="Текст")
+
+    def test_repeat_views_are_counted_once(self, _):
+        self.assertTrue(self.counter.record(self.post.pk, "u1"))
+        self.assertFalse(self.counter.record(self.post.pk, "u1"))
+        self.assertTrue(self.counter.record(self.post.pk, "u2"))
+        self.assertTrue(self.counter.record(self.post.pk + 1, "u1"))  # Другой пост
+        self.assertTrue(self.counter.record(self.post.pk))  # Без проверки на повтор
+        self.assertTrue(self.counter.record(self.post.pk))
+        self.assertEqual(self.counter.pending(self.post.pk), 4)
+
+    def test_seen_viewers_expire_after_two_generations(self, _):
+        now = [1000.0]
+        with mock.patch("app.viewcounts.time.monotonic", lambda: now[0]):
+            counter = ViewCounter()
+            self.assertTrue(counter.record(self.post.pk, "u1"))
+            now[0] += DEDUP_WINDOW + 1  # Текущее поколение стало прошлым, повтор все еще ловится
+            self.assertFalse(counter.record(self.post.pk, "u1"))
+            now[0] += DEDUP_WINDOW + 1  # Прошлое поколение выброшено
+            self.assertTrue(counter.record(self.post.pk, "u1"))
+        self.assertEqual(counter.pending(self.post.pk), 2)
+
+    def test_flush_adds_to_counter_and_is_not_clobbered_by_edits(self, _):
+        stale = Post.objects.get(pk=self.post.pk)  # Форма загрузила пост до записи просмотров
+        for viewer in ("u1", "u2", "u3"):
+            self.counter.record(self.post.pk, viewer)
+        Post.objects.filter(pk=self.post.pk).update(view_count=10)  # Записал другой процесс
+        self.assertEqual(self.counter.flush(), 1)
+        self.assertEqual(self.counter.flush(), 0)
+        self.assertEqual(Post.objects.get(pk=self.post.pk).view_count, 13)
+
+        form = PostForm({"title": "Новое название", "content": "Текст"}, instance=stale)
+        self.assertTrue(form.is_valid())
+        form.save()
+
+        request = RequestFactory().post("/")
+        request.user = self.author
+        post_admin = PostAdmin(Post, admin.site)
+        stale = Post.objects.get(pk=self.post.pk)
+        Post.objects.filter(pk=self.post.pk).update(view_count=F("view_count") + 1)
+        admin_form = post_admin.get_form(request, stale, change=True)(
+            {"title": "Из админки", "content": "Текст", "author": self.author.pk}, instance=stale
+        )
+        self.assertTrue(admin_form.is_valid(), admin_form.errors)
+        post_admin.save_model(request, admin_form.save(commit=False), admin_form, True)
+
+        post = Post.objects.get(pk=self.post.pk)
+        self.assertEqual((post.title, post.view_count), ("Из админки", 14))
+
+
+class FeedTests(TestCase):
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        for name, value in (("ROOT", root), ("SEGMENT_SIZE", 2)):
+            patcher = mock.patch.object(feeds, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.author = User.objects.create_user("author")
+
+    def post(self):
+        return Post.objects.create(author=self.author, title="Пост", content="Текст")
+
+    def segment_tasks(self):
+        return list(Task.objects.filter(name="app.feeds.build_sitemap_segment").values_list("dedup_key", "args"))
+
+    def test_build_sitemap_writes_segment_files_and_index(self):
+        posts = [self.post() for _ in range(5)]
+        posts[0].is_deleted = True
+        posts[0].save()
+        segments = {post.pk // 2 for post in posts[1:]}
+
+        self.assertEqual(feeds.build_sitemap(), len(segments))
+        for segment in segments:
+            with open(feeds.segment_path(segment), encoding="utf-8") as fh:
+                urls = fh.read()
+            for post in posts[1:]:
+                self.assertEqual(feeds.post_url(post.pk) in urls, post.pk // 2 == segment)
+        self.assertNotIn(feeds.post_url(posts[0].pk), urls)
+        with open(feeds.index_path(), encoding="utf-8") as fh:
+            index = fh.read()
+        self.assertEqual(index.count("<sitemap>"), len(segments))
+
+    def test_feed_returns_304_for_matching_etag(self):
+        self.post()
+        feeds.build_feeds()
+        response = self.client.get(reverse("feed", args=["rss"]))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"<rss", b"".join(response.streaming_content))
+        response = self.client.get(reverse("feed", args=["rss"]), headers={"if-none-match": response["ETag"]})
+        self.assertEqual(response.status_code, 304)
+
+    def test_missing_file_is_queued_not_built_in_request(self):
+        self.post()
+        Task.objects.all().delete()
+        for _ in range(2):
+            response = self.client.get(reverse("sitemap"))
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response["Retry-After"], str(feeds.RETRY_AFTER))
+        self.assertFalse(os.path.exists(feeds.index_path()))
+        self.assertEqual(Task.objects.filter(dedup_key="sitemap").count(), 1)
+        run_tasks()
+        self.assertEqual(self.client.get(reverse("sitemap")).status_code, 200)
+        self.assertEqual(self.client.get(reverse("author-feed", args=[self.author.pk + 100, "rss"])).status_code, 404)
+
+    def test_post_save_queues_one_rebuild_per_segment(self):
+        first = self.post()
+        first.title = "Новое название"
+        first.save()
+        second = self.post()
+        segments = {pk // 2 for pk in (first.pk, second.pk)}
+        self.assertCountEqual(self.segment_tasks(), [("sitemap:%s" % segment, [segment]) for segment in segments])
+        self.assertEqual(Task.objects.filter(dedup_key="feeds").count(), 1)
+        self.assertEqual(Task.objects.filter(dedup_key="feeds:%s" % self.author.pk).count(), 1)
+
+
+class ProfilerTests(TestCase):
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        patcher = mock.patch.object(profiler, "ROOT", root)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def slow_request(self, token):
+        def view(request):
+            time.sleep(0.1)  # Сэмплер успевает снять стеки
+            return HttpResponse("ok")
+
+        request = RequestFactory().get("/posts/", headers={"x-profile": token})
+        return profiler.ProfilerMiddleware(view)(request)
+
+    def test_unsigned_or_forged_header_is_ignored(self):
+        name = profiler.new_profile_name("request")
+        for token in (name, signing.dumps(name, salt="other"), profiler.make_token()[0] + "x"):
+            self.assertNotIn("X-Profile-Name", self.slow_request(token))
+        self.assertEqual(profiler.profile_names(), [])
+
+    def test_signed_token_writes_collapsed_profile(self):
+        token, name = profiler.make_token()
+        response = self.slow_request(token)
+        self.assertEqual(response["X-Profile-Name"], name)
+        self.assertEqual(profiler.profile_names(), [name])
+        files = os.listdir(os.path.join(profiler.ROOT, name))
+        self.assertTrue(files and all(filename.endswith(".collapsed") for filename in files))
+        stacks = profiler.load(name)
+        self.assertGreater(sum(stacks.values()), 0)
+        self.assertTrue(all(stack.startswith("view;GET posts/;") for stack in stacks))
+
+    def test_staff_views_redirect_anonymous_and_regular_users(self):
+        urls = [reverse("profiler"), reverse("profiler-download", args=["run-x", "collapsed"])]
+        for url in urls:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 302)
+            self.assertIn(reverse("admin:login"), response["Location"])
+        self.client.force_login(User.objects.create_user("user"))
+        for url in urls:
+            self.assertEqual(self.client.get(url).status_code, 302)
+        self.assertEqual(self.client.post(reverse("profiler"), {"action": "start"}).status_code, 302)
+        self.assertIsNone(profiler.active_run())
+
+        self.client.force_login(User.objects.create_user("staff", is_staff=True))
+        self.assertEqual(self.client.get(urls[0]).status_code, 200)
+        self.assertEqual(self.client.get(urls[1]).status_code, 404)
+
+
+class RateLimitTests(TransactionTestCase):
+    databases = {"default", "archive"}  # Лайк возвращает реакции из архива
+
+    def setUp(self):
+        patcher = mock.patch.dict(ratelimit.RULES, {"like": ("3/m", "user")})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = User.objects.create_user("fan")
+        self.post = Post.objects.create(author=self.user, title="Пост", content="Текст")
+        self.like_url = reverse("like", args=[self.post.pk])
+
+    def logged_in(self, client):
+        client.force_login(self.user)
+        client.get(reverse("profile"))  # Кука увидена с пользователем - дальше лимит по сессии
+        return client
+
+    def like(self, client, count):
+        return [client.post(self.like_url).status_code for _ in range(count)]
+
+    def test_exhausted_bucket_returns_429_with_retry_after(self):
+        client = self.logged_in(self.client)
+        self.assertNotIn(429, self.like(client, 3))
+        response = client.post(self.like_url)
+        self.assertEqual(response.status_code, 429)
+        self.assertIn(int(response["Retry-After"]), (20, 21))  # 3 жетона в минуту: следующий через ~20 с
+        self.assertEqual(Like.objects.count(), 1)  # Лайк, снятие, лайк - четвертый запрос до view не дошел
+
+    def test_sessions_and_addresses_have_separate_buckets(self):
+        anonymous = Client()
+        self.assertEqual(self.like(anonymous, 4)[-1], 429)  # Ведро адреса пустое
+        # Выдуманная кука не дает нового ведра, считается по адресу
+        anonymous.cookies[settings.SESSION_COOKIE_NAME] = "made-up"
+        self.assertEqual(self.like(anonymous, 1), [429])
+        # Настоящая сессия с того же адреса считается отдельно
+        self.assertNotIn(429, self.like(self.logged_in(Client()), 3))
+
+    def test_register_has_stricter_limit_by_address(self):
+        rate, scope = ratelimit.RULES["register"]
+        self.assertEqual(scope, "ip")
+        capacity, _ = ratelimit.parse_rate(rate)
+        statuses = [self.client.post(reverse("register"), {"username": ""}).status_code for _ in range(capacity + 1)]
+        self.assertEqual(statuses, [200] * capacity + [429])
+        self.assertNotEqual(self.client.post(self.like_url).status_code, 429)  # Другие маршруты не задеты
+
+    def test_429_is_returned_before_csrf_check(self):
+        client = self.logged_in(Client(enforce_csrf_checks=True))
+        self.assertEqual(self.like(client, 4), [403, 403, 403, 429])
@@ -0,0 +1,180 @@
+import hashlib
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, SkipFile, StopUpload
+
+from app.blobs import register_blob
+from app.images import EXTENSIONS, SNIFF_SIZE, sniff_image_type
+from app.storage import ContentAddressedStorage, select_media_storage, staging_dir
+
+# Максимальный размер одной картинки и всего запроса (байты)
+MAX_FILE_SIZE = getattr(settings, "UPLOAD_MAX_FILE_SIZE", 10 * 1024 * 1024)
+MAX_REQUEST_SIZE = getattr(settings, "UPLOAD_MAX_REQUEST_SIZE", 50 * 1024 * 1024)
+# Сколько файлов можно прислать одним запросом
+MAX_FILES = getattr(settings, "UPLOAD_MAX_FILES", 10)
+
+
+class StoredUploadedFile(UploadedFile):
+    """
+    Загруженный файл во временном .upload в staging_dir() (вне MEDIA_ROOT), уже с итоговым именем
+    stored_name. В хранилище попадает только после commit() (переименование, копия только если
+    временная папка на другом диске), ContentAddressedStorage._save видит stored_name и ничего не копирует.
+    Если commit() так и не вызвали (CSRF, ошибки формы) - close() удаляет временный файл
+    """
+
+    def __init__(self, path, storage, stored_name, name, content_type, size):
+        super().__init__(open(path, "rb"), name, content_type, size)
+        self.path = path
+        self.storage = storage
+        self.stored_name = stored_name
+        self.committed = False
+
+    def temporary_file_path(self):
+        # ImageField проверяет картинку по пути, не читая ее в память
+        return self.path
+
+    def commit(self):
+        """
+        Переносит файл в хранилище и учитывает его в Blob
+        """
+        if self.committed:
+            return
+        self.storage.move_into_place(self.path, self.stored_name)
+        self.path = self.storage.path(self.stored_name)
+        self.committed = True
+        # Если пост так и не сохранят - файл уберет gc_media
+        register_blob(self.stored_name, self.size)
+
+    def close(self):
+        super().close()
+        if not self.committed and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class StreamingImageUploadHandler(FileUploadHandler):
+    """
+    Пишет загружаемые картинки по чанкам во временные файлы в staging_dir() (вне MEDIA_ROOT,
+    их нельзя скачать), попутно считая sha256. В хранилище их переносит
+    commit_uploads, когда CSRF и форма проверены. По первым байтам проверяет что это картинка,
+    лимиты размера проверяет на лету: плохой файл пропускается (SkipFile),
+    слишком большой запрос обрывается (StopUpload). В памяти только текущий чанк.
+
+    Ошибки складываются в request.upload_errors: {имя поля: текст}, None - весь запрос
+    """
+
+    def __init__(self, request, storage=None, upload_to=None):
+        super().__init__(request)
+        self.storage = storage or select_media_storage()
+        self.upload_to = (upload_to or "").strip("/")
+        self.errors = {}
+        request.upload_errors = self.errors
+        self.request_size = 0
+        self.file_count = 0
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.file_count += 1
+        if self.file_count > MAX_FILES:
+            self.errors[None] = "Можно загрузить не больше %d файлов за раз" % MAX_FILES
+            raise StopUpload(connection_reset=True)
+        fd, self.tmp_path = tempfile.mkstemp(suffix=".upload", dir=staging_dir())
+        self.file = os.fdopen(fd, "wb")
+        self.digest = hashlib.sha256()
+        self.head = b""
+        self.image_type = None
+
+    def receive_data_chunk(self, raw_data, start):
+        self.request_size += len(raw_data)
+        if self.request_size > MAX_REQUEST_SIZE:
+            self._discard()
+            self.errors[None] = self._too_large_message()
+            raise StopUpload(connection_reset=True)
+        if start + len(raw_data) > MAX_FILE_SIZE:
+            self._reject("Файл больше %d МБ" % (MAX_FILE_SIZE // (1024 * 1024)))
+        if self.image_type is None:
+            # Первый чанк почти всегда длиннее SNIFF_SIZE, но на всякий случай докапливаем
+            self.head = (self.head + raw_data)[:SNIFF_SIZE]
+            if len(self.head) >= SNIFF_SIZE:
+                self._sniff()
+        self.digest.update(raw_data)
+        self.file.write(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        if self.image_type is None:
+            try:
+                self._sniff()
+            except SkipFile:  # Файл короче SNIFF_SIZE
+                return None
+        self.__dict__.pop("file").close()
+        stored_name = self.storage.blob_name(self.upload_to, self.digest.hexdigest(), EXTENSIONS[self.image_type])
+        return StoredUploadedFile(
+            self.tmp_path, self.storage, stored_name, self.file_name, self.image_type, file_size
+        )
+
+    def upload_interrupted(self):
+        self._discard()
+
+    def _sniff(self):
+        self.image_type = sniff_image_type(self.head)
+        if self.image_type is None:
+            self._reject("Файл не является картинкой (JPEG, PNG, GIF, WebP)")
+
+    def _reject(self, message):
+        self.errors[self.field_name] = message
+        self._discard()
+        raise SkipFile()
+
+    def _discard(self):
+        # Атрибут file удаляем: парсер закрывает handler.file если он есть
+        file = self.__dict__.pop("file", None)
+        if file is not None:
+            file.close()
+            if os.path.exists(self.tmp_path):
+                os.remove(self.tmp_path)
+
+    @staticmethod
+    def _too_large_message():
+        return "Все файлы вместе больше %d МБ" % (MAX_REQUEST_SIZE // (1024 * 1024))
+
+
+def streaming_upload_handlers(request, upload_to=None):
+    """
+    Обработчики загрузки для request.upload_handlers. Писать сразу в хранилище
+    умеем только для ContentAddressedStorage, иначе оставляем стандартные
+    """
+    storage = select_media_storage()
+    if not isinstance(storage, ContentAddressedStorage):
+        request.upload_errors = {}
+        return request.upload_handlers
+    return [StreamingImageUploadHandler(request, storage, upload_to)]
+
+
+def commit_uploads(files):
+    """
+    Переносит загруженные файлы в хранилище. Вызывать только после проверки
+    CSRF и формы, иначе чужой сайт сможет складывать файлы в публичное хранилище
+    :param files: request.FILES
+    """
+    for _, uploaded in files.lists():
+        for file in uploaded:
+            if isinstance(file, StoredUploadedFile):
+                file.commit()
+
+
+def apply_upload_errors(request, form, formset, file_field="file"):
+    """
+    Переносит ошибки загрузки в формы
+    :return: Были ли ошибки
+    """
+    errors = getattr(request, "upload_errors", None) or {}
+    if None in errors:
+        form.add_error(None, errors[None])
+    for media_form in formset.forms:
+        message = errors.get(media_form.add_prefix(file_field))
+        if message:
+            media_form.add_error(file_field, message)
+    return bool(errors)
@@ -2,7 +2,8 @@ from django.urls import path, reverse_lazy
 from django.contrib.auth.views import LogoutView, PasswordChangeView
 from app.views import IndexView, CustomLoginView, register, PostListView, PostDetailView, PostDeleteView, \
     PostCreateView, PostUpdateView, like_post, dislike_post, create_comment, create_report, ReportListView, \
-    UserUpdateView, UserPostListView, profile_view
+    UserUpdateView, UserPostListView, profile_view, image_proxy, feed, author_feed, sitemap_index, \
+    sitemap_segment, profiler_view, profiler_download
 
 urlpatterns = [
     path("", IndexView.as_view(), name="index"),  # Главная Страница
@@ -31,5 +32,18 @@ urlpatterns = [
 
     # Жалобы
     path("posts/<int:post_id>/report", create_report, name="create-report"),
-    path("reports/", ReportListView.as_view(), name="report-list")
+    path("reports/", ReportListView.as_view(), name="report-list"),
+
+    # Прокси для внешних картинок
+    path("img/<str:token>", image_proxy, name="image-proxy"),
+
+    # RSS/Atom ленты и карта сайта
+    path("feeds/<str:kind>.xml", feed, name="feed"),
+    path("feeds/authors/<int:author_id>/<str:kind>.xml", author_feed, name="author-feed"),
+    path("sitemap.xml", sitemap_index, name="sitemap"),
+    path("sitemap-<int:segment>.xml", sitemap_segment, name="sitemap-segment"),
+
+    # Профилировщик (только staff)
+    path("staff/profiler/", profiler_view, name="profiler"),
+    path("staff/profiler/<str:name>.<str:fmt>", profiler_download, name="profiler-download"),
 ]
@@ -0,0 +1,161 @@
+import atexit
+import hashlib
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Case, F, Value, When
+
+from app.models import Post
+
+logger = logging.getLogger(__name__)
+
+# Как часто сбрасывать накопленные просмотры в базу (секунды)
+FLUSH_INTERVAL = getattr(settings, "VIEW_COUNTER_FLUSH_INTERVAL", 30)
+# Повторный просмотр одним и тем же: "user" (пользователь/сессия/IP), "session", None - считать все
+DEDUP = getattr(settings, "VIEW_COUNTER_DEDUP", "user")
+# Сколько секунд помним кто уже смотрел пост
+DEDUP_WINDOW = getattr(settings, "VIEW_COUNTER_DEDUP_WINDOW", 60 * 60)
+# Размер фильтра Блума в битах (2**20 бит = 128 КБ) и кол-во хешей
+BLOOM_BITS = getattr(settings, "VIEW_COUNTER_BLOOM_BITS", 1 << 20)
+BLOOM_HASHES = 4
+# Сколько постов обновляем одним UPDATE
+FLUSH_BATCH = 500
+
+
+class BloomFilter:
+    """
+    Компактное вероятностное множество: может ошибочно сказать "уже было"
+    (просмотр не засчитается), но никогда не пропустит повтор
+    """
+
+    def __init__(self, bits=BLOOM_BITS, hashes=BLOOM_HASHES):
+        self.bits = bits
+        self.hashes = hashes
+        self.array = bytearray((bits + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        # Двойное хеширование: k позиций из двух хешей
+        return [(first + i * second) % self.bits for i in range(self.hashes)]
+
+    def __contains__(self, key):
+        return all(self.array[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.array[pos >> 3] |= 1 << (pos & 7)
+
+
+class ViewCounter:
+    """
+    Считает просмотры постов в памяти процесса и раз в FLUSH_INTERVAL секунд
+    записывает накопленное в Post.view_count одной транзакцией,
+    вместо UPDATE на каждый просмотр
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = defaultdict(int)
+        # Два поколения фильтра: текущее и прошлое, так повтор ловится минимум DEDUP_WINDOW секунд
+        self._seen = BloomFilter()
+        self._seen_previous = BloomFilter()
+        self._rotated_at = time.monotonic()
+        self._flusher = None
+
+    def record(self, post_id, viewer=None):
+        """
+        Засчитывает просмотр
+        :param post_id: pk поста
+        :param viewer: Кто смотрит (см. viewer_key), None - без проверки на повтор
+        :return: Засчитан ли просмотр
+        """
+        with self._lock:
+            if viewer is not None:
+                if time.monotonic() - self._rotated_at > DEDUP_WINDOW:
+                    self._seen_previous, self._seen = self._seen, BloomFilter()
+                    self._rotated_at = time.monotonic()
+                key = "%s:%s" % (post_id, viewer)
+                if key in self._seen or key in self._seen_previous:
+                    return False
+                self._seen.add(key)
+            self._pending[post_id] += 1
+            if self._flusher is None:
+                self._start_flusher()
+        return True
+
+    def pending(self, post_id):
+        """
+        Сколько просмотров еще не записано в базу
+        """
+        with self._lock:
+            return self._pending.get(post_id, 0)
+
+    def flush(self):
+        """
+        Записывает накопленные просмотры в базу
+        :return: Сколько постов обновлено
+        """
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(int)
+        if not pending:
+            return 0
+        items = list(pending.items())
+        try:
+            with transaction.atomic():
+                for start in range(0, len(items), FLUSH_BATCH):
+                    batch = items[start:start + FLUSH_BATCH]
+                    # Один UPDATE на всю пачку: view_count = view_count + CASE id WHEN ... END
+                    Post.objects.filter(pk__in=[pk for pk, _ in batch]).update(
+                        view_count=F("view_count") + Case(
+                            *[When(pk=pk, then=Value(delta)) for pk, delta in batch],
+                            default=Value(0),
+                        )
+                    )
+        except Exception:
+            # Не потеряли: вернем обратно и попробуем в следующий раз
+            with self._lock:
+                for pk, delta in items:
+                    self._pending[pk] += delta
+            raise
+        return len(items)
+
+    def _start_flusher(self):
+        self._flusher = threading.Thread(target=self._flush_loop, name="view-counter", daemon=True)
+        self._flusher.start()
+        atexit.register(self._flush_quietly)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            self._flush_quietly()
+            connection.close()
+
+    def _flush_quietly(self):
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Не удалось записать просмотры")
+
+
+def viewer_key(request):
+    """
+    Кто смотрит пост, для проверки повторных просмотров
+    :return: Строка либо None если повторы не проверяем
+    """
+    if DEDUP is None:
+        return None
+    if DEDUP == "user" and request.user.is_authenticated:
+        return "u%s" % request.user.pk
+    session_key = request.session.session_key
+    if session_key:
+        return "s%s" % session_key
+    return "ip%s" % request.META.get("REMOTE_ADDR", "")
+
+
+view_counter = ViewCounter()
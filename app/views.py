@@ -1,12 +1,29 @@
+import os
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
+from django.core import signing
+from django.http import Http404, HttpResponse
 from django.shortcuts import render, redirect, get_object_or_404
 from django.urls import reverse_lazy
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from django.views.decorators.http import require_safe
 from django.views.generic import ListView, CreateView, UpdateView, DetailView, DeleteView
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.contrib.auth.views import LoginView
 from django.contrib.auth.models import User
-from app.models import Post, DisLike, Like, Report
+from app.models import Post, DisLike, Like, Media, Report, UserStats
+from app import feeds, profiler
+from app.archive import restore_reactions
 from app.forms import PostForm, CustomUserCreationForm, CommentForm, ReportForm, UserChangeForm, MediaFormSet
+from app.image_proxy import ImageProxyError, get_image, load_token, option as image_proxy_option
+from app.purge import schedule_post_deletion
+from app.serving import MEDIA_ACCEL_PREFIX, STATIC_ACCEL_PREFIX, is_blob_name, is_manifest_name, serve_file
+from app.stats import rebuild_user_stats
+from app.uploads import apply_upload_errors, commit_uploads, streaming_upload_handlers
+from app.viewcounts import view_counter, viewer_key
 
 
 # TODO: Сделать Страницу Главную Index
@@ -16,6 +33,8 @@ class IndexView(ListView):
     """
     # Для подключения Модели
     model = Post
+    # Удаленные посты не показываем
+    queryset = Post.objects.visible()
     # Устанавливаем Шаблон HTML
     template_name = "app/index.html"
     # Имя переменной в Шаблоне
@@ -52,18 +71,35 @@ class PostCreateView(LoginRequiredMixin, CreateView):
         context["media_formset"] = kwargs.get("media_formset") or MediaFormSet()
         return context
 
-    # Так как используем FormSet нам придется вручную сохранять
+    # CSRF проверяем сами в _post: middleware читает request.POST,
+    # а обработчики загрузки нужно поставить до первого чтения тела
+    @method_decorator(csrf_exempt)
+    def dispatch(self, request, *args, **kwargs):
+        return super().dispatch(request, *args, **kwargs)
+
     def post(self, request, *args, **kwargs):
+        # Картинки пишутся по чанкам во временные файлы, плохие отсекаются на лету
+        request.upload_handlers = streaming_upload_handlers(request, Media.file.field.upload_to)
+        return self._post(request, *args, **kwargs)
+
+    # Так как используем FormSet нам придется вручную сохранять
+    @method_decorator(csrf_protect)
+    def _post(self, request, *args, **kwargs):
+        self.object = None  # Как в CreateView.post, нужно для get_context_data
         form = self.get_form()  # Получаем заполненую Форму поста
         media_formset = MediaFormSet(request.POST, request.FILES)  # Получаем заполненый медиа
 
         # Проверяем Правильно ли заполненые формы
-        if form.is_valid() and media_formset.is_valid():
+        form_valid = form.is_valid()
+        formset_valid = media_formset.is_valid()
+        upload_failed = apply_upload_errors(request, form, media_formset)  # Пропущенные файлы
+        if form_valid and formset_valid and not upload_failed:
             post = form.save(commit=False)
             post.author = self.request.user  # Добавляем автора созданного поста
             post.save()
 
             media_formset.instance = post  # вставляем пост для которого медиа заполнели
+            commit_uploads(request.FILES)  # Только теперь картинки попадают в хранилище
             media_formset.save()  # Сохраняем медиа
 
             return redirect("index")  # После успеха отправляем на главную страницу
@@ -79,6 +115,8 @@ class PostListView(ListView):
     """
     # Для подключения Модели
     model = Post
+    # Удаленные посты не показываем
+    queryset = Post.objects.visible()
     # Устанавливаем Шаблон HTML
     template_name = "app/post_list.html"
     # Имя переменной в Шаблоне
@@ -96,17 +134,29 @@ class PostDetailView(DetailView):
     """
     # Моделька
     model = Post
+    queryset = Post.objects.visible()
     # Шаблон HTML
     template_name = "app/post_detail.html"
     # Имя Переменной в Шаблон
     context_object_name = "post"
 
+    def get(self, request, *args, **kwargs):
+        response = super().get(request, *args, **kwargs)
+        # Просмотр копится в памяти, в базу уходит пачкой раз в VIEW_COUNTER_FLUSH_INTERVAL
+        view_counter.record(self.object.pk, viewer_key(request))
+        return response
+
     def get_context_data(self, **kwargs):
         """
         Помогает засунуть доп переменные
         """
         context = super().get_context_data(**kwargs)
         context["comment_form"] = CommentForm()  # Мы добавили переменную comment_form
+        # Похожие посты посчитаны заранее (build_related), тут один запрос
+        context["related_posts"] = [
+            link.related for link in
+            self.object.related_links.filter(related__is_deleted=False).select_related("related").order_by("rank")
+        ]
         context["post_test"] = "Тестовое"
         return context
 
@@ -114,6 +164,7 @@ class PostDetailView(DetailView):
 # TODO: Сделать Страницу Изменение Поста
 class PostUpdateView(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
     model = Post
+    queryset = Post.objects.visible()
     template_name = "app/post_form.html"
     form_class = PostForm
 
@@ -133,9 +184,18 @@ class PostUpdateView(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
 # TODO: Сделать Страницу Подтверждение Удаления
 class PostDeleteView(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
     model = Post
+    queryset = Post.objects.visible()
     template_name = "app/post_delete.html"
     success_url = reverse_lazy("post-list")
 
+    def form_valid(self, form):
+        """
+        Пост скрываем сразу, а лайки, комменты, жалобы и медиа удаляются в фоне,
+        иначе каскадное удаление популярного поста не успевает за время запроса
+        """
+        schedule_post_deletion(self.object)
+        return redirect(self.get_success_url())
+
     def test_func(self):
         """
         Проверка того что пользователь является автором удаляемого поста
@@ -177,7 +237,8 @@ class CustomLoginView(LoginView):
 @login_required
 def like_post(request, post_id):
     if request.method == "POST":
-        post = get_object_or_404(Post, pk=post_id)
+        post = get_object_or_404(Post.objects.visible(), pk=post_id)
+        restore_reactions(post, request.user.pk)  # Реакция на старый пост могла уехать в архив
 
         # Удаление Дизлайка
         DisLike.objects.filter(post=post, user=request.user).delete()
@@ -193,7 +254,8 @@ def like_post(request, post_id):
 @login_required
 def dislike_post(request, post_id):
     if request.method == "POST":
-        post = get_object_or_404(Post, pk=post_id)
+        post = get_object_or_404(Post.objects.visible(), pk=post_id)
+        restore_reactions(post, request.user.pk)  # Реакция на старый пост могла уехать в архив
 
         # Удаление Лайк
         Like.objects.filter(post=post, user=request.user).delete()
@@ -209,7 +271,7 @@ def dislike_post(request, post_id):
 @login_required
 def create_comment(request, post_id):
     if request.method == "POST":
-        post = get_object_or_404(Post, pk=post_id)
+        post = get_object_or_404(Post.objects.visible(), pk=post_id)
         form = CommentForm(request.POST)
         if form.is_valid():
             comment = form.save(commit=False)
@@ -232,7 +294,7 @@ def about_us(request):
 # TODO: Создание Жалоб
 @login_required
 def create_report(request, post_id):
-    post = get_object_or_404(Post, pk=post_id)
+    post = get_object_or_404(Post.objects.visible(), pk=post_id)
     # Когда человек заполнил форму
     if request.method == "POST":
         form = ReportForm(request.POST)
@@ -276,13 +338,27 @@ class ReportListView(LoginRequiredMixin, ListView):
         return Report.objects.filter(user=self.request.user)
 
 
+def get_user_stats(user):
+    """
+    Статистика пользователя одним запросом по первичному ключу.
+    Строки еще нет (пользователь появился раньше таблицы) - считаем ее сейчас
+    """
+    stats = UserStats.objects.filter(pk=user.pk).first()
+    if stats is None:
+        rebuild_user_stats(user.pk)
+        stats = UserStats.objects.filter(pk=user.pk).first() or UserStats(user=user)
+    return stats
+
+
 # Профиль
 @login_required
 def profile_view(request):
     return render(
         request,
         "app/profile.html",
-
+        {
+            "stats": get_user_stats(request.user)
+        }
     )
 
 
@@ -295,6 +371,146 @@ class UserUpdateView(UpdateView):
     model = User
 
 
-class UserPostListView(PostListView):
+class UserPostListView(LoginRequiredMixin, PostListView):
     def get_queryset(self):
-        return Post.objects.filter(author=self.request.user)
+        return Post.objects.visible().filter(author=self.request.user).order_by(*self.ordering)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["stats"] = get_user_stats(self.request.user)
+        return context
+
+
+# Раздача загруженных файлов (media/post-gallery/...)
+@require_safe
+def serve_media(request, path):
+    return serve_file(request, path, root=settings.MEDIA_ROOT, accel_prefix=MEDIA_ACCEL_PREFIX,
+                      immutable=is_blob_name(path))
+
+
+# Раздача собранной статики (после collectstatic)
+@require_safe
+def serve_static(request, path):
+    return serve_file(request, path, root=settings.STATIC_ROOT, accel_prefix=STATIC_ACCEL_PREFIX,
+                      immutable=is_manifest_name(path))
+
+
+# Внешние картинки (Media.url) через локальный кеш
+@require_safe
+def image_proxy(request, token):
+    try:
+        url, width = load_token(token)
+    except signing.BadSignature:
+        raise Http404("Картинка не найдена")
+    try:
+        path, content_type = get_image(url, width)
+    except ImageProxyError:
+        return HttpResponse("Не удалось загрузить картинку", status=502, content_type="text/plain; charset=utf-8")
+    return serve_file(request, path, content_type=content_type, max_age=image_proxy_option("TTL"))
+
+
+# Ленты и карта сайта: отдаем готовые файлы (ETag/Last-Modified, 304)
+@require_safe
+def feed(request, kind):
+    if kind not in feeds.FEED_CLASSES:
+        raise Http404("Лента не найдена")
+    return serve_feed_file(request, feeds.feed_path(kind), kind, feeds.build_feeds, dedup_key="feeds")
+
+
+@require_safe
+def author_feed(request, author_id, kind):
+    if kind not in feeds.FEED_CLASSES:
+        raise Http404("Лента не найдена")
+    path = feeds.feed_path(kind, author_id)
+    if not os.path.exists(path) and not User.objects.filter(pk=author_id, is_active=True).exists():
+        raise Http404("Лента не найдена")
+    return serve_feed_file(request, path, kind, feeds.build_feeds, author_id, dedup_key="feeds:%s" % author_id)
+
+
+@require_safe
+def sitemap_index(request):
+    return serve_feed_file(request, feeds.index_path(), "sitemap", feeds.build_sitemap, dedup_key="sitemap")
+
+
+@require_safe
+def sitemap_segment(request, segment):
+    path = feeds.segment_path(segment)
+    if not os.path.exists(path):
+        start = segment * feeds.SEGMENT_SIZE
+        if not Post.objects.visible().filter(pk__gte=start, pk__lt=start + feeds.SEGMENT_SIZE).exists():
+            raise Http404("Сегмент не найден")
+    return serve_feed_file(request, path, "sitemap", feeds.build_sitemap_segment, segment,
+                           dedup_key="sitemap:%s" % segment)
+
+
+def serve_feed_file(request, path, kind, build, *args, dedup_key):
+    """
+    Отдает готовый файл ленты/карты сайта. Если его еще нет, сборку ставим в очередь,
+    а не делаем в запросе (индекс карты сайта - это проход по всем постам),
+    клиент получает 503 с Retry-After. Роботы и читалки лент такой ответ повторяют
+    :param build: Задача которая соберет файл, args - ее аргументы
+    """
+    if not os.path.exists(path):
+        build.enqueue(*args, dedup_key=dedup_key)
+        if not os.path.exists(path):  # При TASK_QUEUE_EAGER файл уже собран
+            response = HttpResponse("Файл еще собирается, повторите позже", status=503,
+                                    content_type="text/plain; charset=utf-8")
+            response["Retry-After"] = str(feeds.RETRY_AFTER)
+            return response
+    return serve_file(request, path, content_type=feeds.CONTENT_TYPES[kind], max_age=feeds.MAX_AGE)
+
+
+# Профилировщик для staff: запуск на N секунд для всех процессов,
+# токен X-Profile для одного запроса, скачивание профилей
+@staff_member_required
+def profiler_view(request):
+    token = None
+    if request.method == "POST":
+        action = request.POST.get("action")
+        if action == "start":
+            try:
+                seconds = int(request.POST.get("seconds", 30))
+            except ValueError:
+                seconds = 30
+            profiler.start(seconds)
+        elif action == "stop":
+            profiler.stop()
+        elif action == "token":
+            token, _ = profiler.make_token()
+        elif action == "delete":
+            profiler.delete(request.POST.get("name", ""))
+        if token is None:
+            return redirect("profiler")
+    profiles = []
+    for name in profiler.profile_names():
+        stacks = profiler.load(name)
+        profiles.append({
+            "name": name,
+            "samples": sum(stacks.values()),
+            "categories": profiler.category_totals(stacks),
+        })
+    return render(request, "app/profiler.html", {
+        "profiles": profiles,
+        "run": profiler.active_run(),
+        "token": token,
+        "max_seconds": profiler.MAX_SECONDS,
+    })
+
+
+@staff_member_required
+@require_safe
+def profiler_download(request, name, fmt):
+    stacks = profiler.load(name)
+    if not stacks:
+        raise Http404("Профиль не найден")
+    if fmt == "collapsed":
+        response = HttpResponse(profiler.collapsed(stacks), content_type="text/plain; charset=utf-8")
+        response["Content-Disposition"] = 'attachment; filename="%s.collapsed"' % name
+        return response
+    if fmt == "html":
+        return render(request, "app/profiler_flamegraph.html", {
+            "name": name,
+            "tree": profiler.tree(stacks),
+            "categories": profiler.category_totals(stacks),
+        })
+    raise Http404("Неизвестный формат")
@@ -42,9 +42,11 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'app.profiler.ProfilerMiddleware',  # Первой: в профиль попадают все остальные middleware
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
+    'app.ratelimit.RateLimitMiddleware',  # До CSRF: отсекаем лишнее до чтения тела запроса
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
@@ -79,8 +81,30 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+        # Воркеры и запросы пишут параллельно: WAL не блокирует чтение на время записи,
+        # IMMEDIATE берет блокировку записи сразу и ждет ее до timeout вместо ошибки "database is locked"
+        'OPTIONS': {
+            'timeout': 20,
+            'transaction_mode': 'IMMEDIATE',
+            'init_command': 'PRAGMA journal_mode=WAL;',
+        },
+        # Тестовый архив создается первым, чтобы основная база подключала (ATTACH) его, а не настоящий файл
+        'TEST': {'DEPENDENCIES': ['archive']},
+    },
+    # Архив лайков и комментов старых постов (см. app/archive.py), основная база остается маленькой.
+    # Таблицы: python manage.py migrate --database archive, перенос: python manage.py archive_old
+    'archive': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'archive.sqlite3',
+        'OPTIONS': {
+            'timeout': 20,
+            'init_command': 'PRAGMA journal_mode=WAL;',
+        },
+        'TEST': {'DEPENDENCIES': []},
+    },
 }
+DATABASE_ROUTERS = ['app.archive.ArchiveRouter']
+TEST_RUNNER = 'app.testrunner.TestRunner'  # Тестовый архив создается вместе с основной тестовой базой
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -115,9 +139,115 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/5.2/howto/static-files/
 
 STATIC_URL = 'static/'
+STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')  # Сюда собирает collectstatic
 MEDIA_URL = 'media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+STORAGES = {
+    "default": {
+        "BACKEND": "django.core.files.storage.FileSystemStorage",
+    },
+    # Загрузки Media.file: имя = sha256 содержимого, дубликаты не хранятся
+    "media": {
+        "BACKEND": "app.storage.ContentAddressedStorage",
+    },
+    # Имена с хешем + .gz/.br варианты рядом с каждым файлом
+    "staticfiles": {
+        "BACKEND": "app.storage.PrecompressedManifestStaticFilesStorage",
+    },
+}
+
+# Раздача медиа и статики:
+# "django" - отдает сам воркер (Range, ETag, 304)
+# "sendfile" - заголовок X-Sendfile для Apache/lighttpd
+# "accel" - заголовок X-Accel-Redirect для nginx, у media и static свои internal location
+#           (alias на MEDIA_ROOT и STATIC_ROOT). Файлы вне этих папок (кеш картинок, ленты) отдает воркер
+FILE_SERVE_MODE = "django"
+FILE_ACCEL_MEDIA_PREFIX = "/protected/media/"
+FILE_ACCEL_STATIC_PREFIX = "/protected/static/"
+FILE_IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60  # Для имен с хешем содержимого
+FILE_DEFAULT_MAX_AGE = 60  # Для остальных, дальше проверка по ETag
+
+# Загрузка картинок постов: пишутся по чанкам во временную папку, лимиты проверяются на лету,
+# в хранилище переносятся после проверки CSRF и формы. Папка вне MEDIA_ROOT (недописанные файлы
+# нельзя скачать), на том же диске - перенос без копирования
+UPLOAD_STAGING_DIR = os.path.join(BASE_DIR, 'cache', 'uploads')
+UPLOAD_MAX_FILE_SIZE = 10 * 1024 * 1024
+UPLOAD_MAX_REQUEST_SIZE = 50 * 1024 * 1024
+UPLOAD_MAX_FILES = 10
+
+# Прокси для внешних картинок (Media.url): скачиваем один раз и храним на диске
+IMAGE_PROXY_ENABLED = True
+IMAGE_PROXY_CACHE_DIR = os.path.join(BASE_DIR, 'cache', 'images')
+IMAGE_PROXY_MAX_CACHE_BYTES = 256 * 1024 * 1024  # Дальше вытесняем давно не использованные
+IMAGE_PROXY_TTL = 7 * 24 * 60 * 60  # Через сколько секунд скачать заново
+IMAGE_PROXY_TIMEOUT = 5
+IMAGE_PROXY_MAX_IMAGE_BYTES = 10 * 1024 * 1024
+IMAGE_PROXY_MAX_WIDTH = 2000
+IMAGE_PROXY_FAILURE_TTL = 5 * 60  # Неудачную загрузку не повторяем столько секунд
+IMAGE_PROXY_ALLOW_PRIVATE = False  # True только для тестов с локальным сервером
+
+# Фоновое удаление постов и пользователей: порции по PURGE_CHUNK_SIZE строк
+PURGE_CHUNK_SIZE = 500
+PURGE_CHUNK_PAUSE = 0.05  # Секунды между порциями
+
+# Счетчик просмотров: копится в памяти процесса и раз в N секунд пишется в базу пачкой
+VIEW_COUNTER_FLUSH_INTERVAL = 30
+VIEW_COUNTER_DEDUP = "user"  # "user" | "session" | None - повторные просмотры не считаем
+VIEW_COUNTER_DEDUP_WINDOW = 60 * 60  # Сколько секунд помним кто смотрел
+VIEW_COUNTER_BLOOM_BITS = 1 << 20  # Размер фильтра Блума (128 КБ на процесс)
+
+# Ограничение частоты запросов (token bucket): имя маршрута -> (лимит, по кому)
+# "user" - по сессии (без запроса в базу), "ip" - по адресу клиента
+RATE_LIMITS = {
+    "like": ("30/m", "user"),
+    "dislike": ("30/m", "user"),
+    "comment": ("10/m", "user"),
+    "create-report": ("5/m", "user"),
+    "register": ("5/h", "ip"),
+}
+RATE_LIMIT_METHODS = ("POST",)
+RATE_LIMIT_CACHE = None  # Алиас из CACHES для общего лимита между процессами, None - память процесса
+RATE_LIMIT_TRUST_FORWARDED = False  # True если стоим за своим прокси (X-Forwarded-For)
+
+# Очередь фоновых задач в базе, воркеры: python manage.py run_worker --processes 2 --threads 4
+TASK_QUEUE_EAGER = False  # True - выполнять сразу после коммита, без воркера
+TASK_QUEUE_BATCH_SIZE = 100  # Сколько задач воркер берет одним запросом
+TASK_QUEUE_LEASE = 5 * 60  # Через сколько секунд задачу упавшего воркера возьмет другой
+TASK_QUEUE_BACKOFF_BASE = 5  # Повтор после ошибки через 5, 10, 20... секунд
+TASK_QUEUE_BACKOFF_MAX = 60 * 60
+TASK_QUEUE_MAX_ATTEMPTS = 5
+
+# RSS/Atom ленты и карта сайта: готовые файлы, пересобираются в фоне только затронутые
+FEEDS_ROOT = os.path.join(BASE_DIR, 'cache', 'feeds')
+FEEDS_SITE_URL = "http://localhost:8000"  # Для абсолютных ссылок в лентах
+FEED_ITEMS = 50  # Сколько последних постов в ленте
+SITEMAP_SEGMENT_SIZE = 10_000  # Постов в одном файле карты сайта (диапазон pk)
+FEEDS_REGENERATE_DELAY = 5  # Секунды: пачка изменений подряд пересобирает файл один раз
+FEEDS_MAX_AGE = 5 * 60
+FEEDS_RETRY_AFTER = 30  # Файла еще нет: сборка в очереди, ответ 503 с Retry-After
+
+# Сэмплирующий профилировщик (staff/profiler/): снимки стеков всех процессов в общей папке
+PROFILER_DIR = os.path.join(BASE_DIR, 'cache', 'profiles')
+PROFILER_INTERVAL = 0.005  # Секунды между снимками (200 в секунду)
+PROFILER_MAX_SECONDS = 10 * 60  # Дольше профилировать все запросы не даем
+PROFILER_TOKEN_MAX_AGE = 60 * 60  # Сколько действует токен для заголовка X-Profile
+
+# Архивация: лайки и комменты постов старше ARCHIVE_AFTER_DAYS дней переезжают в базу "archive"
+ARCHIVE_AFTER_DAYS = 180
+ARCHIVE_CHUNK_SIZE = 1000  # Строк за одну транзакцию
+ARCHIVE_CHUNK_PAUSE = 0.05  # Секунды между порциями
+
+# Похожие посты (TF-IDF по тексту + общие лайки), считаются офлайн: python manage.py build_related
+RELATED_POSTS_COUNT = 5
+RELATED_TEXT_WEIGHT = 0.7
+RELATED_LIKES_WEIGHT = 0.3
+RELATED_BLOCK_CELLS = 4_000_000  # Размер блока матрицы оценок (float32: 16 МБ)
+RELATED_DELAY = 60  # Новые посты пачкой получают похожие через столько секунд
+# Новые посты считаются по векторам последнего полного пересчета, полный ставится в очередь раз в интервал
+RELATED_VECTORS_PATH = os.path.join(BASE_DIR, 'cache', 'related.npz')
+RELATED_REBUILD_INTERVAL = 24 * 60 * 60
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -14,10 +14,16 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, include, re_path
+
+from app.views import serve_media, serve_static
 
 urlpatterns = [
     path('admin/', admin.site.urls),
-    path("", include("app.urls"))
+    path("", include("app.urls")),
+    # Медиа и статика с ETag/Range/кешированием, либо через X-Sendfile/X-Accel-Redirect
+    re_path(r"^%s(?P<path>.+)$" % settings.MEDIA_URL.lstrip("/"), serve_media, name="media"),
+    re_path(r"^%s(?P<path>.+)$" % settings.STATIC_URL.lstrip("/"), serve_static, name="static"),
 ]